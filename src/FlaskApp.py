@@ -1,13 +1,474 @@
-from simulation import MyApp
-from flask import Flask, render_template
+import sys
+import math
+import time
+import queue
+import argparse
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+from flask import Flask, Response, render_template, request, jsonify
+from panda3d.core import load_prc_file_data
+
+# The browser is the only window, the offscreen backend is set up in main()
+load_prc_file_data("", "audio-library-name null")
+
+from panda import OffscreenPanda
+from funcs import changeSpeed, changeThermo, changeBaro, calcAtomPairs, speedText
+from geometry import GeometryEncoder, MESSAGE, KEYFRAME
+from coloring import COLORMAPS, PRESETS
+from backend import add_backend_arguments, backend_from_args
 
 flaskApp = Flask(__name__)
+# Set up in main(), shared by every request
+server = None
+
+
+class FrameBroadcaster:
+    """Newest encoded frame, shared by every connected viewer.
+
+    Each rendered frame is encoded once in a thread pool, however many clients watch it.
+    Clients never queue frames: a client that is slower than the renderer gets the newest
+    frame whenever it is ready for the next one, and a frame arriving while every encoder
+    is busy is dropped. Adding a viewer only adds one more socket write per frame.
+    """
+    def __init__(self, workers=4, image_format="jpeg", quality=80):
+        self.workers = workers
+        self.pool = ThreadPoolExecutor(workers, thread_name_prefix="encoder")
+        if image_format == "png":
+            self.extension, self.mimetype, self.params = ".png", "image/png", [cv2.IMWRITE_PNG_COMPRESSION, 1]
+        else:
+            self.extension, self.mimetype, self.params = ".jpg", "image/jpeg", [cv2.IMWRITE_JPEG_QUALITY, quality]
+        self.cond = threading.Condition()
+        self.image = None
+        self.published = 0  # sequence number of self.image
+        self.submitted = 0
+        self.pending = 0
+        self.clients = 0
+        self.stats = {"encoded": 0, "dropped": 0, "encode_ms": 0.0}
+
+    def submit(self, frame):
+        # frame is an (H, W, 3) BGR array the caller doesn't touch again
+        with self.cond:
+            if self.pending >= self.workers:
+                self.stats["dropped"] += 1
+                return False
+            self.submitted += 1
+            self.pending += 1
+            seq = self.submitted
+        self.pool.submit(self.encode, seq, frame)
+        return True
+
+    def encode(self, seq, frame):
+        # OpenCV releases the GIL while encoding, so the encoders run in parallel with
+        # the render loop
+        start = time.perf_counter()
+        ok, data = cv2.imencode(self.extension, frame, self.params)
+        with self.cond:
+            self.pending -= 1
+            self.stats["encode_ms"] = 1000 * (time.perf_counter() - start)
+            # A frame finished after a newer one is stale and dropped
+            if ok and seq > self.published:
+                self.image = data.tobytes()
+                self.published = seq
+                self.stats["encoded"] += 1
+                self.cond.notify_all()
+
+    def latest(self, after=0, timeout=5.0):
+        # Wait for a frame newer than after. Returns (seq, image), image is None on timeout.
+        with self.cond:
+            self.cond.wait_for(lambda: self.published > after, timeout)
+            if self.published > after:
+                return self.published, self.image
+            return after, None
+
+    def stream(self):
+        # multipart/x-mixed-replace body of one MJPEG client
+        with self.cond:
+            self.clients += 1
+        try:
+            seq = 0
+            while True:
+                seq, image = self.latest(seq)
+                if image is None:
+                    continue
+                yield (b"--frame\r\nContent-Type: " + self.mimetype.encode() +
+                       b"\r\nContent-Length: " + str(len(image)).encode() + b"\r\n\r\n" + image + b"\r\n")
+        finally:
+            # Runs when the client disconnects and the server closes the generator
+            with self.cond:
+                self.clients -= 1
+
+    def close(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+
+class GeometryBroadcaster:
+    """Binary geometry messages for clients that draw the scene themselves.
+
+    Messages are delta encoded against the previous one, so unlike JPEG frames they can't
+    be skipped one at a time. The last backlog messages are kept for clients that are a
+    little behind. A client that connects, or that fell so far behind that its next
+    message is gone, asks for a keyframe and continues from there. A keyframe of 100k
+    atoms is as large as 4-6 deltas, so they are only encoded when a client needs one
+    (and every keyframe_every messages of the encoder, if set).
+    """
+    def __init__(self, encoder, backlog=16):
+        self.encoder = encoder
+        # One thread, every message depends on the one encoded before it
+        self.pool = ThreadPoolExecutor(1, thread_name_prefix="geometry")
+        self.cond = threading.Condition()
+        self.messages = collections.deque(maxlen=backlog)  # (sequence number, message)
+        self.keyframe = None  # newest keyframe and its sequence number
+        self.keyframe_seq = 0
+        self.keyframe_wanted = False
+        self.published = 0
+        self.busy = False
+        self.clients = 0
+        self.stats = {"messages": 0, "keyframes": 0, "dropped": 0, "bytes": 0, "encode_ms": 0.0}
+
+    def submit(self, x, cell, boxlo, bonds):
+        # Arrays are copies the caller doesn't touch again
+        with self.cond:
+            if self.busy:
+                self.stats["dropped"] += 1
+                return False
+            self.busy = True
+        self.pool.submit(self.encode, x, cell, boxlo, bonds)
+        return True
+
+    def encode(self, x, cell, boxlo, bonds):
+        start = time.perf_counter()
+        with self.cond:
+            keyframe, self.keyframe_wanted = self.keyframe_wanted, False
+        try:
+            message = self.encoder.encode(x, cell, boxlo, bonds, keyframe=keyframe)
+        finally:
+            with self.cond:
+                self.busy = False
+        with self.cond:
+            self.published += 1
+            self.messages.append((self.published, message))
+            if MESSAGE.unpack_from(message)[2] & KEYFRAME:
+                self.keyframe, self.keyframe_seq = message, self.published
+                self.stats["keyframes"] += 1
+            self.stats["messages"] += 1
+            self.stats["bytes"] += len(message)
+            self.stats["encode_ms"] = 1000 * (time.perf_counter() - start)
+            self.cond.notify_all()
+
+    def pending(self, sent):
+        # Messages for a client that has every message up to sent, None if it has to wait
+        # for a keyframe
+        oldest = self.messages[0][0] if self.messages else self.published + 1
+        if sent > 0 and sent >= oldest - 1:
+            return [message for seq, message in self.messages if seq > sent]
+        if self.keyframe is not None and self.keyframe_seq >= oldest - 1:
+            return [self.keyframe] + [message for seq, message in self.messages if seq > self.keyframe_seq]
+        return None
+
+    def stream(self):
+        with self.cond:
+            self.clients += 1
+        try:
+            sent = 0
+            while True:
+                with self.cond:
+                    self.cond.wait_for(lambda: self.published > sent, 5.0)
+                    messages = self.pending(sent)
+                    if messages is None:
+                        self.keyframe_wanted = True
+                        self.cond.wait_for(lambda: self.pending(sent) is not None, 5.0)
+                        continue
+                    if not messages:
+                        continue
+                    sent = self.published
+                yield b"".join(messages)
+        finally:
+            with self.cond:
+                self.clients -= 1
+
+    def close(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+
+def geometry_meta(panda):
+    # Symbol, color and scale of every atom type, sent with each keyframe
+    types, first = np.unique(panda.atom_type_list, return_index=True)
+    return {"types": {str(t): {"symbol": str(panda.type_to_symbol.get(t, t)),
+                               "color": [round(float(c), 3) for c in panda.atom_colors[i]],
+                               "scale": [round(float(c), 3) for c in panda.atom_scales[i]]}
+                      for t, i in zip(types, first)}}
+
+
+# Slider actions of /control: the function applying them and the slider's range
+SLIDERS = {"speed": (changeSpeed, 1, 10), "thermostat": (changeThermo, -5000, 13000),
+           "barostat": (changeBaro, -1000, 1000)}
+
+
+def number(params, key, kind=float):
+    # Finite number parameter of a /control request
+    try:
+        value = kind(params[key])
+    except (KeyError, TypeError, ValueError, OverflowError):
+        raise ValueError(f"{key} has to be a number") from None
+    if not math.isfinite(value):
+        raise ValueError(f"{key} has to be finite")
+    return value
+
+
+class WebSimulation:
+    """Runs the one shared OffscreenPanda for all web clients.
+
+    Panda3D and LAMMPS are only touched from the thread calling run(). Control requests
+    arrive on Flask's threads and are queued as callables, which run() applies between
+    frames. Nothing is rendered while no client is connected.
+    """
+    def __init__(self, panda, broadcaster, geometry, fps=30, geometry_fps=5):
+        self.panda = panda
+        self.broadcaster = broadcaster
+        self.geometry = geometry
+        self.frame_time = 1 / fps
+        self.geometry_time = 1 / geometry_fps
+        self.next_geometry = 0.0
+        self.commands = queue.Queue()
+        self.running = True
+
+    def control(self, action, params):
+        # Parameters are parsed here on the request's thread, a malformed request raises
+        # ValueError instead of failing between frames
+        panda = self.panda
+        if panda.playback is not None and action in ("thermostat", "barostat", "color"):
+            raise ValueError(f"{action} needs a running simulation")
+        if action in ("rotate", "pan"):
+            dx, dy = number(params, "dx"), number(params, "dy")
+            move = panda.rotate_camera if action == "rotate" else panda.pan_camera
+            command = lambda: move(dx, dy)
+        elif action == "zoom":
+            delta = number(params, "delta")
+            command = lambda: panda.zoom_camera(delta)
+        elif action in SLIDERS:
+            change, low, high = SLIDERS[action]
+            value = number(params, "value", int)
+            if not low <= value <= high:
+                raise ValueError(f"{action} has to be between {low} and {high}")
+            command = lambda: change(panda, None, value)
+        elif action == "show":
+            name = params.get("object")
+            if name not in ("box", "atoms", "bonds"):
+                raise ValueError(f"Unknown object {name!r}")
+            command = lambda: self.toggle_show_object(name)
+        elif action == "color":
+            source, colormap = params.get("source"), params.get("colormap")
+            if source is not None and not isinstance(source, str):
+                raise ValueError("source has to be a string")
+            if colormap is not None and colormap not in COLORMAPS:
+                raise ValueError(f"Unknown colormap {colormap!r}")
+            # Whether LAMMPS has the value is only known once it is applied
+            command = lambda: panda.set_coloring(source, colormap)
+        elif action == "center":
+            command = self.center_camera
+        elif action == "pause":
+            command = lambda: setattr(panda, "paused", not panda.paused)
+        elif action == "reset":
+            command = self.reset_simulation
+        else:
+            raise ValueError(f"Unknown action {action!r}")
+        self.commands.put(command)
+
+    def center_camera(self):
+        self.panda.center_camera()
+        self.panda.cam_pivot.set_hpr(0, 0, 0)
+
+    def reset_simulation(self):
+        if self.panda.playback is not None:
+            self.panda.seekFrame(0)
+        else:
+            self.panda.restoreState("initial")
+
+    def toggle_show_object(self, object):
+        panda = self.panda
+        nodes = {"box": ("show_box", panda.box_path), "atoms": ("show_atoms", panda.atom_layer),
+                 "bonds": ("show_bonds", panda.bond_node)}
+        flag, node = nodes[object]
+        visible = not getattr(panda, flag)
+        setattr(panda, flag, visible)
+        if node:
+            node.show() if visible else node.hide()
+        panda.redraw.invalidate("visibility")
+
+    def state(self):
+        # Settings and latest thermo values for the page's sliders and readouts
+        panda = self.panda
+        thermo = {key: float(history.view()[-1]) for key, history in panda.sim_info.items() if history.count}
+        error = None if panda.engine_error is None else str(panda.engine_error)
+        return {"paused": panda.paused, "error": error, "timestep": panda.timestep, "speed": speedText(panda),
+                "steps_per_frame": panda.scheduler.steps, "tStop": panda.tStop, "pStop": panda.pStop,
+                "playback": panda.playback is not None, "clients": self.broadcaster.clients,
+                "show": {"box": panda.show_box, "atoms": panda.show_atoms, "bonds": panda.show_bonds},
+                "coloring": {"source": panda.coloring.spec, "colormap": panda.coloring.colormap,
+                             "range": panda.coloring.range},
+                "thermo": thermo, "frames": dict(self.broadcaster.stats), "geometry_clients": self.geometry.clients,
+                "geometry": dict(self.geometry.stats), "readback": panda.profiler.counter_summary()}
+
+    def run(self):
+        panda = self.panda
+        while self.running:
+            start = time.perf_counter()
+            panda.profiler.begin_frame()
+            while not self.commands.empty():
+                # A command that fails (e.g. a deck rejecting a fix, an unknown per-atom
+                # value) is logged, the server keeps running for the other viewers
+                try:
+                    self.commands.get()()
+                except Exception:
+                    flaskApp.logger.exception("Control command failed")
+            if not panda.paused:
+                panda.moveAtomsTask()
+            # Frames are only rendered when the view changed, new clients get the last one
+            if self.broadcaster.clients > 0:
+                panda.updateSceneTask()
+                # Always at full resolution, the JPEG has the size of the page's image
+                if panda.next_render_scale() is not None:
+                    # Copied here because the next render reuses the RAM image, the alpha
+                    # channel is left behind in the same copy
+                    frame = np.ascontiguousarray(panda.render_frame_to_array()[:, :, :3])
+                    panda.profiler.count("cpu_copies")
+                    self.broadcaster.submit(frame)
+                elif panda.readback_pending:
+                    # With a threaded backend the last frame is still in flight once the view
+                    # stops changing
+                    frame = np.ascontiguousarray(panda.frame_to_array(panda.finish_frame_to_ram())[:, :, :3])
+                    panda.profiler.count("cpu_copies")
+                    self.broadcaster.submit(frame)
+            if self.geometry.clients > 0 and start >= self.next_geometry:
+                self.next_geometry = start + self.geometry_time
+                bonds = None
+                if panda.show_bonds:
+                    # Already up to date if updateSceneTask ran above
+                    if self.broadcaster.clients == 0:
+                        calcAtomPairs(panda)
+                    bonds = np.array(panda.bond_pairs, dtype=np.int32).reshape(-1, 2)
+                self.geometry.submit(panda.x.copy(), panda.cell.copy(), panda.boxlo.copy(), bonds)
+            panda.profiler.end_frame(panda)
+            time.sleep(max(0.0, self.frame_time - (time.perf_counter() - start)))
+
 
 @flaskApp.route('/')
 def home():
-    app = MyApp()
-    return render_template('home.html', app=app)
+    return render_template('home.html', width=server.panda.W, height=server.panda.H,
+                           presets={source: preset[0] for source, preset in PRESETS.items()},
+                           colormaps=list(COLORMAPS))
+
+
+@flaskApp.route('/stream')
+def stream():
+    return Response(server.broadcaster.stream(), mimetype="multipart/x-mixed-replace; boundary=frame",
+                    headers={"Cache-Control": "no-store"})
+
+
+@flaskApp.route('/geometry')
+def geometry():
+    # Stream of geometry.GeometryEncoder messages, see geometry.py for the layout
+    return Response(server.geometry.stream(), mimetype="application/octet-stream",
+                    headers={"Cache-Control": "no-store"})
+
+
+@flaskApp.route('/frame')
+def frame():
+    # Single newest frame, for clients that poll instead of streaming
+    broadcaster = server.broadcaster
+    with broadcaster.cond:
+        broadcaster.clients += 1
+    try:
+        seq, image = broadcaster.latest(int(request.args.get("after", 0)))
+    finally:
+        with broadcaster.cond:
+            broadcaster.clients -= 1
+    if image is None:
+        return Response(status=204)
+    return Response(image, mimetype=broadcaster.mimetype, headers={"X-Frame": str(seq), "Cache-Control": "no-store"})
+
+
+@flaskApp.route('/control', methods=['POST'])
+def control():
+    params = request.get_json(force=True)
+    if not isinstance(params, dict):
+        return jsonify({"ok": False, "error": "Expected a JSON object"}), 400
+    try:
+        server.control(params.get("action"), params)
+    except ValueError as e:
+        return jsonify({"ok": False, "error": str(e)}), 400
+    return jsonify({"ok": True})
+
+
+@flaskApp.route('/state')
+def state():
+    return jsonify(server.state())
+
+
+def main():
+    global server
+    parser = argparse.ArgumentParser(description="Serve the simulation to web browsers as an MJPEG stream")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--fps", type=float, default=30, help="maximum frames rendered per second")
+    parser.add_argument("--encoders", type=int, default=4, help="threads encoding frames")
+    parser.add_argument("--format", choices=["jpeg", "png"], default="jpeg")
+    parser.add_argument("--quality", type=int, default=80, help="JPEG quality")
+    parser.add_argument("--geometry-fps", type=float, default=5, help="geometry messages per second on /geometry")
+    parser.add_argument("--geometry-bits", type=int, default=12, choices=range(8, 17), metavar="8-16",
+                        help="position resolution of /geometry, as a fraction 1 / 2**bits of the box")
+    parser.add_argument("--keyframe-every", type=int, default=0,
+                        help="geometry messages between keyframes, 0 sends them only when a client needs one")
+    parser.add_argument("--width", type=int, default=1080)
+    parser.add_argument("--height", type=int, default=960)
+    parser.add_argument("--input", default=None, help="LAMMPS input deck (default inputs/tersoff.in)")
+    parser.add_argument("--play", metavar="PATH", default=None, help="play back a recorded trajectory, LAMMPS dump or data file")
+    parser.add_argument("--threaded", action="store_true", help="advance LAMMPS in a background thread")
+    parser.add_argument("--speed-mode", choices=["fixed", "rate", "fps"], default="rate",
+                        help="what the speed slider sets: steps per frame, simulated time per second or frame rate")
+    parser.add_argument("--bond-style", choices=["lines", "cylinders"], default="lines")
+    parser.add_argument("--atom-style", choices=["spheres", "impostors"], default="spheres")
+    parser.add_argument("--profile", metavar="PATH", default=None,
+                        help="stream per-stage frame timings, readback copies and memory to a .csv file (JSON lines otherwise)")
+    add_backend_arguments(parser)
+    args = parser.parse_args()
+    backend_from_args(parser, args).apply()
+
+    panda = OffscreenPanda(args.width, args.height, input_file=args.input, trajectory=args.play)
+    panda.bond_style = args.bond_style
+    panda.scheduler.mode = args.speed_mode
+    panda.set_atom_style(args.atom_style)
+    if args.profile:
+        panda.profiler.enabled = True
+        panda.profiler.start_export(args.profile)
+    panda.moveAtomsTask()
+    panda.drawSimulationBoxTask()
+    panda.center_camera()
+    if args.threaded and panda.playback is None:
+        panda.startEngine()
+
+    encoder = GeometryEncoder(panda.atom_type_list, panda.periodicity, geometry_meta(panda),
+                              keyframe_every=args.keyframe_every, bits=args.geometry_bits)
+    server = WebSimulation(panda, FrameBroadcaster(args.encoders, args.format, args.quality),
+                           GeometryBroadcaster(encoder), args.fps, args.geometry_fps)
+    # Flask serves from its own threads, Panda3D stays on the main thread
+    web = threading.Thread(target=flaskApp.run, kwargs={"host": args.host, "port": args.port, "threaded": True,
+                                                        "use_reloader": False}, daemon=True)
+    web.start()
+    try:
+        server.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.broadcaster.close()
+        server.geometry.close()
+        panda.stopEngine()
+        panda.profiler.stop_export()
+    return 0
 
 
 if __name__ == '__main__':
-    flaskApp.run(debug=True)
+    sys.exit(main())
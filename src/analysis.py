@@ -0,0 +1,262 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from scipy.spatial import cKDTree
+from neighbors import periodic_images
+
+
+class AnalysisFrame:
+    """Copy of the per-atom arrays of one frame, owned by the analysis workers."""
+    def __init__(self, step, x, xu, cell, boxlo, periodicity):
+        self.step = step
+        self.x = x.copy()
+        self.xu = xu.copy()
+        self.cell = cell.copy()
+        self.boxlo = boxlo.copy()
+        self.periodic = np.asarray(periodicity, dtype=bool)
+
+
+def type_groups(types):
+    # Sorted unique types and the atom indices of each
+    return {int(t): np.flatnonzero(types == t) for t in np.unique(types)}
+
+
+class RadialDistribution:
+    """Per type pair radial distribution functions g(r), averaged over recent frames.
+
+    The distances come from one sparse KD-tree query of the center atoms against the
+    periodically padded atoms and are binned with a single bincount over all type pairs.
+    Large systems use a random subset of at most max_centers atoms per type as centers,
+    which keeps the cost per frame bounded.
+    """
+    def __init__(self, types, r_max, nbins=100, window=50, max_centers=2000, seed=0):
+        self.types = np.asarray(types)
+        self.groups = type_groups(self.types)
+        self.r_max = r_max
+        self.nbins = nbins
+        self.edges = np.linspace(0, r_max, nbins + 1)
+        self.r = 0.5 * (self.edges[1:] + self.edges[:-1])
+        self.shell = 4 / 3 * np.pi * np.diff(self.edges ** 3)
+        self.pairs = [(a, b) for a in self.groups for b in self.groups if a <= b]
+        self.pair_index = np.zeros((self.types.max() + 1,) * 2, dtype=np.intp)
+        for k, (a, b) in enumerate(self.pairs):
+            self.pair_index[a, b] = self.pair_index[b, a] = k
+        # Exponentially weighted sums over about window frames
+        self.decay = 1 - 1 / window
+        self.counts = np.zeros((len(self.pairs), nbins))
+        self.ideal = np.zeros(len(self.pairs))
+        self.max_centers = max_centers
+        self.rng = np.random.default_rng(seed)
+
+    def reset(self):
+        self.counts[:] = 0
+        self.ideal[:] = 0
+
+    def update(self, frame, wrapped, tree, index):
+        centers = {t: atoms if len(atoms) <= self.max_centers else
+                   self.rng.choice(atoms, self.max_centers, replace=False) for t, atoms in self.groups.items()}
+        center_atoms = np.concatenate(list(centers.values()))
+        near = cKDTree(wrapped[center_atoms]).sparse_distance_matrix(tree, self.r_max, output_type="ndarray")
+        near = near[near["v"] > 0]
+        pair = self.pair_index[self.types[center_atoms[near["i"]]], self.types[index[near["j"]]]]
+        bins = np.minimum((near["v"] * (self.nbins / self.r_max)).astype(np.intp), self.nbins - 1)
+        counts = np.bincount(pair * self.nbins + bins, minlength=self.counts.size)
+        # Pairs an ideal gas of the same density would have per unit shell volume. Centers of
+        # either type of a pair count the partners of the other one.
+        volume = abs(np.linalg.det(frame.cell))
+        ideal = np.zeros(len(self.pairs))
+        for k, (a, b) in enumerate(self.pairs):
+            if a == b:
+                ideal[k] = len(centers[a]) * (len(self.groups[a]) - 1) / volume
+            else:
+                ideal[k] = (len(centers[a]) * len(self.groups[b]) + len(centers[b]) * len(self.groups[a])) / volume
+        self.counts *= self.decay
+        self.counts += counts.reshape(self.counts.shape)
+        self.ideal *= self.decay
+        self.ideal += ideal
+
+    def result(self):
+        return self.r, {f"{a}-{b}": self.counts[k] / (self.ideal[k] * self.shell)
+                        for k, (a, b) in enumerate(self.pairs) if self.ideal[k] > 0}
+
+
+class CoordinationHistogram:
+    """Fraction of the atoms of each type with a given number of bonded neighbors.
+
+    Neighbors are counted within the same per-atom cutoffs as the drawn bonds, using one
+    sparse distance query of the atoms against their periodically padded copies.
+    """
+    def __init__(self, types, cutoffs, max_coordination=16, window=50):
+        self.types = np.asarray(types)
+        self.groups = type_groups(self.types)
+        self.cutoffs = np.asarray(cutoffs, dtype=float)
+        self.max_coordination = max_coordination
+        self.decay = 1 - 1 / window
+        self.hist = {t: np.zeros(max_coordination + 1) for t in self.groups}
+        self.mean = {t: 0.0 for t in self.groups}
+
+    def reset(self):
+        for t in self.groups:
+            self.hist[t][:] = 0
+
+    def update(self, frame, wrapped, tree, index):
+        near = cKDTree(wrapped).sparse_distance_matrix(tree, self.cutoffs.max(), output_type="ndarray")
+        i, j = near["i"], index[near["j"]]
+        bonded = (near["v"] <= np.minimum(self.cutoffs[i], self.cutoffs[j])) & (near["v"] > 0)
+        coordination = np.bincount(i[bonded], minlength=len(wrapped))
+        np.minimum(coordination, self.max_coordination, out=coordination)
+        for t, atoms in self.groups.items():
+            counts = np.bincount(coordination[atoms], minlength=self.max_coordination + 1)
+            self.hist[t] *= self.decay
+            self.hist[t] += counts
+            self.mean[t] = coordination[atoms].mean()
+
+    def result(self):
+        return np.arange(self.max_coordination + 1), {t: hist / hist.sum() for t, hist in self.hist.items()
+                                                      if hist.sum() > 0}
+
+
+class MeanSquaredDisplacement:
+    """Multiple time origin MSD per atom type from unwrapped coordinates.
+
+    Every origin_every steps the current positions become a new time origin, at most
+    max_origins of them are kept. Each frame adds the displacement from every origin to
+    the bin of its lag, so the curve averages over all origins. As in LAMMPS' compute msd
+    with com yes, the drift of the center of mass is removed.
+    """
+    def __init__(self, types, masses=None, origin_every=100, max_origins=20, nbins=100):
+        self.groups = type_groups(np.asarray(types))
+        self.masses = None if masses is None else np.asarray(masses, dtype=float)
+        self.origin_every = origin_every
+        self.max_origins = max_origins
+        self.max_lag = origin_every * max_origins
+        self.nbins = nbins
+        self.sums = {t: np.zeros(nbins) for t in self.groups}
+        self.counts = np.zeros(nbins)
+        self.origins = []  # (step, positions, center of mass)
+        self.last_step = None
+
+    def reset(self):
+        for t in self.groups:
+            self.sums[t][:] = 0
+        self.counts[:] = 0
+        self.origins = []
+        self.last_step = None
+
+    def center_of_mass(self, xu):
+        if self.masses is None:
+            return xu.mean(axis=0)
+        return self.masses @ xu / self.masses.sum()
+
+    def update(self, frame):
+        step, xu = frame.step, frame.xu
+        if self.last_step is not None and step <= self.last_step:
+            # Time went backwards (state restored), the old origins don't apply anymore
+            self.reset()
+        self.last_step = step
+        com = self.center_of_mass(xu)
+        if not self.origins or step - self.origins[-1][0] >= self.origin_every:
+            self.origins.append((step, xu.copy(), com))
+        self.origins = [o for o in self.origins if step - o[0] < self.max_lag][-self.max_origins:]
+        for origin_step, origin, origin_com in self.origins:
+            lag = step - origin_step
+            if lag == 0:
+                continue
+            b = lag * self.nbins // self.max_lag
+            d = xu - origin - (com - origin_com)
+            sq = np.einsum("ij,ij->i", d, d)
+            for t, atoms in self.groups.items():
+                self.sums[t][b] += sq[atoms].mean()
+            self.counts[b] += 1
+
+    def result(self, dt):
+        # Lag times, MSD per type and the diffusion coefficient per type from the slope of
+        # the second half of the curve (MSD = 6 D t)
+        filled = self.counts > 0
+        lag = (np.arange(self.nbins) + 0.5) * self.max_lag / self.nbins * dt
+        t = lag[filled]
+        msd = {ty: self.sums[ty][filled] / self.counts[filled] for ty in self.groups}
+        diffusion = {}
+        if len(t) >= 4:
+            half = len(t) // 2
+            for ty, curve in msd.items():
+                diffusion[ty] = np.polyfit(t[half:], curve[half:], 1)[0] / 6
+        return t, msd, diffusion
+
+
+class AnalysisPipeline:
+    """Runs the structural analyses on a thread pool, off the render loop.
+
+    submit() hands a frame to the workers and returns immediately. An analysis that is
+    still busy with an earlier frame skips the new one, so the analyses sample the run at
+    whatever rate they can keep up with. results() returns the latest finished results.
+    The heavy parts (KD-tree queries, NumPy kernels) release the GIL.
+    """
+    def __init__(self, types, cutoffs, cell, dt=1.0, masses=None, r_max=None, workers=2,
+                 msd_origin_every=100, msd_origins=20):
+        if r_max is None:
+            # Up to half the narrowest box width, where g(r) is still free of self images
+            widths = 1 / np.linalg.norm(np.linalg.inv(cell), axis=0)
+            r_max = min(0.5 * widths.min(), 4 * max(cutoffs))
+        self.dt = dt
+        self.rdf = RadialDistribution(types, r_max)
+        self.coordination = CoordinationHistogram(types, cutoffs)
+        self.msd = MeanSquaredDisplacement(types, masses, msd_origin_every, msd_origins)
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="analysis")
+        self.pending = {"structure": None, "msd": None}
+        self.lock = threading.Lock()
+        self.latest = {}
+        self.version = 0
+        self.stats = {"submitted": 0, "structure": 0, "msd": 0}
+
+    def busy(self, name):
+        future = self.pending[name]
+        return future is not None and not future.done()
+
+    def submit(self, step, x, xu, cell, boxlo, periodicity):
+        # Returns False if every analysis is still busy and the frame was skipped
+        idle = [name for name in self.pending if not self.busy(name)]
+        if not idle:
+            return False
+        frame = AnalysisFrame(step, x, xu, cell, boxlo, periodicity)
+        for name in idle:
+            self.pending[name] = self.pool.submit(getattr(self, f"run_{name}"), frame)
+        self.stats["submitted"] += 1
+        return True
+
+    def run_structure(self, frame):
+        # Both analyses query the same tree of the atoms and their periodic images
+        r = max(self.rdf.r_max, self.coordination.cutoffs.max())
+        wrapped, points, index = periodic_images(frame.x, frame.cell, frame.boxlo, frame.periodic, r)
+        tree = cKDTree(points)
+        self.rdf.update(frame, wrapped, tree, index)
+        self.coordination.update(frame, wrapped, tree, index)
+        self.publish("structure", rdf=self.rdf.result(), coordination=self.coordination.result(),
+                     mean_coordination=dict(self.coordination.mean))
+
+    def run_msd(self, frame):
+        self.msd.update(frame)
+        t, msd, diffusion = self.msd.result(self.dt)
+        self.publish("msd", msd=(t, msd), diffusion=diffusion)
+
+    def publish(self, name, **results):
+        with self.lock:
+            self.latest.update(results)
+            self.version += 1
+            self.stats[name] += 1
+
+    def results(self):
+        with self.lock:
+            return self.version, dict(self.latest)
+
+    def reset(self):
+        # Wait for running jobs and drop everything accumulated so far
+        for name, future in self.pending.items():
+            if future is not None:
+                future.result()
+        self.rdf.reset()
+        self.coordination.reset()
+        self.msd.reset()
+
+    def close(self):
+        self.pool.shutdown(wait=True)
@@ -0,0 +1,84 @@
+import os
+from panda3d.core import load_prc_file_data
+
+# Panda3D display modules. EGL renders without an X server, GLX needs one (or Xvfb). "auto"
+# lets Panda3D try its default order.
+DISPLAYS = {"auto": None, "egl": "p3headlessgl", "glx": "pandagl"}
+# Panda3D threading models by the stages that get their own thread: "draw" draws in a second
+# thread, "cull" culls and draws in one second thread, "cull-draw" gives each its own
+THREADING_MODELS = {"single": "", "draw": "/Draw", "cull": "Cull", "cull-draw": "Cull/Draw"}
+
+
+class RenderBackend:
+    """Display module, rasterizer and threading of Panda3D's offscreen rendering.
+
+    Has to be applied before the first ShowBase is created. With software GL, Mesa's llvmpipe
+    rasterizes with render_threads threads (LP_NUM_THREADS, 0 keeps Mesa's default of one
+    per core). A threading model other than "single" moves culling and/or drawing off the
+    App thread, so they overlap the simulation step and bond update of the next frame. The
+    frames then come out a few frames late, see OffscreenPanda.render_frame_to_ram.
+
+    A threaded draw needs GLX (an X server, or Xvfb on a render node). Panda3D 1.10 only
+    binds the desktop OpenGL API in the App thread, so an EGL context made in the draw
+    thread is OpenGL ES 1 and can't run the atom shaders.
+    """
+    def __init__(self, display="auto", threading="single", software=True, render_threads=0):
+        if display not in DISPLAYS:
+            raise ValueError(f"Unknown display {display}, expected one of {', '.join(DISPLAYS)}")
+        if threading not in THREADING_MODELS:
+            raise ValueError(f"Unknown threading model {threading}, expected one of {', '.join(THREADING_MODELS)}")
+        if display == "egl" and threading != "single":
+            raise ValueError(f"The {threading} threading model needs the glx display, EGL only renders single threaded")
+        self.display = display
+        self.threading = threading
+        self.software = software
+        self.render_threads = render_threads
+
+    @classmethod
+    def parse(cls, spec, software=True):
+        # "display[:threading[:render threads]]", e.g. "egl", "egl:cull-draw" or "auto:draw:8"
+        parts = spec.split(":")
+        threads = int(parts[2]) if len(parts) > 2 and parts[2] else 0
+        return cls(parts[0] or "auto", parts[1] if len(parts) > 1 and parts[1] else "single", software, threads)
+
+    @property
+    def name(self):
+        name = f"{self.display}:{self.threading}:{self.render_threads or 'auto'}"
+        return name if self.software else name + ":hw"
+
+    def apply(self):
+        load_prc_file_data("", "window-type offscreen")
+        display = self.display
+        if display == "auto" and self.threading != "single":
+            # Don't let Panda3D fall back to EGL, see above
+            display = "glx"
+        if DISPLAYS[display] is not None:
+            load_prc_file_data("", f"load-display {DISPLAYS[display]}")
+        if THREADING_MODELS[self.threading]:
+            load_prc_file_data("", f"threading-model {THREADING_MODELS[self.threading]}")
+        load_prc_file_data("", f"gl-force-software {'true' if self.software else 'false'}")
+        if self.software:
+            # Mesa reads these when the GL context is created
+            os.environ["LIBGL_ALWAYS_SOFTWARE"] = "1"
+            os.environ.setdefault("GALLIUM_DRIVER", "llvmpipe")
+        if self.render_threads:
+            os.environ["LP_NUM_THREADS"] = str(self.render_threads)
+        return self
+
+
+def add_backend_arguments(parser):
+    parser.add_argument("--display", choices=list(DISPLAYS), default="auto",
+                        help="Panda3D display module: egl renders headless without an X server")
+    parser.add_argument("--render-threading", choices=list(THREADING_MODELS), default="single",
+                        help="run Panda3D's cull and/or draw stages in their own threads (needs glx)")
+    parser.add_argument("--render-threads", type=int, default=0,
+                        help="llvmpipe rasterizer threads (LP_NUM_THREADS), 0 uses one per core")
+    parser.add_argument("--hardware-gl", action="store_true",
+                        help="use the GPU's OpenGL driver instead of forcing software rendering")
+
+
+def backend_from_args(parser, args):
+    try:
+        return RenderBackend(args.display, args.render_threading, not args.hardware_gl, args.render_threads)
+    except ValueError as e:
+        parser.error(str(e))
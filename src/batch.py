@@ -0,0 +1,159 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import multiprocessing
+import numpy as np
+import cv2
+from panda3d.core import load_prc_file_data
+from backend import add_backend_arguments, backend_from_args
+
+# This runs again in every spawned worker process, the rendering backend is applied in
+# init_worker before its Panda3D instance is created
+load_prc_file_data("", "audio-library-name null")
+
+# Panda3D instance of a worker process
+worker_panda = None
+
+
+def load_camera_path(path, n_frames, orbit):
+    # Per-frame camera states (heading, pitch, distance, pivot). A camera path file holds
+    # keyframes like {"frame": 0, "heading": 0, "pitch": -10, "distance": 40, "pivot": [x, y, z]}
+    # that are linearly interpolated. Missing values fall back to the centered default camera.
+    if path is None:
+        keys = [{"frame": 0, "heading": 0}, {"frame": max(n_frames - 1, 1), "heading": orbit * max(n_frames - 1, 1)}]
+    else:
+        with open(path, "r") as f:
+            keys = sorted(json.load(f), key=lambda k: k["frame"])
+    frames = np.arange(n_frames)
+    path = {}
+    for name in ("heading", "pitch", "distance"):
+        known = [(k["frame"], k[name]) for k in keys if name in k]
+        if known:
+            path[name] = np.interp(frames, [f for f, v in known], [v for f, v in known])
+    known = [(k["frame"], k["pivot"]) for k in keys if "pivot" in k]
+    if known:
+        pivots = np.array([p for f, p in known], dtype=float)
+        path["pivot"] = np.stack([np.interp(frames, [f for f, p in known], pivots[:, d]) for d in range(3)], axis=1)
+    return [{name: values[i] for name, values in path.items()} for i in range(n_frames)]
+
+
+def init_worker(backend, trajectory, W, H, bond_style, atom_style, atom_detail):
+    # Every worker owns an independent Panda3D instance fed from the shared trajectory file
+    global worker_panda
+    backend.apply()
+    from panda import OffscreenPanda
+    worker_panda = OffscreenPanda(W, H, trajectory=trajectory)
+    worker_panda.bond_style = bond_style
+    worker_panda.set_atom_style(atom_style)
+    worker_panda.set_atom_detail(atom_detail)
+    worker_panda.drawSimulationBoxTask()
+    worker_panda.center_camera()
+    worker_panda.default_camera = (worker_panda.cam_pivot.get_h(), worker_panda.cam_pivot.get_p(),
+                                   worker_panda.cam_distance, worker_panda.cam_pivot.get_pos())
+
+
+def render_frame(job):
+    # Render one frame. Image sequences are encoded right here in the worker, video frames
+    # are sent back to the parent as raw BGR pixels.
+    frame, camera, image_path = job
+    panda = worker_panda
+    panda.seekFrame(frame)
+    panda.drawSimulationBoxTask()
+    if panda.show_bonds:
+        panda.drawBondsTask()
+    heading, pitch, distance, pivot = panda.default_camera
+    panda.set_camera(camera.get("heading", heading), camera.get("pitch", pitch),
+                     camera.get("distance", distance), camera.get("pivot", pivot))
+    # Every job is a different frame, so a threaded backend has to finish it right away
+    bgr = panda.render_frame_to_array(wait=True)[:, :, :3]
+    if image_path is not None:
+        cv2.imwrite(image_path, bgr)
+        return frame, None
+    return frame, np.ascontiguousarray(bgr)
+
+
+def simulate_to_trajectory(input_file, n_frames, steps_per_frame, path, W, H):
+    # A deck has to be advanced in order, so it is simulated once into a trajectory that
+    # the render workers can then split between them
+    from panda import OffscreenPanda
+    panda = OffscreenPanda(W, H, input_file=input_file)
+    panda.timestep = steps_per_frame
+    panda.startRecording(path)
+    for i in range(n_frames):
+        panda.run_single()
+        if panda.recorder is None:
+            break  # the recording failed
+    panda.stopRecording()
+    if panda.recording_error is not None:
+        raise panda.recording_error
+    panda.destroy()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Render a LAMMPS deck or recorded trajectory to video or images without Qt")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--trajectory", help="recorded .traj file, LAMMPS dump or data file to render")
+    source.add_argument("--input", help="LAMMPS input deck to simulate and render")
+    parser.add_argument("--frames", type=int, default=None, help="number of frames (required with --input)")
+    parser.add_argument("--steps-per-frame", type=int, default=10, help="MD steps between frames with --input")
+    parser.add_argument("--camera", default=None, help="JSON camera path with keyframes")
+    parser.add_argument("--orbit", type=float, default=0.0, help="degrees to orbit per frame if no camera path is given")
+    parser.add_argument("--output", required=True, help="video file (.mp4, .avi) or a directory for a PNG sequence")
+    parser.add_argument("--fps", type=float, default=30)
+    parser.add_argument("--width", type=int, default=1080)
+    parser.add_argument("--height", type=int, default=960)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--bond-style", choices=["lines", "cylinders"], default="lines")
+    parser.add_argument("--atom-style", choices=["spheres", "impostors"], default="spheres")
+    parser.add_argument("--atom-detail", choices=["auto", "high", "standard", "low"], default="auto")
+    add_backend_arguments(parser)
+    args = parser.parse_args()
+    backend = backend_from_args(parser, args)
+    if args.input is not None:
+        backend.apply()
+
+    W, H = args.width, args.height
+    trajectory = args.trajectory
+    if args.input is not None:
+        if args.frames is None:
+            parser.error("--frames is required with --input")
+        trajectory = os.path.join(tempfile.mkdtemp(prefix="asv_"), "batch.traj")
+        print(f"Simulating {args.frames} frames...")
+        simulate_to_trajectory(os.path.abspath(args.input), args.frames, args.steps_per_frame, trajectory, W, H)
+
+    from lammpsfiles import open_trajectory
+    reader = open_trajectory(trajectory)
+    n_frames = reader.n_frames if args.frames is None else min(args.frames, reader.n_frames)
+    reader.close()
+    cameras = load_camera_path(args.camera, n_frames, args.orbit)
+
+    video = os.path.splitext(args.output)[1].lower() in (".mp4", ".avi", ".mkv", ".mov")
+    writer = None
+    if video:
+        fourcc = cv2.VideoWriter_fourcc(*("mp4v" if args.output.lower().endswith(".mp4") else "MJPG"))
+        writer = cv2.VideoWriter(args.output, fourcc, args.fps, (W, H))
+        jobs = [(i, cameras[i], None) for i in range(n_frames)]
+    else:
+        os.makedirs(args.output, exist_ok=True)
+        jobs = [(i, cameras[i], os.path.join(args.output, f"frame_{i:06d}.png")) for i in range(n_frames)]
+
+    # Spawned (not forked) workers so no GL state is shared. imap keeps frame order, so the
+    # video encoder consumes frames while later ones are still rendering.
+    print(f"Rendering {n_frames} frames with {args.workers} workers...")
+    start = time.perf_counter()
+    ctx = multiprocessing.get_context("spawn")
+    with ctx.Pool(args.workers, initializer=init_worker, initargs=(backend, trajectory, W, H, args.bond_style, args.atom_style, args.atom_detail)) as pool:
+        for frame, bgr in pool.imap(render_frame, jobs, chunksize=4):
+            if writer is not None:
+                writer.write(bgr)
+    if writer is not None:
+        writer.release()
+    elapsed = time.perf_counter() - start
+    print(f"Rendered {n_frames} frames in {elapsed:.1f} s ({n_frames / elapsed:.1f} frames/s)")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
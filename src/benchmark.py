@@ -0,0 +1,230 @@
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import resource
+import subprocess
+import tempfile
+import multiprocessing
+import numpy as np
+from panda3d.core import load_prc_file_data
+from backend import RenderBackend, add_backend_arguments, backend_from_args
+
+# No Qt involved, the rendering backend is applied in the process of every size
+load_prc_file_data("", "audio-library-name null")
+
+base_dir = os.path.dirname(os.path.abspath(__file__))
+repo_dir = os.path.dirname(base_dir)
+# The deck is replicated, so every size is a multiple of its 500 atoms
+BASE_DECK = os.path.join(repo_dir, "inputs", "tersoff.in")
+BASE_ATOMS = 500
+STAGES = ["run_single", "calcAtomPairs", "create_bond_geometry", "drawSimulationBoxTask", "render_readback"]
+
+
+def replication(n_atoms):
+    # Split n_atoms / 500 copies into three factors that are as even as possible
+    copies = max(1, round(n_atoms / BASE_ATOMS))
+    factors = [1, 1, 1]
+    n = copies
+    p = 2
+    primes = []
+    while n > 1:
+        while n % p == 0:
+            primes.append(p)
+            n //= p
+        p += 1
+    for p in sorted(primes, reverse=True):
+        factors[factors.index(min(factors))] *= p
+    return sorted(factors)
+
+
+def make_deck(factors, directory):
+    # Copy of the tersoff deck with a replicate command right after the data file is read
+    lines = []
+    with open(BASE_DECK, "r") as f:
+        for line in f:
+            lines.append(line)
+            if line.startswith("read_data"):
+                lines.append("replicate {} {} {}\n".format(*factors))
+    path = os.path.join(directory, "bench_{}x{}x{}.in".format(*factors))
+    with open(path, "w") as f:
+        f.writelines(lines)
+    return path
+
+
+def memory_mb():
+    # Current and peak resident set size of this process
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    current = peak
+    try:
+        with open("/proc/self/statm", "r") as f:
+            current = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 ** 2
+    except (OSError, ValueError):
+        pass
+    return {"rss": round(current, 1), "peak": round(peak, 1)}
+
+
+def timed(times, name, func, *args):
+    start = time.perf_counter()
+    func(*args)
+    times[name].append(time.perf_counter() - start)
+
+
+def bench_size(backend, deck, repeats, warmup, W, H, bond_style, atom_style, steps, threads):
+    # One system size and backend, run in its own process so memory numbers and the
+    # Panda3D instance don't carry over between them
+    backend.apply()
+    from panda import OffscreenPanda
+    from funcs import calcAtomPairs, create_bond_geometry
+
+    os.chdir(repo_dir)  # the deck refers to inputs/ relative to the repository
+    start = time.perf_counter()
+    panda = OffscreenPanda(W, H, input_file=deck, omp_threads=threads)
+    panda.bond_style = bond_style
+    panda.set_atom_style(atom_style)
+    panda.timestep = steps
+    panda.drawSimulationBoxTask()
+    panda.center_camera()
+    setup = time.perf_counter() - start
+    memory_setup = memory_mb()
+
+    times = {name: [] for name in STAGES}
+    for i in range(warmup + repeats):
+        timed(times, "run_single", panda.run_single)
+        panda.atom_layer.update_positions(panda.x)
+        timed(times, "calcAtomPairs", calcAtomPairs, panda)
+        timed(times, "create_bond_geometry", create_bond_geometry, panda)
+        timed(times, "drawSimulationBoxTask", panda.drawSimulationBoxTask)
+        # With a threaded backend this reads a frame from a few frames ago, so the draw
+        # overlaps the next step like it does in the viewer
+        timed(times, "render_readback", panda.render_frame_to_ram)
+        if i < warmup:
+            for values in times.values():
+                values.clear()
+
+    stages = {}
+    for name, values in times.items():
+        ms = 1000 * np.array(values)
+        stages[name] = {"mean_ms": round(float(ms.mean()), 3), "min_ms": round(float(ms.min()), 3),
+                        "max_ms": round(float(ms.max()), 3)}
+    natoms = len(panda.x)
+    mean = {name: np.mean(values) for name, values in times.items()}
+    result = {
+        "atoms": natoms,
+        "backend": backend.name,
+        "pipeline_depth": panda.pipeline_depth,
+        "bonds": len(panda.bond_pairs),
+        "setup_s": round(setup, 3),
+        "stages": stages,
+        "frame_ms": round(1000 * sum(mean.values()), 3),
+        "throughput": {
+            "atom_steps_per_s": round(natoms * steps / mean["run_single"], 1),
+            "atoms_per_s_bonds": round(natoms / mean["calcAtomPairs"], 1),
+            "bonds_per_s_geometry": round(len(panda.bond_pairs) / mean["create_bond_geometry"], 1),
+            "frames_per_s": round(1 / sum(mean.values()), 3),
+            "render_frames_per_s": round(1 / mean["render_readback"], 3),
+            "megapixels_per_s_readback": round(W * H / 1e6 / mean["render_readback"], 2),
+        },
+        "memory_mb": {"after_setup": memory_setup, "end": memory_mb()},
+    }
+    return result
+
+
+def git_commit():
+    # Commit the results belong to, "+dirty" when the working tree has local changes
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=repo_dir, text=True).strip()
+        dirty = subprocess.run(["git", "diff", "--quiet", "HEAD"], cwd=repo_dir).returncode != 0
+        return commit + ("+dirty" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(results, baseline_path):
+    # Print the mean time of every stage relative to an earlier result file
+    with open(baseline_path, "r") as f:
+        baseline = json.load(f)
+    # Results from before backends were recorded ran the default single threaded backend
+    old = {(r["atoms"], r.get("backend", "auto:single:auto")): r for r in baseline["results"]}
+    print(f"\nCompared to {baseline['commit'][:12]} (ratio > 1 is slower)")
+    for r in results:
+        key = (r["atoms"], r["backend"])
+        if key not in old:
+            continue
+        ratios = [f"{name} {r['stages'][name]['mean_ms'] / max(old[key]['stages'][name]['mean_ms'], 1e-6):.2f}"
+                  for name in STAGES]
+        print(f"{r['atoms']:>9} atoms, {r['backend']}: " + ", ".join(ratios))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time every stage of the step -> bonds -> geometry -> readback pipeline without Qt")
+    parser.add_argument("--sizes", default="500,4000,32000,256000,1000000",
+                        help="comma separated atom counts, rounded to multiples of the 500 atom diamond deck")
+    parser.add_argument("--repeats", type=int, default=10, help="timed frames per size")
+    parser.add_argument("--warmup", type=int, default=2, help="untimed frames before measuring")
+    parser.add_argument("--steps", type=int, default=1, help="MD steps per run_single")
+    parser.add_argument("--threads", type=int, default=0, help="OpenMP threads for LAMMPS (0 runs the plain styles)")
+    parser.add_argument("--width", type=int, default=1080)
+    parser.add_argument("--height", type=int, default=960)
+    parser.add_argument("--bond-style", choices=["lines", "cylinders"], default="lines")
+    parser.add_argument("--atom-style", choices=["spheres", "impostors"], default="spheres")
+    parser.add_argument("--output", default=None, help="result JSON file (default benchmark_<commit>.json)")
+    parser.add_argument("--compare", default=None, metavar="JSON", help="earlier result file to compare against")
+    parser.add_argument("--backends", default=None, metavar="SPECS",
+                        help="comma separated rendering backends to compare, each display[:threading[:render threads]], "
+                             "e.g. egl,egl:cull-draw,egl:draw:4 (default: the one given by the options below)")
+    add_backend_arguments(parser)
+    args = parser.parse_args()
+    if args.backends:
+        try:
+            backends = [RenderBackend.parse(spec, not args.hardware_gl) for spec in args.backends.split(",")]
+        except ValueError as e:
+            parser.error(str(e))
+    else:
+        backends = [backend_from_args(parser, args)]
+
+    commit = git_commit()
+    output = args.output or f"benchmark_{commit[:12]}.json"
+    report = {
+        "commit": commit,
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "host": platform.node(),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "config": vars(args),
+        "results": [],
+    }
+
+    deck_dir = tempfile.mkdtemp(prefix="asv_bench_")
+    ctx = multiprocessing.get_context("spawn")
+    for size in [int(s) for s in args.sizes.split(",")]:
+        factors = replication(size)
+        deck = make_deck(factors, deck_dir)
+        print(f"Benchmarking {BASE_ATOMS * int(np.prod(factors))} atoms ({'x'.join(map(str, factors))})...")
+        for backend in backends:
+            with ctx.Pool(1) as pool:
+                result = pool.apply(bench_size, (backend, deck, args.repeats, args.warmup, args.width, args.height,
+                                                 args.bond_style, args.atom_style, args.steps, args.threads))
+            report["results"].append(result)
+            stages = ", ".join(f"{name} {result['stages'][name]['mean_ms']:.1f} ms" for name in STAGES)
+            print(f"  {backend.name}: {stages}, {result['throughput']['frames_per_s']:.2f} frames/s, "
+                  f"peak {result['memory_mb']['end']['peak']:.0f} MB")
+            # Written after every run so a run that dies on the largest system keeps the rest
+            with open(output, "w") as f:
+                json.dump(report, f, indent=2)
+
+    if len(backends) > 1:
+        print("\nFrames/s per backend (whole frame / render + readback only)")
+        for r in report["results"]:
+            print(f"{r['atoms']:>9} atoms, {r['backend']:<22} {r['throughput']['frames_per_s']:8.2f} "
+                  f"{r['throughput']['render_frames_per_s']:8.2f}")
+    print(f"Results written to {output}")
+    if args.compare:
+        compare(report["results"], args.compare)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,140 @@
+import math
+import numpy as np
+from panda3d.core import *
+from instancing import load_shader, make_buffer_texture, buffer_view
+
+
+def array_view(vdata, index, columns):
+    # Writable float32 view of one vertex array. Calling this marks the array as modified.
+    return np.frombuffer(memoryview(vdata.modify_array(index)).cast("B"), dtype=np.float32).reshape(-1, columns)
+
+
+def half_bonds(x, pairs, vectors):
+    # Every bond is split in two halves, one starting at each atom. This colors bonds by
+    # atom and draws bonds across periodic boundaries as two stubs leaving the box.
+    i, j = pairs[:, 0], pairs[:, 1]
+    half = 0.5 * vectors
+    return i, j, x[i], x[i] + half, x[j], x[j] - half
+
+
+class BondLines:
+    """Bonds as line segments in one persistent vertex buffer, rewritten in place each frame."""
+    def __init__(self, parent, thickness=10.0):
+        vertex = GeomVertexArrayFormat("vertex", 3, Geom.NT_float32, Geom.C_point)
+        color = GeomVertexArrayFormat("color", 4, Geom.NT_float32, Geom.C_color)
+        fmt = GeomVertexFormat()
+        fmt.add_array(vertex)
+        fmt.add_array(color)
+        fmt = GeomVertexFormat.register_format(fmt)
+
+        self.vdata = GeomVertexData("bonds", fmt, Geom.UH_dynamic)
+        self.prim = GeomLines(Geom.UH_dynamic)
+        geom = Geom(self.vdata)
+        geom.add_primitive(self.prim)
+        node = GeomNode("bonds")
+        node.add_geom(geom)
+        node.set_bounds(OmniBoundingVolume())
+        node.set_final(True)
+        self.node = parent.attach_new_node(node)
+        self.node.set_render_mode_thickness(thickness)
+        self.capacity = 0
+
+    def reserve(self, bonds):
+        # Grow geometrically so a slowly rising bond count doesn't reallocate every frame
+        if bonds > self.capacity:
+            self.capacity = max(bonds, 2 * self.capacity)
+            self.vdata.set_num_rows(4 * self.capacity)
+
+    def update(self, x, pairs, vectors, colors):
+        n = len(pairs)
+        self.reserve(n)
+        i, j, a0, a1, b0, b1 = half_bonds(x, pairs, vectors)
+        v = array_view(self.vdata, 0, 3)[:4 * n].reshape(n, 4, 3)
+        v[:, 0], v[:, 1], v[:, 2], v[:, 3] = a0, a1, b0, b1
+        c = array_view(self.vdata, 1, 4)[:4 * n].reshape(n, 4, 4)
+        c[:, 0] = c[:, 1] = colors[i]
+        c[:, 2] = c[:, 3] = colors[j]
+        self.prim.clear_vertices()
+        if n:
+            self.prim.set_nonindexed_vertices(0, 4 * n)
+
+    def show(self):
+        self.node.show()
+
+    def hide(self):
+        self.node.hide()
+
+    def remove(self):
+        self.node.removeNode()
+
+
+def make_cylinder(segments=8):
+    # Open unit cylinder along +z with radius 1 and height 1
+    vdata = GeomVertexData("cylinder", GeomVertexFormat.get_v3n3(), Geom.UH_static)
+    vdata.set_num_rows(2 * segments)
+    vertex = GeomVertexWriter(vdata, "vertex")
+    normal = GeomVertexWriter(vdata, "normal")
+    for k in range(segments):
+        a = 2 * math.pi * k / segments
+        for z in (0, 1):
+            vertex.add_data3(math.cos(a), math.sin(a), z)
+            normal.add_data3(math.cos(a), math.sin(a), 0)
+    tris = GeomTriangles(Geom.UH_static)
+    for k in range(segments):
+        a0, a1 = 2 * k, 2 * k + 1
+        b0, b1 = 2 * ((k + 1) % segments), 2 * ((k + 1) % segments) + 1
+        tris.add_vertices(a0, b0, b1)
+        tris.add_vertices(a0, b1, a1)
+    geom = Geom(vdata)
+    geom.add_primitive(tris)
+    node = GeomNode("cylinder")
+    node.add_geom(geom)
+    return node
+
+
+class BondCylinders:
+    """Bonds as hardware-instanced cylinders, one instance per half bond."""
+    def __init__(self, parent, radius=0.08):
+        self.node = parent.attach_new_node(make_cylinder())
+        self.node.set_shader(load_shader("bonds.vert", "lit.frag"))
+        self.node.node().set_bounds(OmniBoundingVolume())
+        self.node.node().set_final(True)
+        self.radius = radius
+        self.capacity = 0
+
+    def reserve(self, bonds):
+        if bonds > self.capacity:
+            self.capacity = max(bonds, 2 * self.capacity)
+            self.starts = make_buffer_texture("bond_starts", 2 * self.capacity)
+            self.ends = make_buffer_texture("bond_ends", 2 * self.capacity)
+            self.colors = make_buffer_texture("bond_colors", 2 * self.capacity)
+            self.node.set_shader_input("bond_starts", self.starts)
+            self.node.set_shader_input("bond_ends", self.ends)
+            self.node.set_shader_input("bond_colors", self.colors)
+
+    def update(self, x, pairs, vectors, colors):
+        n = len(pairs)
+        self.reserve(max(n, 1))
+        i, j, a0, a1, b0, b1 = half_bonds(x, pairs, vectors)
+        starts = buffer_view(self.starts)
+        starts[0:n, :3], starts[n:2 * n, :3] = a0, b0
+        starts[:2 * n, 3] = self.radius
+        ends = buffer_view(self.ends)
+        ends[0:n, :3], ends[n:2 * n, :3] = a1, b1
+        c = buffer_view(self.colors)
+        c[0:n], c[n:2 * n] = colors[i], colors[j]
+        if n == 0:
+            # An instance count of zero would disable instancing, so draw one zero-radius cylinder
+            starts[0] = ends[0] = 0
+            self.node.set_instance_count(1)
+        else:
+            self.node.set_instance_count(2 * n)
+
+    def show(self):
+        self.node.show()
+
+    def hide(self):
+        self.node.hide()
+
+    def remove(self):
+        self.node.removeNode()
@@ -0,0 +1,186 @@
+import re
+import numpy as np
+from lammps import LMP_STYLE_ATOM, LMP_TYPE_VECTOR, LMP_TYPE_ARRAY, LMP_SIZE_COLS, LMP_VAR_ATOM
+
+# Anchor colors of the colormaps, interpolated into a lookup table
+COLORMAPS = {
+    "viridis": [(0.267, 0.005, 0.329), (0.229, 0.322, 0.546), (0.128, 0.567, 0.551),
+                (0.369, 0.789, 0.383), (0.993, 0.906, 0.144)],
+    "plasma": [(0.050, 0.030, 0.528), (0.494, 0.012, 0.658), (0.798, 0.280, 0.470),
+               (0.973, 0.585, 0.254), (0.940, 0.975, 0.131)],
+    "coolwarm": [(0.230, 0.299, 0.754), (0.552, 0.690, 0.996), (0.866, 0.866, 0.866),
+                 (0.958, 0.604, 0.482), (0.706, 0.016, 0.150)],
+    "jet": [(0.0, 0.0, 0.5), (0.0, 0.0, 1.0), (0.0, 1.0, 1.0), (1.0, 1.0, 0.0), (1.0, 0.0, 0.0), (0.5, 0.0, 0.0)],
+    "gray": [(0.1, 0.1, 0.1), (0.95, 0.95, 0.95)],
+}
+LUT_SIZE = 256
+# Atoms without a value (NaN) are drawn in this color
+MISSING = (0.5, 0.5, 0.5, 1.0)
+
+# Named quantities: (label, value spec, compute ID, command creating the compute). The
+# compute is only created if the deck doesn't already define one with that ID.
+PRESETS = {
+    "type": ("Type", None, None, None),
+    "displacement": ("Displacement", "c_displace[4]", "displace", "compute displace all displace/atom"),
+    "ke": ("Kinetic energy", "c_asv_ke", "asv_ke", "compute asv_ke all ke/atom"),
+    "coordination": ("Coordination", "c_asv_coord", "asv_coord", "compute asv_coord all coord/atom cutoff {cutoff}"),
+    "centro": ("Centro-symmetry", "c_asv_centro", "asv_centro", "compute asv_centro all centro/atom {neighbors}"),
+    "speed": ("Speed", "|v|", None, None),
+}
+SPEC = re.compile(r"^(c|f|v)_([\w-]+)(?:\[(\d+)\])?$")
+# Components of per-atom vectors by their dump names
+COMPONENTS = {f"{prefix}{axis}": (vector, i) for vector, prefix in (("x", ""), ("v", "v"), ("f", "f"))
+              for i, axis in enumerate("xyz")}
+
+
+def make_lut(name):
+    # (LUT_SIZE, 4) float32 RGBA table of a colormap
+    anchors = np.array(COLORMAPS[name], dtype=np.float32)
+    t = np.linspace(0, 1, LUT_SIZE)
+    stops = np.linspace(0, 1, len(anchors))
+    lut = np.ones((LUT_SIZE, 4), dtype=np.float32)
+    for c in range(3):
+        lut[:, c] = np.interp(t, stops, anchors[:, c])
+    return lut
+
+
+def parse_spec(spec):
+    # (kind, name, column, norm) of a value spec, see AtomColoring
+    norm = spec.startswith("|") and spec.endswith("|")
+    if norm:
+        spec = spec[1:-1]
+    if spec in COMPONENTS:
+        return ("atom",) + COMPONENTS[spec] + (norm,)
+    match = SPEC.match(spec)
+    if match is None:
+        return "atom", spec, None, norm
+    kind, name, column = match.groups()
+    return {"c": "compute", "f": "fix", "v": "variable"}[kind], name, None if column is None else int(column) - 1, norm
+
+
+class AtomColoring:
+    """Colors atoms by any per-atom compute, fix, atom-style variable or atom property.
+
+    A spec names the value the way LAMMPS does: "c_ID" or "c_ID[k]" for a per-atom compute
+    (k counts from 1), "f_ID[k]" for a fix, "v_name" for an atom-style variable, or an atom
+    property such as "q" or a vector component like "vx". "|name|" takes the norm of a vector property like v.
+    gather() reads the values in atom ID order, colorize() maps them through the colormap
+    with one table lookup. Neither runs any Python per atom.
+    """
+    def __init__(self, natoms, colormap="viridis"):
+        self.natoms = natoms
+        self.spec = None
+        self.values = np.full(natoms, np.nan)
+        self.index = np.zeros(natoms, dtype=np.intp)
+        self.colors = np.ones((natoms, 4), dtype=np.float32)
+        self.set_colormap(colormap)
+        # Fixed range, None for auto range
+        self.vmin = None
+        self.vmax = None
+        # Auto range follows the 1st to 99th percentile, smoothed so colors don't flicker
+        self.percentiles = (1, 99)
+        self.smoothing = 0.2
+        self.range_samples = 20000
+        self.range = None
+        # False until colorize() ran for the current source
+        self.ready = False
+
+    @property
+    def active(self):
+        return self.spec is not None
+
+    def set_colormap(self, name):
+        self.colormap = name
+        # One extra row at the end for atoms without a value
+        self.lut = np.vstack((make_lut(name), np.array([MISSING], dtype=np.float32)))
+
+    def set_source(self, spec, vmin=None, vmax=None):
+        self.spec = spec
+        self.vmin, self.vmax = vmin, vmax
+        self.range = None
+        self.ready = False
+        self.values[:] = np.nan
+
+    def check(self, lmp, spec):
+        # Raise ValueError if spec references a compute, fix or variable LAMMPS doesn't have
+        kind, name, column, norm = parse_spec(spec)
+        if kind != "atom" and not lmp.has_id(kind, name):
+            raise ValueError(f"No {kind} {name} in LAMMPS")
+
+    def gather(self, lmp, local_order=None, out=None):
+        # Read the current values into out (self.values by default) in atom ID order.
+        # local_order maps LAMMPS' local atoms to their rows, as set by gatherAtoms. Without
+        # it lmp is a parallel.ParallelLammps and the values are gathered from every rank.
+        out = self.values if out is None else out
+        kind, name, column, norm = parse_spec(self.spec)
+        if local_order is None:
+            data = self.gather_global(lmp, kind, name, column)
+        else:
+            nlocal = len(local_order)
+            if kind == "compute":
+                dtype = LMP_TYPE_VECTOR if column is None else LMP_TYPE_ARRAY
+                data = lmp.numpy.extract_compute(name, LMP_STYLE_ATOM, dtype)
+            elif kind == "fix":
+                dtype = LMP_TYPE_VECTOR if column is None else LMP_TYPE_ARRAY
+                data = lmp.numpy.extract_fix(name, LMP_STYLE_ATOM, dtype)
+            elif kind == "variable":
+                data = lmp.numpy.extract_variable(name, "all", LMP_VAR_ATOM)
+            else:
+                data = lmp.numpy.extract_atom(name)
+            if data is None:
+                raise ValueError(f"No per-atom {kind} {name} in LAMMPS")
+            data = data[:nlocal]
+            if column is not None:
+                data = data[:, column]
+            if norm:
+                out[local_order] = np.sqrt(np.einsum("ij,ij->i", data, data))
+                return out
+            out[local_order] = data
+            return out
+        if column is not None:
+            data = data[:, column]
+        out[:] = np.sqrt(np.einsum("ij,ij->i", data, data)) if norm else data
+        return out
+
+    def gather_global(self, lmp, kind, name, column):
+        # ID ordered values from all MPI ranks
+        if kind == "compute":
+            count = 1 if column is None else lmp.extract_compute(name, LMP_STYLE_ATOM, LMP_SIZE_COLS)
+            return lmp.gather(f"c_{name}", count)
+        if kind == "fix":
+            count = 1 if column is None else lmp.extract_fix(name, LMP_STYLE_ATOM, LMP_SIZE_COLS)
+            return lmp.gather(f"f_{name}", count)
+        if kind == "variable":
+            return lmp.gather(f"v_{name}", 1)
+        return lmp.gather(name, 3 if name in ("x", "v", "f") else 1)
+
+    def colorize(self, values=None):
+        # Map values to RGBA. The range is auto-ranged unless vmin/vmax are set.
+        values = self.values if values is None else values
+        finite = np.isfinite(values)
+        lo, hi = self.vmin, self.vmax
+        if lo is None or hi is None:
+            if finite.any():
+                # A strided sample is plenty for the range of a large system
+                sample = values[finite]
+                sample = sample[::max(1, len(sample) // self.range_samples)]
+                p_lo, p_hi = np.percentile(sample, self.percentiles)
+                if self.range is None:
+                    self.range = [p_lo, p_hi]
+                else:
+                    self.range[0] += self.smoothing * (p_lo - self.range[0])
+                    self.range[1] += self.smoothing * (p_hi - self.range[1])
+            auto = self.range or [0.0, 1.0]
+            lo = auto[0] if lo is None else lo
+            hi = auto[1] if hi is None else hi
+        scale = (LUT_SIZE - 1) / (hi - lo) if hi > lo else 0.0
+        # index = clip((v - lo) * scale), NaN goes to the MISSING row
+        np.subtract(values, lo, out=self.colors[:, 0], casting="unsafe")
+        t = self.colors[:, 0]
+        t *= scale
+        np.clip(t, 0, LUT_SIZE - 1, out=t)
+        t[~finite] = LUT_SIZE
+        self.index[:] = t
+        np.take(self.lut, self.index, axis=0, out=self.colors)
+        self.ready = True
+        return self.colors
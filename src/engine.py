@@ -0,0 +1,105 @@
+import threading
+import queue
+import time
+import numpy as np
+
+
+class Snapshot:
+    """One complete simulation state as published by the engine thread."""
+    def __init__(self, natoms):
+        self.x = np.zeros((natoms, 3))
+        self.ix = np.zeros((natoms, 3), dtype=np.int32)
+        self.xu = np.zeros((natoms, 3))
+        # Values of the coloring source, only gathered while coloring is active
+        self.values = np.zeros(natoms)
+        self.colored = False
+        self.cell = np.zeros((3, 3))
+        self.boxlo = np.zeros(3)
+        self.step = 0
+
+
+class SnapshotBuffer:
+    """Triple buffer: the engine always has a free slot to write into and the reader always
+    gets the most recent complete snapshot, so neither side ever waits for the other."""
+    def __init__(self, natoms):
+        self.slots = [Snapshot(natoms) for _ in range(3)]
+        self.back, self.ready, self.front = 0, 1, 2
+        self.fresh = False
+        self.lock = threading.Lock()
+
+    def back_buffer(self):
+        return self.slots[self.back]
+
+    def publish(self):
+        # Swap the finished back slot with the ready slot
+        with self.lock:
+            self.back, self.ready = self.ready, self.back
+            self.fresh = True
+
+    def latest(self):
+        # Returns None if nothing new was published since the last call. The returned
+        # snapshot stays untouched by the engine until latest() is called again.
+        with self.lock:
+            if not self.fresh:
+                return None
+            self.front, self.ready = self.ready, self.front
+            self.fresh = False
+            return self.slots[self.front]
+
+
+class SimulationEngine(threading.Thread):
+    """Advances LAMMPS in its own thread and publishes snapshots for the render side.
+
+    Once started, this thread is the only one allowed to touch panda.lmp. Commands from
+    the UI (thermostat, barostat, ...) are queued through command() and applied between runs.
+    If a command or run fails the thread stops and leaves the exception in error.
+    """
+    def __init__(self, panda):
+        super().__init__(daemon=True)
+        self.panda = panda
+        self.buffer = SnapshotBuffer(len(panda.atom_ids))
+        self.commands = queue.Queue()
+        self.thermo = queue.Queue()
+        self.steps_per_second = 0
+        self.error = None
+        self._stop_event = threading.Event()
+
+    def command(self, cmd):
+        self.commands.put(cmd)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+    def run(self):
+        try:
+            self.loop()
+        except Exception as e:
+            self.error = e
+
+    def loop(self):
+        panda = self.panda
+        while not self._stop_event.is_set():
+            while not self.commands.empty():
+                panda.lmp.command(self.commands.get())
+                panda.scheduler.invalidate()
+            if panda.paused:
+                time.sleep(0.01)
+                continue
+
+            start = time.perf_counter()
+            steps = panda.scheduler.run(panda.lmp, panda.timestep)
+            thermo_rows = panda.thermo_capture.read().copy()
+            self.thermo.put(thermo_rows)
+
+            snap = self.buffer.back_buffer()
+            snap.cell[:], snap.boxlo[:], periodicity = panda.readBox()
+            panda.gatherAtoms(snap.x, snap.ix, snap.xu if panda.track_unwrapped else None)
+            snap.colored = panda.coloring.active
+            if snap.colored:
+                panda.gatherValues(snap.values)
+            panda.recordFrame(snap.x, snap.ix, snap.cell, snap.boxlo, thermo_rows)
+            snap.step = panda.lmp.get_thermo("step")
+            self.buffer.publish()
+            self.steps_per_second = steps / (time.perf_counter() - start)
+
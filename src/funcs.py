@@ -4,9 +4,8 @@ from direct.gui.DirectGui import *
 from panda3d.core import *
 from lammps import lammps, LMP_TYPE_VECTOR, LMP_STYLE_ATOM, LMP_TYPE_ARRAY
 import numpy as np
-from ase import Atoms
-from ase.neighborlist import NeighborList
-from scipy.spatial import cKDTree
+from neighbors import BondNeighborList
+from bonds import BondLines, BondCylinders
 
 
 def startStopSimulation(panda):
@@ -19,29 +18,50 @@ def startStopSimulation(panda):
 
 def changeSpeed(panda, label, v):
     panda.timestep = v
-    label.setText(f"Simulation Speed: {panda.timestep:.2f}")
+    if label is not None:
+        label.setText(f"Simulation Speed: {speedText(panda)}")
+
+def speedText(panda):
+    # What the speed setting means in the current scheduler mode
+    if panda.playback is not None:
+        return f"{panda.timestep} recorded frames/frame"
+    return panda.scheduler.describe(panda.timestep, panda.lmp)
+
+# IDs of the fixes the thermostat and barostat sliders control
+THERMOSTAT_FIX = "2"
+BAROSTAT_FIX = "3"
+
+# The targets are held (start = stop). Runs are parts of long windows, so a ramp would
+# stretch over the whole window and start over with the next one.
+def thermostatCommand(panda):
+    return f"fix {THERMOSTAT_FIX} all langevin {panda.tStop} {panda.tStop} 0.1 102938"
+
+def barostatCommand(panda):
+    return f"fix {BAROSTAT_FIX} all nph couple xyz iso {panda.pStop} {panda.pStop} 1"
 
 def changeThermo(panda, label, v):
     # Change thermal endpoint and update fix
     panda.tStop = 2**(v/1000)
-    panda.lmp.command(f"fix 2 all langevin {panda.tStart} {panda.tStop} 0.1 102938")
-    label.setText(f"Thermostat: {panda.tStop:.3f}")
-    # Update tStart to be the thermal endpoint of last simulation. This approach
-    # might lead to some funkiness if tStop was not reached in previous simulation
-    panda.tStart = panda.tStop
+    panda.lammpsCommand(thermostatCommand(panda))
+    if label is not None:
+        label.setText(f"Thermostat: {panda.tStop:.3f}")
 
 def changeBaro(panda, label, v):
     panda.pStop = v/100000
-    panda.lmp.command(f"fix 3 all nph couple xyz iso {panda.pStart} {panda.pStop} 1")
-    label.setText(f"Barostat: {panda.pStop:.3f}")
-    panda.pStart = panda.pStop
+    panda.lammpsCommand(barostatCommand(panda))
+    if label is not None:
+        label.setText(f"Barostat: {panda.pStop:.3f}")
 
 def extractThermo(panda):
-    # Store thermo data from last simulation
-    last_thermo = panda.lmp.last_thermo()
-    last_thermo = {k.upper():v for k,v in last_thermo.items()}
-    for key in last_thermo:
-        panda.sim_info[key].append(last_thermo[key])
+    # Store thermo data of every step of the last simulation
+    rows = panda.thermo_capture.read()
+    storeThermo(panda, panda.thermo_capture.keys, rows)
+    return rows
+
+def storeThermo(panda, keys, rows):
+    # rows holds one column per key and one row per MD step
+    for col, key in enumerate(keys):
+        panda.sim_info[key].extend(rows[:, col])
 
 def toggleGraphView(main_window, graph_name, state):
     if state == 2:
@@ -50,43 +70,26 @@ def toggleGraphView(main_window, graph_name, state):
         main_window.graphs[graph_name].setVisible(True)
 
 def calcAtomPairs(panda):
-    panda.bond_pairs = []
-
-    atoms = Atoms(symbols=panda.atom_symbols, positions=panda.x)
-
+    # Bonds are found through a persistent, periodic neighbor list that only rebuilds its
+    # candidate pairs once atoms have moved far enough
     if not panda.cutoff_cached:
-        panda.cutoffs = np.array([panda.atom_bond_cutoffs[symbol] for symbol in panda.atom_symbols])
+        panda.cutoffs = panda.bondCutoffs()
         panda.max_cutoff = np.max(panda.cutoffs)
+        panda.bond_neighbors = BondNeighborList(panda.cutoffs)
         panda.cutoff_cached = True
 
-    positions = atoms.get_positions()
-    tree = cKDTree(positions)
-    pairs = tree.query_pairs(r=panda.max_cutoff)
-
-    for i, j in pairs:
-        cutoff_ij = min(panda.cutoffs[i], panda.cutoffs[j])
-        dist = np.linalg.norm(positions[i] - positions[j])
-        if dist <= cutoff_ij:
-            # Store atom indices and positions
-            panda.bond_pairs.append((i, j, positions[i], positions[j]))
+    panda.bond_pairs, panda.bond_vectors = panda.bond_neighbors.update(panda.x, panda.cell, panda.boxlo,
+                                                                       panda.periodicity)
 
 
 def create_bond_geometry(panda, thickness=10.0):
-    if panda.bond_node != 0:
-        panda.bond_node.removeNode()
-
-    lines = LineSegs()
-    lines.setThickness(thickness)
-
-    for i, j, p1, p2 in panda.bond_pairs:
-        atom_type = panda.atom_symbols[i]  # symbol or type ID
-        atom_info = panda.atom_types.get(atom_type, {})
-        color = atom_info.get("color", [1, 1, 1, 1])  # default: white
-
-        lines.setColor(*color)
-        lines.moveTo(*p1)
-        lines.drawTo(*p2)
-
-    panda.bond_node = NodePath(lines.create())
-    panda.bond_node.reparentTo(panda.render)
-
+    # The bond geometry is created once and its buffers are rewritten in place every frame
+    if panda.bond_node == 0:
+        if panda.bond_style == "cylinders":
+            panda.bond_node = BondCylinders(panda.render)
+        else:
+            panda.bond_node = BondLines(panda.render, thickness)
+        if not panda.show_bonds:
+            panda.bond_node.hide()
+
+    panda.bond_node.update(panda.x, panda.bond_pairs, panda.bond_vectors, panda.atom_colors)
@@ -0,0 +1,173 @@
+import json
+import struct
+import zlib
+import numpy as np
+
+# Message layout (little endian), one message per frame
+#   header  : MAGIC, version, flags, bits, frame number, natoms, nbonds, payload length
+#   payload : zlib(cell (9 float64), boxlo (3 float64),
+#                  [KEYFRAME: meta json length (int32), meta json, types (uint16)],
+#                  positions: 2 byte planes of 3 * natoms uint16,
+#                  [BONDS: 2 * nbonds int32])
+# Positions are fractional coordinates in the cell, quantized to bits bits. A keyframe holds
+# them as they are, every other frame the zigzag encoded difference to the previous message.
+# Each array is split into a plane of low bytes and one of high bytes, most high bytes of a
+# small delta are zero, which zlib compresses to almost nothing.
+# Bonds are sorted (i, j) pairs stored as the increase of i and as j - i, and are only sent
+# in keyframes and when they changed.
+MAGIC = b"ASVG"
+VERSION = 1
+KEYFRAME = 1
+BONDS = 2
+MESSAGE = struct.Struct("<4sBBHqiii")
+
+
+def fractional(x, cell, boxlo, periodicity):
+    # Positions in cell coordinates, wrapped into [0, 1) along periodic directions
+    f = (x - boxlo) @ np.linalg.inv(cell)
+    f[:, periodicity] %= 1.0
+    return f
+
+
+def byte_planes(values):
+    # uint16 array -> its low bytes followed by its high bytes
+    return np.ascontiguousarray(values.reshape(-1).view(np.uint8).reshape(-1, 2).T).tobytes()
+
+
+def from_byte_planes(data, count):
+    planes = np.frombuffer(data, dtype=np.uint8, count=2 * count).reshape(2, count)
+    return np.ascontiguousarray(planes.T).view(np.uint16).reshape(-1)
+
+
+class GeometryFrame:
+    """Decoded frame: positions in box units plus what a renderer needs to draw them."""
+    def __init__(self, frame, x, types, cell, boxlo, bonds, meta):
+        self.frame = frame
+        self.x = x
+        self.types = types
+        self.cell = cell
+        self.boxlo = boxlo
+        self.bonds = bonds
+        self.meta = meta
+
+
+class GeometryEncoder:
+    """Encodes atom positions, bonds and the cell into compact binary messages.
+
+    Every message after a keyframe depends on the one before it, so messages have to be
+    decoded in order, starting from a keyframe. A keyframe is encoded for the first message,
+    when asked for and every keyframe_every messages unless that is 0. bits sets the
+    position resolution to 1 / 2**bits of the box, 16 bits is 0.0015 Angstrom in a
+    100 Angstrom box.
+    """
+    def __init__(self, types, periodicity, meta=None, keyframe_every=30, bits=16, level=1):
+        self.types = np.asarray(types, dtype=np.uint16)
+        self.natoms = len(self.types)
+        self.periodicity = np.asarray(periodicity, dtype=bool)
+        self.meta = dict(meta or {})
+        self.meta["periodicity"] = [bool(p) for p in self.periodicity]
+        self.keyframe_every = keyframe_every
+        self.bits = bits
+        self.level = level
+        self.frame = 0
+        self.previous = None
+        self.bonds = None
+
+    def encode(self, x, cell, boxlo, bonds=None, keyframe=False):
+        keyframe = (keyframe or self.previous is None or
+                    bool(self.keyframe_every) and self.frame % self.keyframe_every == 0)
+        scale = (1 << self.bits) - 1
+        f = fractional(x, cell, boxlo, self.periodicity)
+        q = np.rint(np.clip(f, 0.0, 1.0) * scale).astype(np.uint16)
+
+        flags = 0
+        parts = [np.asarray(cell, dtype=np.float64).tobytes(), np.asarray(boxlo, dtype=np.float64).tobytes()]
+        if keyframe:
+            flags |= KEYFRAME
+            meta = json.dumps(self.meta).encode()
+            parts += [struct.pack("<i", len(meta)), meta, self.types.tobytes(), byte_planes(q)]
+        else:
+            # uint16 wraps around, so the difference stays exact for any movement
+            delta = (q - self.previous).view(np.int16)
+            zigzag = ((delta << 1) ^ (delta >> 15)).view(np.uint16)
+            parts.append(byte_planes(zigzag))
+        self.previous = q
+
+        nbonds = 0
+        if bonds is not None:
+            bonds = np.asarray(bonds, dtype=np.int32).reshape(-1, 2)
+            if keyframe or self.bonds is None or not np.array_equal(bonds, self.bonds):
+                self.bonds = bonds
+                flags |= BONDS
+                nbonds = len(bonds)
+                pairs = np.sort(bonds, axis=1)
+                pairs = pairs[np.lexsort((pairs[:, 1], pairs[:, 0]))]
+                steps = np.diff(pairs[:, 0], prepend=0).astype(np.int32)
+                parts += [steps.tobytes(), (pairs[:, 1] - pairs[:, 0]).astype(np.int32).tobytes()]
+
+        payload = zlib.compress(b"".join(parts), self.level)
+        header = MESSAGE.pack(MAGIC, VERSION, flags, self.bits, self.frame, self.natoms, nbonds, len(payload))
+        self.frame += 1
+        return header + payload
+
+
+class GeometryDecoder:
+    """Rebuilds frames from a stream of GeometryEncoder messages.
+
+    Messages before the first keyframe are skipped.
+    """
+    def __init__(self):
+        self.previous = None
+        self.types = None
+        self.meta = {}
+        self.bonds = np.empty((0, 2), dtype=np.int32)
+        self.buffer = b""
+
+    def feed(self, data):
+        # Split arbitrary chunks of a byte stream into messages and decode the complete ones
+        self.buffer += data
+        frames = []
+        while len(self.buffer) >= MESSAGE.size:
+            length = MESSAGE.unpack_from(self.buffer)[-1]
+            if len(self.buffer) < MESSAGE.size + length:
+                break
+            frame = self.decode(self.buffer[:MESSAGE.size + length])
+            self.buffer = self.buffer[MESSAGE.size + length:]
+            if frame is not None:
+                frames.append(frame)
+        return frames
+
+    def decode(self, message):
+        magic, version, flags, bits, frame, natoms, nbonds, length = MESSAGE.unpack_from(message)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("not an ASV geometry message")
+        if not flags & KEYFRAME and self.previous is None:
+            return None
+        raw = zlib.decompress(message[MESSAGE.size:MESSAGE.size + length])
+        cell = np.frombuffer(raw, dtype=np.float64, count=9).reshape(3, 3).copy()
+        boxlo = np.frombuffer(raw, dtype=np.float64, count=3, offset=72).copy()
+        pos = 96
+        count = 3 * natoms
+        if flags & KEYFRAME:
+            meta_len = struct.unpack_from("<i", raw, pos)[0]
+            self.meta = json.loads(raw[pos + 4:pos + 4 + meta_len].decode())
+            pos += 4 + meta_len
+            self.types = np.frombuffer(raw, dtype=np.uint16, count=natoms, offset=pos).copy()
+            pos += 2 * natoms
+            q = from_byte_planes(raw[pos:], count)
+        else:
+            zigzag = from_byte_planes(raw[pos:], count)
+            delta = ((zigzag >> 1) ^ (-(zigzag & 1)).astype(np.uint16))
+            q = self.previous + delta
+        pos += 2 * count
+        self.previous = q
+
+        if flags & BONDS:
+            steps = np.frombuffer(raw, dtype=np.int32, count=nbonds, offset=pos)
+            offsets = np.frombuffer(raw, dtype=np.int32, count=nbonds, offset=pos + 4 * nbonds)
+            i = np.cumsum(steps, dtype=np.int32)
+            self.bonds = np.stack((i, i + offsets), axis=1)
+
+        f = q.reshape(natoms, 3) / float((1 << bits) - 1)
+        x = f @ cell + boxlo
+        return GeometryFrame(frame, x, self.types, cell, boxlo, self.bonds, self.meta)
@@ -0,0 +1,229 @@
+import os
+import math
+import numpy as np
+from panda3d.core import *
+
+base_dir = os.path.dirname(os.path.abspath(__file__))
+shader_dir = os.path.join(base_dir, "shaders")
+models_dir = os.path.join(os.path.dirname(base_dir), "models")
+
+# Meshes loaded once per process and shared by every atom layer
+model_cache = {}
+
+
+def load_shader(vertex, fragment):
+    # Load a GLSL shader pair from the src/shaders directory
+    return Shader.load(Shader.SL_GLSL,
+                       vertex=Filename.from_os_specific(os.path.join(shader_dir, vertex)),
+                       fragment=Filename.from_os_specific(os.path.join(shader_dir, fragment)))
+
+
+def make_buffer_texture(name, rows, format=Texture.F_rgba32):
+    # Float buffer texture that holds one texel per instance
+    tex = Texture(name)
+    tex.setup_buffer_texture(max(rows, 1), Texture.T_float, format, GeomEnums.UH_dynamic)
+    return tex
+
+
+def buffer_view(tex, channels=4):
+    # Writable (rows, channels) float32 view of the texture's RAM image. Calling this marks
+    # the texture as modified, so Panda re-uploads it on the next frame.
+    return np.frombuffer(memoryview(tex.modify_ram_image()), dtype=np.float32).reshape(-1, channels)
+
+
+def load_model(loader, name):
+    # Load a mesh from the models directory. The path is absolute, so loading doesn't
+    # depend on the working directory the program was started from.
+    if name not in model_cache:
+        path = Filename.from_os_specific(os.path.join(models_dir, name))
+        model = loader.loadModel(path)
+        # Bake the egg's own transform into the vertices so the shader sees model space directly
+        model.flatten_strong()
+        model.clear_color()
+        model_cache[name] = model
+    return model_cache[name]
+
+
+def make_low_poly_sphere(radius):
+    # Icosahedron (20 triangles) for atoms that only cover a few pixels
+    t = (1 + 5 ** 0.5) / 2
+    points = np.array([[-1, t, 0], [1, t, 0], [-1, -t, 0], [1, -t, 0],
+                       [0, -1, t], [0, 1, t], [0, -1, -t], [0, 1, -t],
+                       [t, 0, -1], [t, 0, 1], [-t, 0, -1], [-t, 0, 1]], dtype=float)
+    normals = points / np.linalg.norm(points, axis=1)[:, None]
+    faces = [(0, 11, 5), (0, 5, 1), (0, 1, 7), (0, 7, 10), (0, 10, 11),
+             (1, 5, 9), (5, 11, 4), (11, 10, 2), (10, 7, 6), (7, 1, 8),
+             (3, 9, 4), (3, 4, 2), (3, 2, 6), (3, 6, 8), (3, 8, 9),
+             (4, 9, 5), (2, 4, 11), (6, 2, 10), (8, 6, 7), (9, 8, 1)]
+    vdata = GeomVertexData("low_poly_sphere", GeomVertexFormat.get_v3n3(), Geom.UH_static)
+    vdata.set_num_rows(len(points))
+    vertex = GeomVertexWriter(vdata, "vertex")
+    normal = GeomVertexWriter(vdata, "normal")
+    for p, n in zip(normals * radius, normals):
+        vertex.add_data3(*p)
+        normal.add_data3(*n)
+    tris = GeomTriangles(Geom.UH_static)
+    for a, b, c in faces:
+        tris.add_vertices(a, c, b)
+    geom = Geom(vdata)
+    geom.add_primitive(tris)
+    node = GeomNode("low_poly_sphere")
+    node.add_geom(geom)
+    return NodePath(node)
+
+
+def make_impostor_quad():
+    # Unit quad, the impostor vertex shader turns it towards the camera and sizes it per atom
+    vdata = GeomVertexData("impostor", GeomVertexFormat.get_v3(), Geom.UH_static)
+    vdata.set_num_rows(4)
+    vertex = GeomVertexWriter(vdata, "vertex")
+    for x, y in ((-1, -1), (1, -1), (1, 1), (-1, 1)):
+        vertex.add_data3(x, y, 0)
+    tris = GeomTriangles(Geom.UH_static)
+    tris.add_vertices(0, 1, 2)
+    tris.add_vertices(0, 2, 3)
+    geom = Geom(vdata)
+    geom.add_primitive(tris)
+    node = GeomNode("impostor")
+    node.add_geom(geom)
+    return NodePath(node)
+
+
+def load_atom_meshes(loader):
+    # High poly, standard and low poly sphere, from most to least detailed. All three have
+    # the same radius so switching between them doesn't change the atom size.
+    if "low_poly" not in model_cache:
+        standard = load_model(loader, "Sphere.egg")
+        low, high = standard.get_tight_bounds()
+        model_cache["low_poly"] = make_low_poly_sphere(max(high - low) / 2)
+    return [load_model(loader, "Sphere_HighPoly.egg"), load_model(loader, "Sphere.egg"),
+            model_cache["low_poly"]]
+
+
+class InstancedAtoms:
+    """All atoms drawn from shared sphere meshes using hardware instancing.
+
+    Every level of detail is one instanced node. A per-frame pass sorts the atoms into
+    levels by their size on screen and writes the atom indices, grouped by level, into
+    the atom_order buffer. Each level draws its slice of that buffer.
+    """
+    # Levels in meshes
+    HIGH, STANDARD, LOW = 0, 1, 2
+    # Radius on screen in pixels above which the high poly and standard meshes are used
+    lod_pixels = (24.0, 4.0)
+    # Above this many atoms the pixel thresholds grow with the atom count, so large
+    # systems fall back to cheaper meshes sooner
+    lod_budget = 50000
+
+    def __init__(self, parent, meshes, count, shader=("atoms.vert", "lit.frag")):
+        self.node = parent.attach_new_node("atoms")
+        self.node.set_shader(load_shader(*shader))
+        self.levels = []
+        for mesh in meshes:
+            level = mesh.copy_to(self.node)
+            # Instances are spread over the whole box, so the mesh bounds are meaningless for culling
+            level.node().set_bounds(OmniBoundingVolume())
+            level.node().set_final(True)
+            self.levels.append(level)
+        low, high = meshes[self.STANDARD].get_tight_bounds()
+        self.mesh_radius = max(high - low) / 2
+        # "auto" picks levels per atom, "high", "standard" or "low" forces one mesh
+        self.detail = "auto"
+        self.radii = np.zeros(0)
+        self.atom_level = None
+        self.capacity = 0
+        self.count = 0
+        self.resize(count)
+
+    def resize(self, count):
+        # Reallocate the per-instance buffers only when the atom count outgrows them
+        if count > self.capacity:
+            self.capacity = count
+            self.positions = make_buffer_texture("atom_positions", count)
+            self.scales = make_buffer_texture("atom_scales", count)
+            self.colors = make_buffer_texture("atom_colors", count)
+            self.order = make_buffer_texture("atom_order", count, Texture.F_r32)
+            self.node.set_shader_input("atom_positions", self.positions)
+            self.node.set_shader_input("atom_scales", self.scales)
+            self.node.set_shader_input("atom_colors", self.colors)
+            self.node.set_shader_input("atom_order", self.order)
+        self.count = count
+        self.radii = np.resize(self.radii, count)
+        self.set_levels(np.full(count, self.STANDARD, dtype=np.int8))
+
+    def set_levels(self, atom_level):
+        # Group the atom indices by level and give every level node its slice
+        if self.atom_level is not None and np.array_equal(atom_level, self.atom_level):
+            return
+        self.atom_level = atom_level
+        groups = [np.flatnonzero(atom_level == i) for i in range(len(self.levels))]
+        buffer_view(self.order, 1)[:self.count, 0] = np.concatenate(groups)
+        offset = 0
+        for level, group in zip(self.levels, groups):
+            level.set_shader_input("lod_offset", float(offset))
+            if len(group) > 0:
+                level.set_instance_count(len(group))
+                level.show()
+            else:
+                level.hide()
+            offset += len(group)
+
+    def update_lod(self, x, camera, fov, height):
+        # Pick a level per atom from its projected radius. fov is the vertical field of
+        # view in degrees and height the image height in pixels.
+        if self.detail != "auto":
+            forced = {"high": self.HIGH, "standard": self.STANDARD, "low": self.LOW}[self.detail]
+            self.set_levels(np.full(self.count, forced, dtype=np.int8))
+            return
+        pos = camera.get_pos(self.node)
+        forward = self.node.get_relative_vector(camera, Vec3(0, 1, 0))
+        depth = (x[:self.count] - np.array(pos)) @ np.array(forward)
+        focal = height / (2 * math.tan(math.radians(fov) / 2))
+        pixels = self.radii * focal / np.maximum(depth, 1e-3)
+        pixels[depth <= 0] = 0
+        factor = max(1.0, self.count / self.lod_budget)
+        atom_level = np.full(self.count, self.LOW, dtype=np.int8)
+        atom_level[pixels > self.lod_pixels[1] * factor] = self.STANDARD
+        atom_level[pixels > self.lod_pixels[0] * factor] = self.HIGH
+        self.set_levels(atom_level)
+
+    def update_positions(self, x):
+        buf = buffer_view(self.positions)
+        buf[:len(x), :3] = x
+
+    def set_colors(self, colors):
+        buf = buffer_view(self.colors)
+        buf[:len(colors)] = colors
+
+    def set_scales(self, scales):
+        buf = buffer_view(self.scales)
+        buf[:len(scales), :3] = scales
+        self.radii[:len(scales)] = self.mesh_radius * np.max(scales, axis=1)
+
+    def show(self):
+        self.node.show()
+
+    def hide(self):
+        self.node.hide()
+
+    def remove(self):
+        self.node.removeNode()
+
+
+class ImpostorAtoms(InstancedAtoms):
+    """Atoms drawn as ray-cast sphere impostors, one camera facing quad per atom.
+
+    Uses the same per-atom buffers as InstancedAtoms, but every atom costs two triangles
+    no matter how close it is, which keeps software rendering usable for 10^5-10^6 atoms.
+    """
+    # A single level, the impostor is exact at every size
+    HIGH = STANDARD = LOW = 0
+
+    def __init__(self, parent, sphere_radius, count):
+        super().__init__(parent, [make_impostor_quad()], count, ("impostor.vert", "impostor.frag"))
+        self.mesh_radius = sphere_radius
+        self.node.set_shader_input("sphere_radius", float(sphere_radius))
+        self.node.set_two_sided(True)
+
+    def update_lod(self, x, camera, fov, height):
+        pass
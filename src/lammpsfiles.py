@@ -0,0 +1,377 @@
+import io
+import os
+import mmap
+import queue
+import struct
+import threading
+import numpy as np
+from trajectory import Frame, TrajectoryReader, MAGIC
+
+# Column of the first coordinate in a data file's Atoms section, per atom style
+DATA_X_COLUMN = {"atomic": 2, "charge": 3, "full": 4, "molecular": 3, "bond": 3, "angle": 3, "sphere": 4,
+                 "dipole": 3, "ellipsoid": 4, "body": 4}
+# Column of the atom type, the molecular styles have the molecule ID before it
+DATA_TYPE_COLUMN = {"full": 2, "molecular": 2, "bond": 2, "angle": 2}
+# Binary dump header, see DumpCustom::header_binary in LAMMPS
+BIN_START = struct.Struct("<q")
+BIN_FORMAT = struct.Struct("<ii")  # endian, revision
+BIN_FRAME = struct.Struct("<qqi6i6d")  # step, natoms, triclinic, boundary, box bounds
+BIN_TILT = struct.Struct("<3d")
+BIN_INT = struct.Struct("<i")
+
+
+def box_from_bounds(bounds, tilt):
+    # Cell (rows are the lattice vectors, as OffscreenPanda.readBox) and boxlo from the
+    # bounding box a triclinic dump writes
+    (xlo, xhi), (ylo, yhi), (zlo, zhi) = bounds
+    xy, xz, yz = tilt
+    xlo -= min(0, xy, xz, xy + xz)
+    xhi -= max(0, xy, xz, xy + xz)
+    ylo -= min(0, yz)
+    yhi -= max(0, yz)
+    cell = np.array([[xhi - xlo, 0, 0], [xy, yhi - ylo, 0], [xz, yz, zhi - zlo]])
+    return cell, np.array([xlo, ylo, zlo])
+
+
+def wrap_positions(columns, data, cell, boxlo, periodic):
+    # Wrapped positions and image flags from any of LAMMPS' coordinate columns:
+    # x (wrapped), xs (scaled), xu (unwrapped) or xsu (scaled unwrapped)
+    for names, scaled, unwrapped in ((("x", "y", "z"), False, False), (("xs", "ys", "zs"), True, False),
+                                     (("xu", "yu", "zu"), False, True), (("xsu", "ysu", "zsu"), True, True)):
+        if all(name in columns for name in names):
+            x = data[:, [columns.index(name) for name in names]]
+            break
+    else:
+        raise ValueError(f"No atom coordinates among the dump columns {' '.join(columns)}")
+    if all(name in columns for name in ("ix", "iy", "iz")):
+        ix = data[:, [columns.index(name) for name in ("ix", "iy", "iz")]].astype(np.int32)
+    else:
+        ix = np.zeros((len(data), 3), dtype=np.int32)
+    f = x if scaled else (x - boxlo) @ np.linalg.inv(cell)
+    if unwrapped:
+        # Put the atoms back into the box, the shift goes to the image flags
+        shift = np.floor(f).astype(np.int32)
+        shift[:, ~periodic] = 0
+        f = f - shift
+        ix += shift
+    return boxlo + f @ cell if scaled or unwrapped else x, ix
+
+
+class DataFileReader:
+    """A LAMMPS data file as a single frame trajectory.
+
+    The Atoms section is parsed in one np.loadtxt call on the memory mapped file. Data
+    files don't store boundary conditions, the box is assumed periodic.
+    """
+    thermo_keys = ["STEP"]
+
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        bounds, tilt, self.natoms, style = [(0.0, 0.0)] * 3, (0.0, 0.0, 0.0), 0, "atomic"
+        pos = self.mm.find(b"\n") + 1  # first line is a comment
+        while True:
+            end = self.mm.find(b"\n", pos)
+            if end < 0:
+                raise ValueError(f"{path} has no Atoms section")
+            text = self.mm[pos:end].decode()
+            pos = end + 1
+            line = text.split("#")[0].split()
+            if not line:
+                continue
+            if line[-1] == "atoms":
+                self.natoms = int(line[0])
+            elif line[-1] in ("xhi", "yhi", "zhi"):
+                bounds["xyz".index(line[-1][0])] = (float(line[0]), float(line[1]))
+            elif line[-3:] == ["xy", "xz", "yz"]:
+                tilt = tuple(float(v) for v in line[:3])
+            elif line[0] == "Atoms":
+                # "Atoms # style" names the atom style
+                if "#" in text:
+                    style = text.split("#")[1].strip() or style
+                break
+        self.cell = np.array([[bounds[0][1] - bounds[0][0], 0, 0],
+                              [tilt[0], bounds[1][1] - bounds[1][0], 0],
+                              [tilt[1], tilt[2], bounds[2][1] - bounds[2][0]]])
+        self.boxlo = np.array([bounds[0][0], bounds[1][0], bounds[2][0]])
+        self.periodicity = np.ones(3, dtype=bool)
+
+        # The section starts after one blank line and has one row per atom
+        while self.mm[pos:pos + 1] in (b"\n", b"\r"):
+            pos += 1
+        data = np.loadtxt(io.BytesIO(self.mm[pos:]), max_rows=self.natoms, comments="#", ndmin=2)
+        order = np.argsort(data[:, 0])
+        data = data[order]
+        self.ids = data[:, 0].astype(np.int64)
+        self.types = data[:, DATA_TYPE_COLUMN.get(style, 1)].astype(np.int32)
+        xcol = DATA_X_COLUMN.get(style, 2)
+        columns = ["?"] * data.shape[1]
+        columns[xcol:xcol + 3] = ["x", "y", "z"]
+        if data.shape[1] >= xcol + 6:
+            columns[xcol + 3:xcol + 6] = ["ix", "iy", "iz"]
+        self.x, self.ix = wrap_positions(columns, data, self.cell, self.boxlo, self.periodicity)
+        self.n_frames = 1
+        self.steps = np.zeros(1, dtype=np.int64)
+
+    def read_frame(self, i):
+        return Frame(self.x, self.ix, self.cell, self.boxlo, np.zeros((1, 1)))
+
+    def thermo(self, i):
+        return np.zeros((1, 1))
+
+    def close(self):
+        self.mm.close()
+        self.file.close()
+
+
+class DumpReader:
+    """Random access to the frames of a text or binary LAMMPS dump file.
+
+    The file is memory mapped and the byte offset of every frame found once, on the first
+    open. The index is saved next to the dump (as <dump>.asvidx) when the directory is
+    writable, so reopening a multi-gigabyte dump is instant. A background thread parses the
+    frames playback is going to ask for next while the current one is shown.
+
+    Atoms are ordered by ID. Any of LAMMPS' coordinate columns can be read, unwrapped and
+    scaled ones are converted to wrapped positions plus image flags.
+    """
+    thermo_keys = ["STEP"]
+
+    def __init__(self, path, prefetch=4):
+        self.path = path
+        self.file = open(path, "rb")
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.binary = BIN_START.unpack_from(self.mm, 0)[0] < 0 if len(self.mm) >= 8 else False
+        self.offsets, self.steps = self.load_index()
+        if len(self.offsets) == 0:
+            raise ValueError(f"{path} has no dump frames")
+        self.n_frames = len(self.offsets)
+
+        # The first frame fixes the atoms, later frames are sorted into the same order
+        self.ids = None
+        step, natoms, columns, data, cell, boxlo, periodic = self.parse(0)
+        self.natoms = natoms
+        self.periodicity = periodic
+        self.ids = np.sort(data[:, columns.index("id")].astype(np.int64)) if "id" in columns else None
+        order = self.order(columns, data)
+        self.types = (data[order, columns.index("type")].astype(np.int32) if "type" in columns
+                      else np.ones(natoms, dtype=np.int32))
+
+        self.cache = {}
+        self.prefetch = prefetch
+        self.last_read = 0
+        self.lock = threading.Lock()
+        self.requests = queue.Queue()
+        self.thread = threading.Thread(target=self.prefetch_loop, daemon=True)
+        self.thread.start()
+
+    # Index
+
+    def index_path(self):
+        return self.path + ".asvidx"
+
+    def load_index(self):
+        # Frame offsets and steps, from the saved index if it belongs to this file
+        stat = os.stat(self.path)
+        stamp = np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+        try:
+            saved = np.load(self.index_path())
+            if np.array_equal(saved[0], stamp):
+                return saved[1:, 0].copy(), saved[1:, 1].copy()
+        except (OSError, ValueError, IndexError):
+            pass
+        offsets, steps = self.build_binary_index() if self.binary else self.build_text_index()
+        try:
+            np.save(self.index_path(), np.vstack((stamp, np.column_stack((offsets, steps)))))
+            # np.save appends .npy to names without it
+            os.replace(self.index_path() + ".npy", self.index_path())
+        except OSError:
+            pass
+        return offsets, steps
+
+    def build_text_index(self):
+        offsets, steps = [], []
+        pos = self.mm.find(b"ITEM: TIMESTEP")
+        while pos >= 0:
+            start = self.mm.find(b"\n", pos) + 1
+            line_end = self.mm.find(b"\n", start)
+            if start == 0 or line_end < 0:
+                break  # frame still being written, its step isn't complete yet
+            offsets.append(pos)
+            steps.append(int(self.mm[start:line_end]))
+            pos = self.mm.find(b"ITEM: TIMESTEP", start)
+        if offsets and not self.text_frame_complete(offsets[-1]):
+            offsets.pop()  # frame still being written
+            steps.pop()
+        return np.array(offsets, dtype=np.int64), np.array(steps, dtype=np.int64)
+
+    def text_frame_complete(self, pos):
+        # Whether the text frame at pos has its header and a full line for every atom
+        head = self.mm[pos:pos + 4096].split(b"\n")
+        atoms = self.mm.find(b"ITEM: ATOMS", pos)
+        try:
+            natoms = int(head[3])
+        except (IndexError, ValueError):
+            return False
+        if atoms < 0:
+            return False
+        line_end = self.mm.find(b"\n", atoms)
+        return line_end >= 0 and self.mm[line_end + 1:].count(b"\n") >= natoms
+
+    def build_binary_index(self):
+        # Walk the frame headers, the chunk sizes give the length of every frame
+        offsets, steps, pos = [], [], 0
+        while pos + BIN_START.size <= len(self.mm):
+            try:
+                header = self.binary_header(pos)
+                if header is None:
+                    break
+                end = header["data"]
+                for _ in range(header["chunks"]):
+                    n = BIN_INT.unpack_from(self.mm, end)[0]
+                    end += BIN_INT.size + 8 * n
+            except (struct.error, IndexError):
+                break  # header or chunk size cut off, the frame is still being written
+            if end > len(self.mm):
+                break  # frame still being written
+            offsets.append(pos)
+            steps.append(header["step"])
+            pos = end
+        return np.array(offsets, dtype=np.int64), np.array(steps, dtype=np.int64)
+
+    def binary_header(self, pos):
+        mm = self.mm
+        if pos + 8 > len(mm):
+            return None
+        marker = BIN_START.unpack_from(mm, pos)[0]
+        if marker >= 0:
+            raise ValueError(f"{self.path} is a binary dump from before LAMMPS 2021, convert it with binary2txt")
+        pos += BIN_START.size - marker + BIN_FORMAT.size
+        step, natoms, triclinic, *rest = BIN_FRAME.unpack_from(mm, pos)
+        pos += BIN_FRAME.size
+        boundary, bounds = rest[:6], rest[6:]
+        tilt = (0.0, 0.0, 0.0)
+        if triclinic:
+            tilt = BIN_TILT.unpack_from(mm, pos)
+            pos += BIN_TILT.size
+        size_one, unit_len = struct.unpack_from("<ii", mm, pos)
+        pos += 8 + unit_len
+        if mm[pos]:
+            pos += 8  # time
+        pos += 1
+        columns_len = BIN_INT.unpack_from(mm, pos)[0]
+        columns = mm[pos + 4:pos + 4 + columns_len].decode().split()
+        pos += 4 + columns_len
+        chunks = BIN_INT.unpack_from(mm, pos)[0]
+        cell, boxlo = box_from_bounds(np.reshape(bounds, (3, 2)), tilt)
+        # Boundary codes per face: 0 periodic, 1 fixed, 2 shrink wrapped, 3 shrink wrapped with minimum
+        periodic = np.array(boundary[0::2], dtype=int) == 0
+        return {"step": step, "natoms": natoms, "size_one": size_one, "columns": columns, "chunks": chunks,
+                "data": pos + BIN_INT.size, "cell": cell, "boxlo": boxlo, "periodic": periodic}
+
+    # Frames
+
+    def parse(self, i):
+        # step, natoms, column names, (natoms, columns) array, cell, boxlo, periodicity
+        pos = int(self.offsets[i])
+        end = int(self.offsets[i + 1]) if i + 1 < len(self.offsets) else len(self.mm)
+        if self.binary:
+            h = self.binary_header(pos)
+            parts, pos = [], h["data"]
+            for _ in range(h["chunks"]):
+                n = BIN_INT.unpack_from(self.mm, pos)[0]
+                parts.append(np.frombuffer(self.mm, dtype=np.float64, count=n, offset=pos + BIN_INT.size))
+                pos += BIN_INT.size + 8 * n
+            data = np.concatenate(parts).reshape(h["natoms"], h["size_one"])
+            return h["step"], h["natoms"], h["columns"], data, h["cell"], h["boxlo"], h["periodic"]
+
+        atoms = self.mm.find(b"ITEM: ATOMS", pos, end)
+        head = self.mm[pos:atoms].decode().split("\n")
+        step, natoms = int(head[1]), int(head[3])
+        box = head[4].split()[3:]
+        tilt_names = [name for name in box if name in ("xy", "xz", "yz")]
+        lines = [[float(v) for v in line.split()] for line in head[5:8]]
+        tilt = [line[2] if tilt_names else 0.0 for line in lines]
+        cell, boxlo = box_from_bounds([line[:2] for line in lines], tilt)
+        # Dumps of old LAMMPS versions don't have the boundary flags
+        flags = box[len(tilt_names):] or ["pp"] * 3
+        periodic = np.array([flag == "pp" for flag in flags], dtype=bool)
+        line_end = self.mm.find(b"\n", atoms)
+        columns = self.mm[atoms + len(b"ITEM: ATOMS"):line_end].decode().split()
+        data = np.loadtxt(io.BytesIO(self.mm[line_end + 1:end]), max_rows=natoms, ndmin=2)
+        return step, natoms, columns, data, cell, boxlo, periodic
+
+    def order(self, columns, data):
+        # Row of every atom in ID order
+        if self.ids is None:
+            return np.arange(len(data))
+        ids = data[:, columns.index("id")].astype(np.int64)
+        order = np.empty(len(ids), dtype=np.intp)
+        order[np.searchsorted(self.ids, ids)] = np.arange(len(ids))
+        return order
+
+    def load_frame(self, i):
+        step, natoms, columns, data, cell, boxlo, periodic = self.parse(i)
+        if natoms != self.natoms:
+            raise ValueError(f"Frame {i} of {self.path} has {natoms} atoms instead of {self.natoms}")
+        x, ix = wrap_positions(columns, data[self.order(columns, data)], cell, boxlo, periodic)
+        return Frame(x, ix, cell, boxlo, np.array([[step]], dtype=np.float64))
+
+    def read_frame(self, i):
+        with self.lock:
+            frame = self.cache.pop(i, None)
+        if isinstance(frame, Exception):
+            # The prefetch thread failed to parse this frame
+            raise frame
+        if frame is None:
+            frame = self.load_frame(i)
+        # Playback moves through the file with a constant stride, prefetch along it
+        stride = i - self.last_read if i > self.last_read else 1
+        self.last_read = i
+        for k in range(1, self.prefetch + 1):
+            if i + k * stride < self.n_frames:
+                self.requests.put(i + k * stride)
+        return frame
+
+    def thermo(self, i):
+        # Dumps have no thermo output, only the step of each frame
+        return np.array([[self.steps[i]]], dtype=np.float64)
+
+    def prefetch_loop(self):
+        while True:
+            i = self.requests.get()
+            if i is None:
+                break
+            with self.lock:
+                if i in self.cache or i <= self.last_read:
+                    continue
+            try:
+                frame = self.load_frame(i)
+            except Exception as e:
+                # Kept in place of the frame, read_frame raises it when playback gets there
+                frame = e
+            with self.lock:
+                self.cache[i] = frame
+                # Drop frames playback has passed, then the farthest ones beyond the budget
+                for j in [j for j in self.cache if j <= self.last_read]:
+                    del self.cache[j]
+                while len(self.cache) > 2 * self.prefetch:
+                    del self.cache[max(self.cache)]
+
+    def close(self):
+        self.requests.put(None)
+        self.thread.join()
+        self.cache.clear()
+        self.mm.close()
+        self.file.close()
+
+
+def open_trajectory(path):
+    # Reader for a recorded ASV trajectory, a LAMMPS data file or a text or binary dump
+    with open(path, "rb") as f:
+        start = f.read(len(MAGIC))
+    if start == MAGIC:
+        return TrajectoryReader(path)
+    if path.endswith(".data") or os.path.basename(path).startswith("data."):
+        return DataFileReader(path)
+    return DumpReader(path)
@@ -1,3 +1,5 @@
+import os
+import math
 import time
 from PyQt6 import QtWidgets, QtCore, QtGui
 import pyqtgraph as pg
@@ -9,6 +11,7 @@ from lammps import lammps, LMP_TYPE_VECTOR, LMP_STYLE_ATOM, LMP_TYPE_ARRAY
 from funcs import *
 from pandalabel import PandaLabel
 from panda import OffscreenPanda
+from coloring import COLORMAPS, PRESETS
 loadPrcFileData("", "transform-cache false")
 
 class MainWindow(QtWidgets.QMainWindow):
@@ -19,15 +22,12 @@ class MainWindow(QtWidgets.QMainWindow):
         self.graphs = {}
         self.curves = {}
         self.graph_min_size = [300, 200]    #Height, Width
+        # Sample count each graph was last drawn with. Graphs are only redrawn when visible and
+        # when new samples have arrived since then.
+        self.plotted_count = {}
         self.total_cycle_time = 0
         self.cycle_count = 0
 
-        self.panda_size = 0
-        self.self_size = 0
-        self.pandalabel_size = 0
-        self.lmp_size = 0
-        self.graph_size = 0
-
         # Layouts
         central = QtWidgets.QWidget()
         hbox = QtWidgets.QHBoxLayout(central)
@@ -49,6 +49,9 @@ class MainWindow(QtWidgets.QMainWindow):
         self.resetbtn = QtWidgets.QPushButton("Reset Camera")
         self.resetbtn.clicked.connect(self.reset_camera)
         buttonbox.addWidget(self.resetbtn)
+        self.recordbtn = QtWidgets.QPushButton("Record")
+        self.recordbtn.clicked.connect(self.toggle_recording)
+        buttonbox.addWidget(self.recordbtn)
 
         # Show object toggle buttons
         show_buttonbox = QtWidgets.QHBoxLayout()
@@ -62,8 +65,14 @@ class MainWindow(QtWidgets.QMainWindow):
         self.showbondsbtn = QtWidgets.QPushButton("Bonds: Hide")
         self.showbondsbtn.clicked.connect(lambda: self.toggle_show_object("bonds"))
         show_buttonbox.addWidget(self.showbondsbtn)
+        self.timingsbtn = QtWidgets.QPushButton("Timings: Show")
+        self.timingsbtn.clicked.connect(self.toggle_timings)
+        show_buttonbox.addWidget(self.timingsbtn)
+        self.analysisbtn = QtWidgets.QPushButton("Analysis: Show")
+        self.analysisbtn.clicked.connect(self.toggle_analysis)
+        show_buttonbox.addWidget(self.analysisbtn)
 
-        self.simSpeedLabel = QtWidgets.QLabel(f"Simulation Speed: {panda.timestep}")
+        self.simSpeedLabel = QtWidgets.QLabel(f"Simulation Speed: {speedText(panda)}")
         vbox.addWidget(self.simSpeedLabel)
         self.speedSlider = QtWidgets.QSlider(QtCore.Qt.Orientation.Horizontal)
         self.speedSlider.setRange(1, 10)
@@ -86,6 +95,59 @@ class MainWindow(QtWidgets.QMainWindow):
         self.pressSlider.valueChanged.connect(lambda v: changeBaro(panda, self.pressSliderLabel, v))
         vbox.addWidget(self.pressSlider)
 
+        # Atom coloring by type or by a per-atom quantity from LAMMPS
+        colorbox = QtWidgets.QHBoxLayout()
+        vbox.addLayout(colorbox)
+        colorbox.addWidget(QtWidgets.QLabel("Color by:"))
+        self.colorByList = QtWidgets.QComboBox()
+        for source, (label, *_) in PRESETS.items():
+            self.colorByList.addItem(label, source)
+        colorbox.addWidget(self.colorByList, 1)
+        self.colormapList = QtWidgets.QComboBox()
+        self.colormapList.addItems(list(COLORMAPS))
+        colorbox.addWidget(self.colormapList)
+        self.sync_coloring()
+        self.colorByList.currentIndexChanged.connect(self.change_coloring)
+        self.colormapList.currentTextChanged.connect(self.change_coloring)
+
+        # Bookmarked simulation states, restored from memory
+        bookmarkbox = QtWidgets.QHBoxLayout()
+        vbox.addLayout(bookmarkbox)
+        self.bookmarkbtn = QtWidgets.QPushButton("Bookmark State")
+        self.bookmarkbtn.clicked.connect(self.bookmark_state)
+        bookmarkbox.addWidget(self.bookmarkbtn)
+        self.bookmarkList = QtWidgets.QComboBox()
+        bookmarkbox.addWidget(self.bookmarkList, 1)
+        self.restorebtn = QtWidgets.QPushButton("Restore")
+        self.restorebtn.clicked.connect(self.restore_bookmark)
+        self.restorebtn.setEnabled(False)
+        bookmarkbox.addWidget(self.restorebtn)
+
+        # Playback of a recorded trajectory replaces the LAMMPS controls with a frame scrubber
+        if panda.playback is not None:
+            self.recordbtn.setVisible(False)
+            self.bookmarkbtn.setVisible(False)
+            self.bookmarkList.setVisible(False)
+            self.restorebtn.setVisible(False)
+            self.tempSlider.setEnabled(False)
+            self.pressSlider.setEnabled(False)
+            self.colorByList.setEnabled(False)
+            self.colormapList.setEnabled(False)
+            self.frameSliderLabel = QtWidgets.QLabel(f"Frame: 0 / {panda.playback.n_frames - 1}")
+            vbox.addWidget(self.frameSliderLabel)
+            self.frameSlider = QtWidgets.QSlider(QtCore.Qt.Orientation.Horizontal)
+            self.frameSlider.setRange(0, panda.playback.n_frames - 1)
+            self.frameSlider.valueChanged.connect(self.scrub_to_frame)
+            vbox.addWidget(self.frameSlider)
+
+        # Properties of the atom picked in the view, refreshed with every frame
+        self.selectionBox = QtWidgets.QGroupBox("Selected Atom")
+        selectionLayout = QtWidgets.QVBoxLayout(self.selectionBox)
+        self.selectionLabel = QtWidgets.QLabel("Click an atom to inspect it")
+        self.selectionLabel.setTextInteractionFlags(QtCore.Qt.TextInteractionFlag.TextSelectableByMouse)
+        selectionLayout.addWidget(self.selectionLabel)
+        vbox.addWidget(self.selectionBox)
+
         # Create a box for toggling individual graphs
         buttonHBox = QtWidgets.QHBoxLayout()
         self.graphGraphicalBox = QtWidgets.QGroupBox("Graph Toggles")
@@ -117,6 +179,9 @@ class MainWindow(QtWidgets.QMainWindow):
                     self.graph.setLabel("left", self.special_keys[key]["y-label"], self.special_keys[key]["y-unit"])
                     self.graph.setLabel("bottom", self.special_keys[key]["x-label"], self.special_keys[key]["x-unit"])
                     self.curve = self.graph.plot(pen='y')
+                    # Min/max decimation down to the plot's pixel width, only for the visible range
+                    self.curve.setDownsampling(auto=True, method="peak")
+                    self.curve.setClipToView(True)
                     self.xdata, self.ydatas = [], {}
                     self.start = time.time()
                     self.graph.setMinimumSize(self.graph_min_size[0], self.graph_min_size[1])
@@ -133,6 +198,9 @@ class MainWindow(QtWidgets.QMainWindow):
                     self.graph.setLabel("left", var_name + self.special_keys[key]["y-label"], self.special_keys[key]["y-unit"])
                     self.graph.setLabel("bottom", self.special_keys[key]["x-label"], self.special_keys[key]["x-unit"])
                     self.curve = self.graph.plot(pen='y')
+                    # Min/max decimation down to the plot's pixel width, only for the visible range
+                    self.curve.setDownsampling(auto=True, method="peak")
+                    self.curve.setClipToView(True)
                     self.xdata, self.ydatas = [], {}
                     self.start = time.time()
                     self.graph.setMinimumSize(self.graph_min_size[0], self.graph_min_size[1])
@@ -142,10 +210,31 @@ class MainWindow(QtWidgets.QMainWindow):
                     self.graphs[var_name] = self.graph
                     self.curves[var_name] = self.curve
 
+        # Structural analysis panels, filled from panda.analysis while it runs
+        self.analysis_graphs = {}
+        self.analysis_curves = {}
+        self.analysis_version = -1
+        time_unit = panda.time_unit
+        for name, title, x_label, x_unit, y_label in (
+                ("rdf", "Radial Distribution Function", "r", "", "g(r)"),
+                ("coordination", "Coordination", "Neighbors", "", "Fraction of atoms"),
+                ("msd", "Mean Squared Displacement", "Time", time_unit, "MSD")):
+            graph = pg.PlotWidget(title=title)
+            graph.setLabel("left", y_label)
+            graph.setLabel("bottom", x_label, x_unit)
+            graph.addLegend()
+            graph.setMinimumSize(self.graph_min_size[0], self.graph_min_size[1])
+            graph.setVisible(False)
+            vbox.addWidget(graph)
+            self.analysis_graphs[name] = graph
+        if panda.analysis is not None:
+            self.show_analysis(True)
+
         # Panda image label
         self.label = PandaLabel(panda)
         self.label.setAlignment(QtCore.Qt.AlignmentFlag.AlignCenter)
         self.label.setMinimumSize(panda.W, panda.H)
+        self.label.atomPicked.connect(self.atom_picked)
 
         # Assemble
         hbox.addWidget(sidebar)
@@ -164,13 +253,74 @@ class MainWindow(QtWidgets.QMainWindow):
 
     def reset_simulation(self):
         print("Resetting simulation...")
-        for atom in self.panda.atoms:
-            atom.removeNode()
-        self.speedSlider.setValue(1)
-        self.tempSlider.setValue(1)
-        self.pressSlider.setValue(0)
-        self.panda.lmp.command(f"clear")
-        self.panda.setupLammps()
+        if self.panda.playback is not None:
+            self.frameSlider.setValue(0)
+            return
+        # Restored from the state saved after setup, the deck isn't read again
+        self.panda.restoreState("initial")
+        self.sync_controls()
+        self.refresh_view()
+
+    def bookmark_state(self):
+        name = self.panda.saveState().name
+        if self.bookmarkList.findText(name) < 0:
+            self.bookmarkList.addItem(name)
+        self.bookmarkList.setCurrentText(name)
+        self.restorebtn.setEnabled(True)
+
+    def restore_bookmark(self):
+        name = self.bookmarkList.currentText()
+        if name:
+            self.panda.restoreState(name)
+            self.sync_controls()
+            self.refresh_view()
+
+    def sync_controls(self):
+        # Move the sliders to the restored settings without sending them to LAMMPS again
+        panda = self.panda
+        for slider, value in ((self.speedSlider, panda.timestep),
+                              (self.tempSlider, round(1000 * math.log2(max(panda.tStop, 1e-9)))),
+                              (self.pressSlider, round(100000 * panda.pStop))):
+            slider.blockSignals(True)
+            slider.setValue(int(value))
+            slider.blockSignals(False)
+        self.simSpeedLabel.setText(f"Simulation Speed: {speedText(panda)}")
+        self.tempSliderLabel.setText(f"Thermostat: {panda.tStop:.3f}")
+        self.pressSliderLabel.setText(f"Barostat: {panda.pStop:.3f}")
+
+    def sync_coloring(self):
+        # Show the coloring set from the command line, a custom value spec is added as an item
+        coloring = self.panda.coloring
+        source = next((key for key, preset in PRESETS.items() if preset[1] == coloring.spec), coloring.spec)
+        if self.colorByList.findData(source) < 0:
+            self.colorByList.addItem(source, source)
+        self.colorByList.blockSignals(True)
+        self.colorByList.setCurrentIndex(self.colorByList.findData(source))
+        self.colorByList.blockSignals(False)
+        self.colormapList.blockSignals(True)
+        self.colormapList.setCurrentText(coloring.colormap)
+        self.colormapList.blockSignals(False)
+
+    def change_coloring(self):
+        self.panda.set_coloring(self.colorByList.currentData(), self.colormapList.currentText())
+        self.refresh_view()
+
+    def toggle_recording(self):
+        if self.panda.recorder is None:
+            os.makedirs("recordings", exist_ok=True)
+            path = os.path.join("recordings", time.strftime("ASV_%Y%m%d_%H%M%S.traj"))
+            print(f"Recording to {path}...")
+            self.panda.startRecording(path)
+            self.recordbtn.setText("Stop Recording")
+        else:
+            self.panda.stopRecording()
+            self.recordbtn.setText("Record")
+
+    def scrub_to_frame(self, frame):
+        if frame != self.panda.playback_frame:
+            self.panda.seekFrame(frame)
+            self.refresh_view()
+        self.frameSliderLabel.setText(f"Frame: {frame} / {self.panda.playback.n_frames - 1}")
 
     def reset_camera(self):
         self.panda.center_camera()
@@ -188,13 +338,11 @@ class MainWindow(QtWidgets.QMainWindow):
             self.panda.show_box = not self.panda.show_box
         if object == "atoms":
             if self.panda.show_atoms:
-                for i in range(len(self.panda.atoms)):
-                    self.panda.atoms[i].hide()
-                    self.showatomsbtn.setText("Atoms: Show")
+                self.panda.atom_layer.hide()
+                self.showatomsbtn.setText("Atoms: Show")
             else:
-                for i in range(len(self.panda.atoms)):
-                    self.panda.atoms[i].show()
-                    self.showatomsbtn.setText("Atoms: Hide")
+                self.panda.atom_layer.show()
+                self.showatomsbtn.setText("Atoms: Hide")
             self.panda.show_atoms = not self.panda.show_atoms
         if object == "bonds":
             if self.panda.show_bonds:
@@ -204,26 +352,122 @@ class MainWindow(QtWidgets.QMainWindow):
                 self.panda.bond_node.show()
                 self.showbondsbtn.setText("Bonds: Hide")
             self.panda.show_bonds = not self.panda.show_bonds
+        self.panda.redraw.invalidate("visibility")
+
+
+    def toggle_timings(self):
+        # The overlay needs the profiler running, exporting to a file keeps it running when hidden
+        profiler = self.panda.profiler
+        profiler.overlay = not profiler.overlay
+        profiler.enabled = profiler.overlay or profiler.export_file is not None
+        self.timingsbtn.setText("Timings: Hide" if profiler.overlay else "Timings: Show")
+        self.label.update()
+
+    def toggle_analysis(self):
+        if self.panda.analysis is None:
+            self.panda.startAnalysis()
+            self.show_analysis(True)
+        else:
+            self.panda.stopAnalysis()
+            self.show_analysis(False)
+
+    def show_analysis(self, visible):
+        for graph in self.analysis_graphs.values():
+            graph.setVisible(visible)
+        self.analysisbtn.setText("Analysis: Hide" if visible else "Analysis: Show")
+
+    def update_analysis(self):
+        # Redraw the analysis panels when the workers have published new results
+        if self.panda.analysis is None:
+            return
+        version, results = self.panda.analysis.results()
+        if version == self.analysis_version:
+            return
+        self.analysis_version = version
+        if "rdf" in results:
+            r, g = results["rdf"]
+            for pair, curve in g.items():
+                self.set_analysis_curve("rdf", pair, r, curve)
+            neighbors, hists = results["coordination"]
+            for t, hist in hists.items():
+                self.set_analysis_curve("coordination", f"type {t}", neighbors, hist, symbol="o")
+        if "msd" in results:
+            t, msd = results["msd"]
+            for ty, curve in msd.items():
+                self.set_analysis_curve("msd", f"type {ty}", t, curve)
+            diffusion = ", ".join(f"D{ty} = {d:.3g}" for ty, d in results["diffusion"].items())
+            self.analysis_graphs["msd"].setTitle(f"Mean Squared Displacement {diffusion}")
 
+    def set_analysis_curve(self, graph, key, x, y, **style):
+        curve = self.analysis_curves.get((graph, key))
+        if curve is None:
+            pen = pg.intColor(len([k for k in self.analysis_curves if k[0] == graph]), hues=6)
+            curve = self.analysis_graphs[graph].plot(pen=pen, name=key, symbolBrush=pen, symbolSize=5, **style)
+            self.analysis_curves[(graph, key)] = curve
+        curve.setData(x, y)
+
+    def atom_picked(self, index):
+        self.update_selection()
+
+    def update_selection(self):
+        index = self.panda.selected_atom
+        if index is None:
+            self.selectionLabel.setText("Click an atom to inspect it")
+            return
+        rows = self.panda.atom_properties(index)
+        text = "\n".join(f"{name}: {value}" for name, value in rows)
+        if text != self.selectionLabel.text():
+            self.selectionLabel.setText(text)
 
     @QtCore.pyqtSlot()
     def update_frame(self):
-        if not self.panda.paused:
-            # Run a simulation step
-            self.panda.moveAtomsTask()
-            qimg = self.panda.render_frame_to_qimage()
-            self.label.setPixmap(QtGui.QPixmap.fromImage(qimg))
-            for key in self.graphs:
-                self.xdata, self.ydatas[key] = self.panda.sim_info["STEP"], self.panda.sim_info[key]
-                self.curves[key].setData(self.xdata, self.ydatas[key])
-            if len(self.xdata) > self.panda.info_size:
-                self.xdata.pop(0)
-                for key in self.ydatas:
-                    self.ydatas[key].pop(0)
-            if self.panda.show_box:
-                self.panda.drawSimulationBoxTask()
-            if self.panda.show_bonds:
-                self.panda.drawBondsTask()
-
+        if self.panda.recording_error is not None:
+            self.recordbtn.setText("Record")
+            QtWidgets.QMessageBox.warning(self, "Recording stopped", f"Recording failed: {self.panda.recording_error}")
+            self.panda.recording_error = None
+        if self.panda.paused:
+            # Camera moves and toggles still need a new frame while paused
+            self.refresh_view()
+            return
+        start = time.perf_counter()
+        profiler = self.panda.profiler
+        profiler.begin_frame()
+        # Run a simulation step
+        self.panda.moveAtomsTask()
+        if self.panda.engine_error is not None:
+            self.startstopbtn.setText("Play")
+            QtWidgets.QMessageBox.warning(self, "Simulation paused", f"LAMMPS failed: {self.panda.engine_error}")
+        self.refresh_view()
+        if self.panda.playback is not None:
+            self.frameSlider.setValue(self.panda.playback_frame)
+        profiler.end_frame(self.panda)
+        self.total_cycle_time += time.perf_counter() - start
+        self.cycle_count += 1
 
+    def refresh_view(self):
+        # Render only if the camera, the scene or a visibility toggle changed since the last
+        # frame. The box and bonds are rebuilt first so they match the atoms in the frame.
+        panda = self.panda
+        profiler = panda.profiler
+        panda.updateSceneTask()
+        scale = panda.next_render_scale()
+        if scale is not None:
+            self.label.set_frame(panda.render_frame_to_qimage(scale))
+        elif panda.readback_pending:
+            self.label.set_frame(panda.frame_to_qimage(panda.finish_frame_to_ram()))
+        profiler.lap("readback")
+        self.update_graphs()
+        self.update_analysis()
+        self.update_selection()
+        profiler.lap("plotting")
 
+    def update_graphs(self):
+        steps = self.panda.sim_info["STEP"]
+        xdata = None
+        for key in self.graphs:
+            if not self.graphs[key].isVisible() or self.plotted_count.get(key) == steps.count:
+                continue
+            if xdata is None:
+                xdata = steps.view()
+            self.curves[key].setData(xdata, self.panda.sim_info[key].view())
+            self.plotted_count[key] = steps.count
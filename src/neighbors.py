@@ -0,0 +1,92 @@
+import itertools
+import numpy as np
+from scipy.spatial import cKDTree
+
+
+def minimum_image(d, cell, periodic):
+    # Apply the minimum image convention to difference vectors d in a (possibly triclinic)
+    # cell whose rows are the lattice vectors. Only periodic dimensions are wrapped.
+    f = d @ np.linalg.inv(cell)
+    f[:, periodic] -= np.round(f[:, periodic])
+    return f @ cell
+
+
+def periodic_images(x, cell, boxlo, periodic, r):
+    # Wrap x into the cell and add the periodic images of the atoms that lie within r of a
+    # box face. Returns the wrapped positions (N, 3), the padded point set (M, 3) that starts
+    # with them and the atom index of every point (M,).
+    inv = np.linalg.inv(cell)
+    f = (x - boxlo) @ inv
+    f[:, periodic] %= 1.0
+    wrapped = f @ cell
+
+    # The distance between opposite faces along cell vector k is 1 / |column k of inv(cell)|
+    margin = r * np.linalg.norm(inv, axis=0)
+    points = [wrapped]
+    index = [np.arange(len(x))]
+    shift_range = [(-1, 0, 1) if p else (0,) for p in periodic]
+    for shift in itertools.product(*shift_range):
+        if not any(shift):
+            continue
+        mask = np.ones(len(x), dtype=bool)
+        for k, s in enumerate(shift):
+            if s == 1:
+                mask &= f[:, k] < margin[k]
+            elif s == -1:
+                mask &= f[:, k] > 1.0 - margin[k]
+        sel = np.nonzero(mask)[0]
+        points.append(wrapped[sel] + np.asarray(shift) @ cell)
+        index.append(sel)
+    return wrapped, np.concatenate(points), np.concatenate(index)
+
+
+class BondNeighborList:
+    """Persistent Verlet-style candidate list for bond detection.
+
+    Candidate pairs are collected within max cutoff + skin and reused until an atom has
+    moved more than half the skin since the last build. Every frame only the candidate
+    distances are recomputed, in one vectorized pass.
+    """
+    def __init__(self, cutoffs, skin=0.5):
+        self.cutoffs = np.asarray(cutoffs, dtype=float)
+        self.max_cutoff = self.cutoffs.max()
+        self.skin = skin
+        self.pairs = np.empty((0, 2), dtype=np.int64)
+        self.pair_cutoffs = np.empty(0)
+        self.x_ref = None
+        self.cell_ref = None
+        self.builds = 0
+
+    def needs_rebuild(self, x, cell, periodic):
+        if self.x_ref is None or len(self.x_ref) != len(x):
+            return True
+        # An affine box change moves atoms by at most the change of the cell vectors
+        cell_change = np.abs(cell - self.cell_ref).max()
+        disp = minimum_image(x - self.x_ref, cell, periodic)
+        max_disp = np.sqrt(np.einsum("ij,ij->i", disp, disp).max()) if len(disp) else 0
+        return max_disp + cell_change > 0.5 * self.skin
+
+    def build(self, x, cell, boxlo, periodic):
+        r_list = self.max_cutoff + self.skin
+        wrapped, points, index = periodic_images(x, cell, boxlo, periodic, r_list)
+
+        tree = cKDTree(points)
+        pairs = tree.query_pairs(r=r_list, output_type="ndarray")
+        pairs = index[pairs]
+        pairs = pairs[pairs[:, 0] != pairs[:, 1]]
+        pairs.sort(axis=1)
+        self.pairs = np.unique(pairs, axis=0)
+        self.pair_cutoffs = np.minimum(self.cutoffs[self.pairs[:, 0]], self.cutoffs[self.pairs[:, 1]])
+
+        self.x_ref = x.copy()
+        self.cell_ref = cell.copy()
+        self.builds += 1
+
+    def update(self, x, cell, boxlo, periodic):
+        # Returns the bonded pairs (M, 2) and their minimum image vectors from i to j (M, 3)
+        periodic = np.asarray(periodic, dtype=bool)
+        if self.needs_rebuild(x, cell, periodic):
+            self.build(x, cell, boxlo, periodic)
+        d = minimum_image(x[self.pairs[:, 1]] - x[self.pairs[:, 0]], cell, periodic)
+        bonded = np.einsum("ij,ij->i", d, d) <= self.pair_cutoffs ** 2
+        return self.pairs[bonded], d[bonded]
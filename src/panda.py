@@ -1,4 +1,5 @@
 import math
+import time
 import numpy as np
 from PyQt6 import QtGui
 from direct.showbase.ShowBase import ShowBase
@@ -6,29 +7,102 @@ from direct.task import Task
 from direct.gui.DirectGui import *
 from panda3d.core import *
 from lammps import lammps, LMP_TYPE_VECTOR, LMP_STYLE_ATOM, LMP_TYPE_ARRAY
-from ase import Atoms
-from ase.neighborlist import NeighborList
 from funcs import *
+from instancing import InstancedAtoms, ImpostorAtoms, load_atom_meshes
+from engine import SimulationEngine
+from thermo import ThermoCapture
+from ringbuffer import RingBuffer
+from profiler import FrameProfiler
+from state import SavedState
+from trajectory import TrajectoryWriter
+from lammpsfiles import open_trajectory
+from parallel import ParallelLammps, lammps_args
+from scheduler import StepScheduler, TIME_UNITS
+from analysis import AnalysisPipeline
+from coloring import AtomColoring, PRESETS
+from picking import AtomPicker
+from redraw import RedrawTracker
 import os
 
 class OffscreenPanda(ShowBase):
-    def __init__(self, W, H):
+    def __init__(self, W, H, history_dir=None, trajectory=None, input_file=None, omp_threads=0, mpi=False):
         super().__init__()
         self.W, self.H = W, H
         # How many iterations of thermo info to be stored before deleting old ones
-        self.info_size = 300
+        self.info_size = 5000
+        # Directory older thermo samples are spilled to once they leave the in-memory history.
+        # None keeps only the last info_size samples.
+        self.history_dir = history_dir
+        self.sim_info = {}
         base_dir = os.path.dirname(os.path.abspath(__file__))
-        self.input_file = os.path.join(base_dir, '../inputs/tersoff.in')
+        self.input_file = input_file or os.path.join(base_dir, '../inputs/tersoff.in')
         self.cutoffs = []
         self.max_cutoff = 0
         self.bond_pairs = []
-        self.bond_geom_node = 0
+        self.bond_vectors = []
+        self.bond_neighbors = None
         self.bond_node = 0
+        # "lines" or "cylinders" (instanced)
+        self.bond_style = "lines"
+        self.atom_layer = None
+        self.show_atoms = True
+        # Atom mesh detail: "auto" picks a level of detail per atom from its size on screen,
+        # "high", "standard" or "low" forces one mesh for every atom
+        self.atom_detail = "auto"
+        # "spheres" (instanced meshes) or "impostors" (ray-cast quads, for very large systems)
+        self.atom_style = "spheres"
+        self.engine = None
+        self.engine_error = None  # why the engine thread stopped, until the simulation is resumed
+        # Chooses the MD steps per frame from the speed setting and runs them without
+        # per-run setup. "fixed" runs exactly timestep steps per frame.
+        self.scheduler = StepScheduler()
+        self.parallel = False
+        self.playback = None
+        self.recorder = None
+        self.recording_error = None  # why the last recording stopped, until it is reported
+        # Per-stage frame timings, off unless enabled
+        self.profiler = FrameProfiler()
+        # In-memory simulation states by name. "initial" is saved right after the deck is
+        # set up and used by reset, the rest are user bookmarks.
+        self.saved_states = {}
+        # Nearest neighbors for the centro-symmetry coloring: 4 for the diamond lattice of
+        # the default deck, 12 for fcc
+        self.centro_neighbors = 4
+        # Structural analysis (RDF, coordination, MSD) on worker threads, off unless started
+        self.analysis = None
+        # Atom picking from the view, the KD-tree over the positions is kept between picks
+        self.picker = AtomPicker()
+        self.selected_atom = None
+        self.selection_path = None
+        # Frames are only rendered when something on screen changed, at reduced resolution
+        # while the camera is being moved
+        self.redraw = RedrawTracker()
+        self.render_scale = 1.0
+        self.box_cell = None
+        self.bonds_version = -1
 
         # Offscreen buffer & texture
         buf = self.win.make_texture_buffer("buf", W, H, to_ram=True)
+        # Opaque clear color, Qt reads the alpha byte of the frame even as RGB32
+        buf.set_clear_color(Vec4(0.41, 0.41, 0.41, 1))
         self.tex = buf.get_texture()
         buf.add_render_texture(self.tex, GraphicsOutput.RTMCopyRam, GraphicsOutput.RTPColor)
+        self.buf = buf
+        # With a threaded (App/Cull/Draw) pipeline, see backend.py, a frame is drawn
+        # pipeline_depth render_frame calls after it was set up. Frames then take turns on
+        # a ring of pipeline_depth + 2 textures and each is read one call after it was
+        # drawn, when nothing writes into it anymore.
+        self.pipeline_depth = self.graphicsEngine.get_threading_model().get_draw_stage()
+        self.pipelined_readback = self.pipeline_depth > 0
+        slots = self.pipeline_depth + 2 if self.pipelined_readback else 1
+        self.readback_textures = [self.tex] + [Texture(f"readback{i}") for i in range(1, slots)]
+        self.readback_started = [0.0] * slots
+        self.frame_index = 0
+        self.ram_image = None
+        # Size of the newest frame, smaller than W x H when drawn at reduced resolution
+        self.frame_size = (W, H)
+        # True while the newest pipelined frame hasn't been read back yet
+        self.readback_pending = False
 
         # Offscreen camera
         dr = buf.get_display_region(0)
@@ -43,8 +117,19 @@ class OffscreenPanda(ShowBase):
         self.cam_h = cam2.get_h()
         self.cam_p = cam2.get_p()
 
-        self.lmp = lammps(cmdargs=["-log", "none", "-screen", "none", "-nocite"])
-        self.setupLammps()
+        if trajectory is not None:
+            # Playback of a recorded trajectory doesn't need LAMMPS at all
+            self.lmp = None
+            self.setupPlayback(trajectory)
+        else:
+            # With mpi the atoms are split over all MPI ranks and gathered back to this one
+            # (rank 0) for drawing, the other ranks run parallel.worker_loop
+            self.parallel = mpi
+            if mpi:
+                self.lmp = ParallelLammps(lammps_args(omp_threads))
+            else:
+                self.lmp = lammps(cmdargs=lammps_args(omp_threads))
+            self.setupLammps()
 
         # Build scene
         self.render.set_shader_auto()
@@ -64,7 +149,6 @@ class OffscreenPanda(ShowBase):
         self._prev  = self.taskMgr.globalClock.get_frame_time()
         self.cutoff_cached = False
         self.show_box = True
-        self.show_atoms = True
         self.show_bonds = True
 
         # Create a pivot node (the point you want to orbit around)
@@ -82,18 +166,27 @@ class OffscreenPanda(ShowBase):
         # Create lammps object and get initial coords
         print("Creating lammps instance...")
         self.lmp.file(self.input_file)
-        self.atom_ids = self.lmp.numpy.extract_atom("id")
-        self.x = self.lmp.numpy.extract_atom("x")[0:len(self.atom_ids)]
-        self.ix = self.lmp.numpy.extract_compute("compute_ix", LMP_STYLE_ATOM, LMP_TYPE_ARRAY)
-        self.xu = self.lmp.numpy.extract_compute("compute_xu", LMP_STYLE_ATOM, LMP_TYPE_ARRAY)
-        self.cell = np.zeros((3, 3))
-        self.timestep = 1
-        self.tStart = 1
-        self.tStop = 1
-        self.pStart = 0
-        self.pStop = 0
-        self.bond_pairs = []
-        self.vertices = []
+        natoms = self.lmp.get_natoms()
+        if self.parallel:
+            # LAMMPS can only gather and scatter by ID when the IDs are 1..natoms
+            if self.lmp.extract_global("map_tag_max") != natoms:
+                raise ValueError(f"{self.input_file} has atom IDs that aren't 1..{natoms}, which --mpi can't "
+                                 "gather. Add reset_atoms id to the deck.")
+            ids = None
+        else:
+            ids = self.lmp.numpy.extract_atom("id")[0:self.lmp.extract_global("nlocal")]
+        self.allocateAtoms(natoms, ids)
+        self.extractAtoms()
+        self.cell, self.boxlo, self.periodicity = self.readBox()
+        self.step = int(self.lmp.extract_global("ntimestep"))
+        self.dt = self.lmp.extract_global("dt")
+        self.time_unit = TIME_UNITS.get(self.lmp.extract_global("units"), "")
+        # The decks ramp their thermostat from tStart to tStop. Hold it at tStop like the
+        # slider does, a ramp would start over with every run window.
+        if self.lmp.has_id("variable", "tStop"):
+            self.tStop = self.lmp.extract_variable("tStop")
+        if self.lmp.has_id("fix", THERMOSTAT_FIX):
+            self.lmp.command(thermostatCommand(self))
 
         # Grab desired variables from read_from_file.in file
         with open(self.input_file, "r") as f:
@@ -104,50 +197,153 @@ class OffscreenPanda(ShowBase):
             for line in keyword_lines:
                 temp = line.split(" ")
                 for word in temp:
-                    keywords.append(word.strip())
+                    if word.strip():
+                        keywords.append(word.strip())
             for keyword in bad_keywords:
                 if keyword in keywords:
                     keywords.remove(keyword)
             # Remove duplicates by turning keywords into a set (that doesn't allow for duplicates) and then back to a list
             keywords = list(set(keywords))
-        # Turn keywords items into a dictionary
+        self.createThermoHistory(keywords)
+        # Capture every thermo quantity on every step, not just the last one of each run
+        self.thermo_capture = ThermoCapture(self.lmp, keywords, on_change=self.scheduler.invalidate)
+
+        # Setup atoms
+        if self.parallel:
+            atom_type_list = self.lmp.gather("type", 1, integer=True).astype(np.int32)
+        else:
+            atom_type_list = np.zeros(natoms, dtype=np.int32)
+            atom_type_list[self.local_order] = self.lmp.numpy.extract_atom("type")[0:len(self.local_order)]
+        self.setupAtoms(atom_type_list)
+        self.saved_states = {}
+        self.saveState("initial")
+
+    def setupPlayback(self, path):
+        print("Opening trajectory...")
+        self.playback = open_trajectory(path)
+        self.allocateAtoms(self.playback.natoms, getattr(self.playback, "ids", None))
+        self.periodicity = self.playback.periodicity
+        self.createThermoHistory(self.playback.thermo_keys)
+        self.thermo_capture = None
+        self.playback_frame = -1
+        frame = self.playback.read_frame(0)
+        self.cell, self.boxlo = frame.cell.copy(), frame.boxlo.copy()
+        self.x[:] = frame.x
+        self.setupAtoms(self.playback.types)
+        self.seekFrame(0)
+
+    def allocateAtoms(self, natoms, ids=None):
+        # Per-atom buffers are in atom ID order and allocated once per setup. run_single
+        # scatters into them instead of allocating new arrays every step. Without ids the
+        # IDs are 1..natoms.
+        self.atom_ids = np.arange(1, natoms + 1) if ids is None else np.sort(np.asarray(ids, dtype=np.int64))
+        # IDs with gaps (e.g. after delete_atoms) are looked up instead of used as row + 1
+        self.contiguous_ids = natoms == 0 or self.atom_ids[-1] == natoms
+        self.x = np.zeros((natoms, 3))
+        self.x_old = np.zeros((natoms, 3))
+        self.ix = np.zeros((natoms, 3), dtype=np.int32)
+        self.ix_old = np.zeros((natoms, 3), dtype=np.int32)
+        self.xu = np.zeros((natoms, 3))
+        # Step of the positions in x, and the time per step for anything plotted over time.
+        # Recordings have no time step, their time is counted in frames.
+        self.step = 0
+        self.dt = 1.0
+        self.time_unit = "frames"
+        # Per-atom property coloring, off (colors by type) until set_coloring is called
+        colormap = self.coloring.colormap if hasattr(self, "coloring") else "viridis"
+        self.coloring = AtomColoring(natoms, colormap)
+        # Unwrapped coordinates are only gathered when something consumes them
+        self.track_unwrapped = False
+        self.timestep = 1
+        self.tStop = 1
+        self.pStop = 0
+        self.bond_pairs = []
+        self.bond_neighbors = None
+        self.cutoff_cached = False
+        self.vertices = []
+        self.picker = AtomPicker()
+        self.select_atom(None)
+
+    def createThermoHistory(self, keywords):
+        # Turn keywords items into a dictionary of fixed-size histories
+        for history in self.sim_info.values():
+            history.close()
         self.sim_info = {}
         for keyword in keywords:
-            self.sim_info[keyword.upper()] = []
+            spill_path = None
+            if self.history_dir is not None:
+                spill_path = os.path.join(self.history_dir, f"{keyword.upper()}.f64")
+            self.sim_info[keyword.upper()] = RingBuffer(self.info_size, spill_path)
 
-        # Setup atoms
-        self.atom_count = self.lmp.get_natoms()
-        self.atoms = []
+    def setupAtoms(self, atom_type_list):
+        self.atom_count = len(atom_type_list)
         self.type_to_symbol = {1: "C"}
         # Add templates for different atoms. Add more or change values depending on amount of atoms in simulation
         self.atom_types = {"C": {"color": [0.1, 0.1, 0.1, 1], "scale": [0.2, 0.2, 0.2]},
                            2: {"color": [0.0, 0.0, 0.9, 1], "scale": [0.15, 0.15, 0.15]}}
         self.atom_bond_cutoffs = {"C": 1.85}
-        self.atom_type_list = self.lmp.numpy.extract_atom("type")[0:len(self.atom_ids)]
-        self.atom_symbols = [self.type_to_symbol[t] for t in self.atom_type_list]
+        self.atom_type_list = atom_type_list
+        self.atom_symbols = [self.type_to_symbol.get(t, t) for t in self.atom_type_list]
+        self.buildAtomAppearance()
         self.createAtomsTask()
 
     def createAtomsTask(self):
         print("Creating atoms...")
-        for atom_id in self.atom_ids:
-            # Load atom model. If simulation has a lot of atoms or needs to run very quickly
-            # change the model to a lower poly version, which can be found online. Any .egg file should work.
-            atom = self.loader.loadModel('../models/Sphere.egg')
-            # Reparent to render (important to do this so the model can be rendered)'
-            atom.reparentTo(self.render)
-            if self.atom_symbols[atom_id - 1] in self.atom_types.keys():
-                atom.setColor(self.atom_types[self.atom_symbols[atom_id - 1]]["color"][0],
-                              self.atom_types[self.atom_symbols[atom_id - 1]]["color"][1],
-                              self.atom_types[self.atom_symbols[atom_id - 1]]["color"][2], 1)
-                atom.setScale(self.atom_types[self.atom_symbols[atom_id - 1]]["scale"][0],
-                              self.atom_types[self.atom_symbols[atom_id - 1]]["scale"][1],
-                              self.atom_types[self.atom_symbols[atom_id - 1]]["scale"][2])
-            # Give atoms random positions
-            atom.setPos(self.x[atom_id - 1][0], self.x[atom_id - 1][1], self.x[atom_id - 1][2])
-            # Add atoms to a list, so they can be easily accessed later
-            self.atoms.append(atom)
+        # The sphere meshes are loaded once and shared. Every atom is an instance of the
+        # high poly, standard or low poly mesh depending on how large it is on screen.
+        meshes = load_atom_meshes(self.loader)
+        if self.atom_layer is not None:
+            self.atom_layer.remove()
+        if self.atom_style == "impostors":
+            low, high = meshes[InstancedAtoms.STANDARD].get_tight_bounds()
+            self.atom_layer = ImpostorAtoms(self.render, max(high - low) / 2, len(self.atom_ids))
+        else:
+            self.atom_layer = InstancedAtoms(self.render, meshes, len(self.atom_ids))
+            self.atom_layer.detail = self.atom_detail
+        self.atom_layer.set_colors(self.coloring.colors if self.coloring.ready else self.atom_colors)
+        self.atom_layer.set_scales(self.atom_scales)
+        self.atom_layer.update_positions(self.x)
+        if not self.show_atoms:
+            self.atom_layer.hide()
+        self.redraw.invalidate("atoms")
         return Task.done
 
+    def set_atom_style(self, style):
+        # Rebuild the atom layer with the other renderer, the per-atom data is the same
+        if style != self.atom_style:
+            self.atom_style = style
+            self.createAtomsTask()
+
+    def set_atom_detail(self, detail):
+        self.atom_detail = detail
+        if self.atom_layer is not None:
+            self.atom_layer.detail = detail
+        self.redraw.invalidate("detail")
+
+    def buildAtomAppearance(self):
+        # Look up color and scale per atom type once, then spread them to every atom with a
+        # single fancy-indexing operation
+        types = np.unique(self.atom_type_list)
+        colors = np.ones((types.max() + 1, 4), dtype=np.float32)
+        scales = np.ones((types.max() + 1, 3), dtype=np.float32)
+        for t in types:
+            symbol = self.type_to_symbol.get(t, t)
+            if symbol in self.atom_types.keys():
+                colors[t] = self.atom_types[symbol]["color"]
+                scales[t] = self.atom_types[symbol]["scale"]
+        self.atom_colors = colors[self.atom_type_list]
+        self.atom_scales = scales[self.atom_type_list]
+
+    def bondCutoffs(self):
+        # Bond cutoff of every atom, looked up once per type. Types without an entry in
+        # atom_bond_cutoffs (e.g. from a file with more types) use the largest cutoff.
+        default = max(self.atom_bond_cutoffs.values())
+        types = np.unique(self.atom_type_list)
+        cutoffs = np.full(types.max() + 1, default)
+        for t in types:
+            cutoffs[t] = self.atom_bond_cutoffs.get(self.type_to_symbol.get(t, t), default)
+        return cutoffs[self.atom_type_list]
+
     def drawSimulationBoxTask(self):
         # print("Drawing simulation box...")
         if self.box_path != 0:
@@ -181,6 +377,8 @@ class OffscreenPanda(ShowBase):
         node = self.lines.create()
         self.box_path = NodePath(node)
         self.box_path.reparentTo(render)
+        self.box_cell = self.cell.copy()
+        self.redraw.invalidate("box")
 
         return Task.done
 
@@ -188,17 +386,83 @@ class OffscreenPanda(ShowBase):
         # print("Drawing bonds...")
         calcAtomPairs(self)
         create_bond_geometry(self)
+        self.bonds_version = self.redraw.atoms_version
+        self.redraw.invalidate("bonds")
+        return Task.done
+
+    def updateSceneTask(self):
+        # Rebuild the box and the bonds only if the cell or the atoms changed since they
+        # were drawn, hidden ones are rebuilt once they are shown again
+        if self.show_box and (self.box_path == 0 or not np.array_equal(self.cell, self.box_cell)):
+            self.drawSimulationBoxTask()
+        self.profiler.lap("box")
+        if self.show_bonds and self.bonds_version != self.redraw.atoms_version:
+            self.drawBondsTask()
+        self.profiler.lap("bonds")
         return Task.done
 
 
     def moveAtomsTask(self):
         # print("Moving atoms...")
-        if not self.paused:
+        moved = False
+        if self.engine_error is not None:
+            # Resumed after the engine thread failed, LAMMPS goes to a new one
+            self.engine_error = None
+            self.startEngine()
+        if self.engine is not None:
+            if self.consumeSnapshot():
+                self.atom_layer.update_positions(self.x)
+                if self.coloring.active:
+                    self.atom_layer.set_colors(self.coloring.colorize())
+                moved = True
+        elif self.playback is not None:
+            if not self.paused:
+                frame = self.playback_frame
+                self.advancePlayback(int(self.timestep))
+                moved = self.playback_frame != frame
+        elif not self.paused:
             self.run_single()
-            for i in range(self.atom_count):
-                self.atoms[i].setPos(self.x[i][0], self.x[i][1], self.x[i][2])
+            self.atom_layer.update_positions(self.x)
+            if self.coloring.active:
+                self.updateColors()
+            moved = True
+        if moved:
+            self.redraw.invalidate("atoms")
+        if moved and self.analysis is not None:
+            self.submitAnalysis()
+        self.profiler.lap("atoms")
         return Task.done
 
+    def startAnalysis(self, **options):
+        # Options go to analysis.AnalysisPipeline (workers, r_max, msd_origin_every, ...)
+        self.stopAnalysis()
+        cutoffs = self.bondCutoffs()
+        masses = None
+        # Recordings carry image flags instead of unwrapped coordinates
+        self.track_unwrapped = self.playback is None
+        if self.track_unwrapped:
+            # The engine thread owns LAMMPS, it is stopped while the first frame is read
+            threaded = self.engine is not None
+            self.stopEngine()
+            type_masses = self.lmp.numpy.extract_atom("mass")
+            if type_masses is not None:
+                masses = type_masses[self.atom_type_list]
+            self.gatherAtoms(self.x, self.ix, self.xu)
+            if threaded:
+                self.startEngine()
+        self.analysis = AnalysisPipeline(self.atom_type_list, cutoffs, self.cell, dt=self.dt, masses=masses,
+                                         **options)
+        self.submitAnalysis()
+
+    def stopAnalysis(self):
+        if self.analysis is not None:
+            self.analysis.close()
+            self.analysis = None
+        self.track_unwrapped = False
+
+    def submitAnalysis(self):
+        xu = self.xu if self.track_unwrapped else self.x + self.ix @ self.cell
+        self.analysis.submit(self.step, self.x, xu, self.cell, self.boxlo, self.periodicity)
 
     def center_camera(self):
         # Return a list of (x, y, z) vertices from a LineSegs-created Geom
@@ -227,40 +491,237 @@ class OffscreenPanda(ShowBase):
 
     def run_single(self):
         # print("Running single...")
-        # store old values for reference
-        self.x_old = self.x.copy()
-        self.ix_old = self.ix.copy()
-        self.xu_old = self.xu.copy()
-
-        # Run single timestep and get ids and coords of atoms
-        self.lmp.command(f"run {self.timestep:.0f}")
+        # Run the scheduled number of steps and get ids and coords of atoms
+        self.scheduler.run(self.lmp, self.timestep)
+        self.step = int(self.lmp.extract_global("ntimestep"))
+        self.profiler.lap("md_step")
 
         # Store thermo info for graphing
-        extractThermo(self)
+        thermo_rows = extractThermo(self)
+        self.profiler.lap("thermo")
+
+        self.cell, self.boxlo, self.periodicity = self.readBox()
 
+        self.extractAtoms()
+        self.recordFrame(self.x, self.ix, self.cell, self.boxlo, thermo_rows)
+
+    def readBox(self):
         boxlo, boxhi, xy, yz, xz, periodicity, box_change = self.lmp.extract_box()
         cell = np.zeros((3,3))
         np.fill_diagonal(cell, np.array(boxhi)-np.array(boxlo))
         cell[1,0] = xy
         cell[2,0] = xz
         cell[2,1] = yz
-        self.cell = cell
-
-        atom_ids = self.lmp.numpy.extract_atom("id")[0:len(self.atom_ids)] # migudo
-        x = self.lmp.numpy.extract_atom("x")
-        ix = self.lmp.numpy.extract_compute("compute_ix", LMP_STYLE_ATOM, LMP_TYPE_ARRAY)
-        xu = self.lmp.numpy.extract_compute("compute_xu", LMP_STYLE_ATOM, LMP_TYPE_ARRAY)
-
-        x_sorted = np.zeros(x.shape)
-        ix_sorted = np.zeros(ix.shape)
-        xu_sorted = np.zeros(xu.shape)
-        # TODO: Remove loop (use numpy array methods)
-        for i in range(len(atom_ids)):
-            x = self.lmp.numpy.extract_atom("x")[0:len(self.atom_ids)] # migudo
-            ix_sorted[atom_ids[i]-1, :] = ix[i, :]
-            xu_sorted[atom_ids[i]-1, :] = xu[i, :]
-        self.x = x
-        self.ix = ix_sorted
+        return cell, np.array(boxlo), np.array(periodicity, dtype=bool)
+
+    def extractAtoms(self):
+        # The previous step's buffers are swapped in as the new targets, so the old values
+        # are kept for reference without copying them.
+        self.x_old, self.x = self.x, self.x_old
+        self.ix_old, self.ix = self.ix, self.ix_old
+        self.gatherAtoms(self.x, self.ix, self.xu if self.track_unwrapped else None)
+
+    def gatherAtoms(self, x, ix, xu=None):
+        # LAMMPS stores atoms in local (spatially sorted) order. Reorder them by ID with one
+        # scatter per array into the given preallocated buffers.
+        if self.parallel:
+            # Other ranks own part of the atoms, LAMMPS collects them already in ID order
+            x[:] = self.lmp.gather("x", 3)
+            ix[:] = self.lmp.gather("c_compute_ix", 3)
+            if xu is not None:
+                xu[:] = self.lmp.gather("c_compute_xu", 3)
+            return
+        self.local_order = self.localRows()
+        nlocal = len(self.local_order)
+        x[self.local_order] = self.lmp.numpy.extract_atom("x")[0:nlocal]
+        ix[self.local_order] = self.lmp.numpy.extract_compute("compute_ix", LMP_STYLE_ATOM, LMP_TYPE_ARRAY)[0:nlocal]
+        if xu is not None:
+            xu[self.local_order] = self.lmp.numpy.extract_compute("compute_xu", LMP_STYLE_ATOM, LMP_TYPE_ARRAY)[0:nlocal]
+
+    def localRows(self):
+        # Row of every local LAMMPS atom in the ID ordered buffers
+        ids = self.lmp.numpy.extract_atom("id")[0:self.lmp.extract_global("nlocal")]
+        if self.contiguous_ids:
+            return ids - 1
+        return np.searchsorted(self.atom_ids, ids)
+
+    def gatherValues(self, out=None):
+        # Current values of the coloring source in atom ID order
+        return self.coloring.gather(self.lmp, None if self.parallel else self.local_order, out)
+
+    def updateColors(self):
+        self.gatherValues()
+        self.atom_layer.set_colors(self.coloring.colorize())
+        self.redraw.invalidate("colors")
+
+    def set_coloring(self, source, colormap=None, vmin=None, vmax=None):
+        # Color atoms by a preset of coloring.PRESETS ("type", "ke", "displacement", ...) or
+        # any per-atom value spec understood by coloring.AtomColoring ("c_ID[2]", "v_name",
+        # "vx", ...). vmin/vmax fix the color range, otherwise it follows the values.
+        if colormap is not None:
+            self.coloring.set_colormap(colormap)
+        self.redraw.invalidate("colors")
+        if source is None or source == "type":
+            self.coloring.set_source(None)
+            self.atom_layer.set_colors(self.atom_colors)
+            return
+        if self.playback is not None:
+            raise ValueError("Recorded trajectories can only be colored by type")
+        label, spec, compute_id, command = PRESETS.get(source, (source, source, None, None))
+        # The engine thread owns LAMMPS, the compute is created and read with it stopped
+        threaded = self.engine is not None
+        self.stopEngine()
+        try:
+            created = False
+            if compute_id is not None and not self.lmp.has_id("compute", compute_id):
+                cutoff = max(self.atom_bond_cutoffs.values())
+                self.lmp.command(command.format(cutoff=cutoff, neighbors=self.centro_neighbors))
+                self.scheduler.invalidate()
+                created = True
+            self.coloring.check(self.lmp, spec)
+            self.coloring.set_source(spec, vmin, vmax)
+            # A new compute has no values before the next run sets it up, the atoms keep
+            # their colors until then
+            if not created:
+                try:
+                    self.updateColors()
+                except Exception:
+                    self.coloring.set_source(None)
+                    self.atom_layer.set_colors(self.atom_colors)
+                    raise
+        finally:
+            if threaded:
+                self.startEngine()
+
+    def advancePlayback(self, frames):
+        # Step forward through the recording, keeping the thermo rows of skipped frames
+        last = min(self.playback_frame + frames, self.playback.n_frames - 1)
+        for i in range(self.playback_frame + 1, last):
+            storeThermo(self, self.playback.thermo_keys, self.playback.thermo(i))
+        if last > self.playback_frame:
+            self.seekFrame(last)
+
+    def seekFrame(self, i):
+        # Show recorded frame i. Anything but the next frame starts a fresh thermo history.
+        frame = self.playback.read_frame(i)
+        if i != self.playback_frame + 1:
+            for history in self.sim_info.values():
+                history.clear()
+        storeThermo(self, self.playback.thermo_keys, frame.thermo)
+        self.x_old, self.x = self.x, self.x_old
+        self.x[:] = frame.x
+        self.ix[:] = frame.ix
+        self.cell = frame.cell.copy()
+        self.boxlo = frame.boxlo.copy()
+        self.playback_frame = i
+        self.step = i
+        self.atom_layer.update_positions(self.x)
+        self.redraw.invalidate("atoms")
+
+    def saveState(self, name=None):
+        # The engine thread owns LAMMPS while it runs, so it is paused around the capture.
+        # Without a name the state is named after its step.
+        threaded = self.engine is not None
+        self.stopEngine()
+        state = SavedState(name, self)
+        self.saved_states[state.name] = state
+        if threaded:
+            self.startEngine()
+        return state
+
+    def restoreState(self, name):
+        # Put LAMMPS back into a saved state and show it. The scene graph is reused as is,
+        # only the per-atom buffers, box and bond list are refreshed.
+        threaded = self.engine is not None
+        self.stopEngine()
+        state = self.saved_states[name]
+        # Captured thermo rows are counted from the fix's first step, so it starts over at the
+        # restored step
+        self.thermo_capture.stop()
+        state.restore(self)
+        self.thermo_capture.start()
+        self.scheduler.invalidate()
+        for history in self.sim_info.values():
+            history.clear()
+        self.x[:] = state.x
+        self.ix[:] = state.ix
+        self.cell, self.boxlo, self.periodicity = self.readBox()
+        self.step = int(self.lmp.extract_global("ntimestep"))
+        if self.analysis is not None:
+            self.analysis.reset()
+        self.cutoff_cached = False
+        self.atom_layer.update_positions(self.x)
+        self.redraw.invalidate("atoms")
+        if threaded:
+            self.startEngine()
+
+    def startRecording(self, path):
+        self.recorder = TrajectoryWriter(path, self.atom_type_list, self.thermo_capture.keys, self.periodicity)
+
+    def stopRecording(self):
+        if self.recorder is not None:
+            recorder, self.recorder = self.recorder, None
+            try:
+                recorder.close()
+            except Exception as e:
+                self.recording_error = e
+                print(f"Recording to {recorder.path} failed: {e}")
+
+    def recordFrame(self, x, ix, cell, boxlo, thermo_rows):
+        # A recording that fails (disk full, ...) is stopped, the simulation goes on
+        recorder = self.recorder
+        if recorder is None:
+            return
+        try:
+            recorder.write(x, ix, cell, boxlo, thermo_rows)
+        except Exception as e:
+            self.recording_error = e
+            self.stopRecording()
+
+    def startEngine(self):
+        # Hand LAMMPS over to a background thread. From here on the render side only
+        # consumes the snapshots it publishes.
+        self.engine = SimulationEngine(self)
+        self.engine.start()
+
+    def stopEngine(self):
+        if self.engine is not None:
+            self.engine.stop()
+            self.engine = None
+
+    def lammpsCommand(self, cmd):
+        # Route commands through the engine thread when it owns the LAMMPS instance
+        if self.engine is not None:
+            self.engine.command(cmd)
+        else:
+            self.lmp.command(cmd)
+            self.scheduler.invalidate()
+
+    def consumeSnapshot(self):
+        # Copy the newest complete engine snapshot into the render-side buffers
+        while not self.engine.thermo.empty():
+            storeThermo(self, self.thermo_capture.keys, self.engine.thermo.get())
+        self.profiler.lap("thermo")
+        snap = self.engine.buffer.latest()
+        if snap is None:
+            if self.engine.error is not None:
+                # The last snapshots are shown, then the simulation is paused on the error
+                self.engine_error = self.engine.error
+                self.stopEngine()
+                self.paused = True
+                print(f"Simulation paused, LAMMPS failed: {self.engine_error}")
+            return False
+        self.x_old, self.x = self.x, self.x_old
+        np.copyto(self.x, snap.x)
+        np.copyto(self.ix, snap.ix)
+        if self.track_unwrapped:
+            np.copyto(self.xu, snap.xu)
+        self.step = int(snap.step)
+        if snap.colored:
+            np.copyto(self.coloring.values, snap.values)
+        self.cell = snap.cell.copy()
+        self.boxlo = snap.boxlo.copy()
+        return True
 
     def rotate_camera(self, dx, dy):
         # Update heading/pitch of pivot
@@ -268,11 +729,21 @@ class OffscreenPanda(ShowBase):
         p = self.cam_pivot.get_p() + dy * 0.2
         p = max(-85, min(85, p))
         self.cam_pivot.set_hpr(h, p, 0)
+        self.redraw.interact()
+
+    def set_camera(self, heading, pitch, distance, pivot=None):
+        # Place the orbit camera directly, e.g. from a scripted camera path
+        self.cam_pivot.set_hpr(heading, max(-85, min(85, pitch)), 0)
+        self.cam_distance = distance
+        self.cam2.set_y(-self.cam_distance)
+        if pivot is not None:
+            self.cam_pivot.set_pos(pivot[0], pivot[1], pivot[2])
 
     def zoom_camera(self, delta):
         # Zoom by changing distance from pivot
         self.cam_distance = self.cam_distance - delta
         self.cam2.set_y(-self.cam_distance)
+        self.redraw.interact()
 
     def pan_camera(self, dx, dy):
         # Pan the pivot in camera space (middle mouse drag).
@@ -285,20 +756,166 @@ class OffscreenPanda(ShowBase):
         move = (right * (-dx * speed)) + (up * (dy * speed))
         # Apply to pivot
         self.cam_pivot.set_pos(self.cam_pivot.get_pos() + move)
-
-    def render_frame_to_qimage(self):
+        self.redraw.interact()
+
+    def pick_atom(self, fx, fy):
+        # Select the atom under film coordinates (fx, fy), -1..1 from the left/bottom edge
+        # of the image to the right/top. Returns its row in the ID ordered buffers
+        # (self.atom_ids[index] is its ID) or None.
+        index = None
+        near, far = Point3(), Point3()
+        if self.show_atoms and self.cam2.node().get_lens().extrude(Point2(fx, fy), near, far):
+            origin = self.render.get_relative_point(self.cam2, near)
+            target = self.render.get_relative_point(self.cam2, far)
+            index = self.picker.pick(self.x, self.atom_layer.radii, origin, target - origin)
+        self.select_atom(index)
+        return index
+
+    def select_atom(self, index):
+        # Highlight atom index with a translucent shell, None clears the selection
+        self.selected_atom = index
+        self.redraw.invalidate("selection")
+        if index is None:
+            if self.selection_path is not None:
+                self.selection_path.hide()
+            return
+        if self.selection_path is None:
+            mesh = load_atom_meshes(self.loader)[InstancedAtoms.STANDARD]
+            self.selection_path = mesh.copy_to(self.render)
+            self.selection_path.set_color(1.0, 0.85, 0.0, 0.45)
+            self.selection_path.set_transparency(TransparencyAttrib.M_alpha)
+            self.selection_path.set_depth_write(False)
+            # Flat unlit color, the auto shader isn't needed
+            self.selection_path.set_light_off()
+            self.selection_path.set_shader_off()
+            self.selection_path.set_bin("transparent", 0)
+        radius = self.atom_layer.radii[index] / self.atom_layer.mesh_radius
+        self.selection_path.set_scale(1.4 * radius)
+        self.selection_path.show()
+        self.updateSelection()
+
+    def updateSelection(self):
+        # Keep the highlight on the selected atom as it moves
+        if self.selected_atom is not None:
+            self.selection_path.set_pos(*self.x[self.selected_atom])
+
+    def atom_properties(self, index):
+        # (name, value) rows describing atom index for the property panel
+        t = self.atom_type_list[index]
+        x, ix = self.x[index], self.ix[index]
+        rows = [("ID", str(self.atom_ids[index])),
+                ("Type", f"{t} ({self.type_to_symbol[t]})" if t in self.type_to_symbol else str(t)),
+                ("Position", "{:.3f} {:.3f} {:.3f}".format(*x)),
+                ("Image", "{} {} {}".format(*ix)),
+                ("Unwrapped", "{:.3f} {:.3f} {:.3f}".format(*(x + ix @ self.cell)))]
+        if self.coloring.active:
+            source = next((label for label, spec, *_ in PRESETS.values() if spec == self.coloring.spec),
+                          self.coloring.spec)
+            rows.append((source, f"{self.coloring.values[index]:.6g}"))
+        if self.playback is not None:
+            rows.append(("Frame", str(self.playback_frame)))
+        else:
+            rows.append(("Step", str(self.step)))
+        return rows
+
+    def set_render_scale(self, scale):
+        # Resize the offscreen buffer to scale times W x H. The textures it is copied to
+        # follow its size.
+        if scale != self.render_scale:
+            self.render_scale = scale
+            self.buf.set_size(max(1, round(self.W * scale)), max(1, round(self.H * scale)))
+
+    def next_render_scale(self):
+        # Resolution scale the view has to be rendered at, None if it is up to date
+        return self.redraw.next_frame(self.cam2.get_mat(self.render))
+
+    def render_frame_to_ram(self, scale=1.0):
+        # Render and return the RAM image of the newest finished frame. RTMCopyRam already
+        # copies the frame into the texture's RAM image while drawing, so no extra
+        # extract_texture_data round trip is needed. With scale < 1 a smaller image of
+        # frame_size is drawn.
+        start = time.perf_counter()
+        self.set_render_scale(scale)
+        if self.atom_layer is not None:
+            # Cheaper meshes at reduced resolution, the atoms are smaller in pixels
+            self.atom_layer.update_lod(self.x, self.cam2, self.cam_fov, self.H * scale)
+        self.updateSelection()
+        self.profiler.lap("atoms")
+        slot = self.draw_frame(start)
+        self.redraw.rendered(scale, self.cam2.get_mat(self.render))
+        self.profiler.lap("render")
+
+        ready = slot
+        if self.pipelined_readback:
+            finished = self.frame_index - self.pipeline_depth - 2
+            if finished < 0:
+                # First frames: nothing older to show yet, so wait for this one
+                return self.finish_frame_to_ram()
+            ready = finished % len(self.readback_textures)
+            self.readback_pending = True
+        return self.read_frame(ready)
+
+    def draw_frame(self, start):
+        # Hand the next frame to the pipeline, returns the readback slot it is copied to
+        slot = self.frame_index % len(self.readback_textures)
+        if self.pipelined_readback:
+            self.buf.clear_render_textures()
+            self.buf.add_render_texture(self.readback_textures[slot], GraphicsOutput.RTMCopyRam,
+                                        GraphicsOutput.RTPColor)
+        self.readback_started[slot] = start
+        self.graphicsEngine.render_frame()
+        # Every drawn frame is copied from the frame buffer into the slot's RAM image
+        self.profiler.count("gpu_copies")
+        self.frame_index += 1
+        return slot
+
+    def finish_frame_to_ram(self):
+        # Push the newest frame through the rest of the threaded pipeline with copies of the
+        # same view, wait for it and return its RAM image. Used when nothing is rendered
+        # after it, e.g. once the view stops changing.
+        newest = (self.frame_index - 1) % len(self.readback_textures)
+        for i in range(self.pipeline_depth):
+            self.draw_frame(self.readback_started[newest])
+        self.graphicsEngine.sync_frame()
+        self.readback_pending = False
+        return self.read_frame(newest)
+
+    def read_frame(self, ready):
+        # Keep a reference so the buffer stays alive while Qt or NumPy views point into it
+        texture = self.readback_textures[ready]
+        self.ram_image = texture.get_ram_image()
+        self.frame_size = (texture.get_x_size(), texture.get_y_size())
+
+        self.profiler.measure("readback_latency_ms", 1000 * (time.perf_counter() - self.readback_started[ready]))
+        self.profiler.lap("readback")
+        return self.ram_image
+
+    def render_frame_to_qimage(self, scale=1.0):
         # 1) Advance spin
         now = self.taskMgr.globalClock.get_frame_time()
         dt  = now - self._prev
         self._prev = now
 
-        # 2) Render & extract
-        self.graphicsEngine.render_frame()
-        self.graphicsEngine.extract_texture_data(self.tex, self.win.get_gsg())
-
-        # 3) Grab bytes and wrap in QImage
-        ram = self.tex.get_ram_image()
-        raw = ram.get_data()   # RGBA8
-        bpl = 4 * self.W
-        img = QtGui.QImage(raw, self.W, self.H, bpl, QtGui.QImage.Format.Format_RGBA8888)
-        return img.mirrored(False, True)
\ No newline at end of file
+        # 2) Render & wrap the RAM image in a QImage without copying it
+        return self.frame_to_qimage(self.render_frame_to_ram(scale))
+
+    def frame_to_qimage(self, ram):
+        # Panda stores the image bottom-up in BGRA byte order (RGB32 on little endian
+        # machines). The PandaLabel draws it flipped instead of this making a mirrored copy.
+        w, h = self.frame_size
+        bpl = 4 * w
+        return QtGui.QImage(memoryview(ram), w, h, bpl, QtGui.QImage.Format.Format_RGB32)
+
+    def render_frame_to_array(self, scale=1.0, wait=False):
+        # Render & extract without Qt. With wait the frame just set up is returned even from a
+        # threaded pipeline, otherwise the newest finished one.
+        ram = self.render_frame_to_ram(scale)
+        if wait and self.readback_pending:
+            ram = self.finish_frame_to_ram()
+        return self.frame_to_array(ram)
+
+    def frame_to_array(self, ram):
+        # The frame as an (h, w, 4) uint8 BGRA view of the RAM image (Panda's byte order),
+        # top row first
+        w, h = self.frame_size
+        return np.frombuffer(memoryview(ram), dtype=np.uint8).reshape(h, w, 4)[::-1]
@@ -3,18 +3,64 @@ from panda import OffscreenPanda
 
 
 class PandaLabel(QtWidgets.QLabel):
-    """A QLabel that forwards left-drag deltas to OffscreenPanda.rotate_camera."""
+    """A QLabel that forwards left-drag deltas to OffscreenPanda.rotate_camera.
+
+    A left click that doesn't move further than the drag distance picks the atom under the
+    cursor instead and emits atomPicked with its index, or None for empty space.
+    """
+    atomPicked = QtCore.pyqtSignal(object)
+
     def __init__(self, panda: OffscreenPanda, parent=None):
         super().__init__(parent)
         self.panda = panda
         self.setMouseTracking(True)
         self._last = None
+        self._press = None
         self._middle_last = None
+        self.frame = None
+
+    def set_frame(self, img: QtGui.QImage):
+        # The image points straight into Panda's RAM image, so it is only drawn, never copied
+        self.frame = img
+        self.update()
 
+    def paintEvent(self, ev: QtGui.QPaintEvent):
+        if self.frame is None:
+            super().paintEvent(ev)
+            return
+        painter = QtGui.QPainter(self)
+        x0, y0 = self.image_origin()
+        # Panda's image is stored bottom-up. Flip while drawing instead of mirroring a copy.
+        painter.translate(x0, y0 + self.panda.H)
+        painter.scale(1, -1)
+        painter.drawImage(QtCore.QRectF(0, 0, self.panda.W, self.panda.H), self.frame)
+        if self.panda.profiler.overlay:
+            painter.resetTransform()
+            self.draw_timings(painter, x0, y0)
+        painter.end()
+
+    def image_origin(self):
+        # Top left corner of the centered image in widget coordinates
+        return (self.width() - self.panda.W) // 2, (self.height() - self.panda.H) // 2
+
+    def draw_timings(self, painter, x0, y0):
+        # Frame time breakdown in the top left corner of the image
+        lines = self.panda.profiler.overlay_lines()
+        font = QtGui.QFont("monospace", 9)
+        font.setStyleHint(QtGui.QFont.StyleHint.Monospace)
+        painter.setFont(font)
+        metrics = painter.fontMetrics()
+        height = metrics.height()
+        width = max(metrics.horizontalAdvance(line) for line in lines)
+        painter.fillRect(x0 + 4, y0 + 4, width + 12, height * len(lines) + 8, QtGui.QColor(0, 0, 0, 160))
+        painter.setPen(QtGui.QColor(255, 255, 255))
+        for i, line in enumerate(lines):
+            painter.drawText(x0 + 10, y0 + 8 + metrics.ascent() + i * height, line)
 
     def mousePressEvent(self, ev: QtGui.QMouseEvent):
         if ev.buttons() & QtCore.Qt.MouseButton.LeftButton:
             self._last = ev.position()
+            self._press = ev.position()
         if ev.buttons() & QtCore.Qt.MouseButton.MiddleButton:
             self._middle_last = ev.position()
 
@@ -37,9 +83,23 @@ class PandaLabel(QtWidgets.QLabel):
 
 
     def mouseReleaseEvent(self, ev: QtGui.QMouseEvent):
+        if ev.button() == QtCore.Qt.MouseButton.LeftButton and self._press is not None:
+            moved = (ev.position() - self._press).manhattanLength()
+            if moved < QtWidgets.QApplication.startDragDistance():
+                self.pick(ev.position())
         self._last = None
+        self._press = None
         self._middle_last = None
 
+    def pick(self, pos):
+        # Widget position to film coordinates, -1..1 across the image with y pointing up
+        x0, y0 = self.image_origin()
+        fx = 2 * (pos.x() - x0) / self.panda.W - 1
+        fy = 1 - 2 * (pos.y() - y0) / self.panda.H
+        if abs(fx) > 1 or abs(fy) > 1:
+            return
+        self.atomPicked.emit(self.panda.pick_atom(fx, fy))
+
 
     def wheelEvent(self, event: QtGui.QWheelEvent):
         delta = event.angleDelta().y() / 120  # 1 unit per notch
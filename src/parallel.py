@@ -0,0 +1,80 @@
+import numpy as np
+from lammps import lammps
+
+
+def lammps_args(omp_threads=0):
+    # Command line of every LAMMPS instance. With OpenMP threads the /omp variants of pair
+    # styles and fixes are used where they exist, the atoms all stay on one process.
+    args = ["-log", "none", "-screen", "none", "-nocite"]
+    if omp_threads > 0:
+        args += ["-sf", "omp", "-pk", "omp", str(omp_threads)]
+    return args
+
+
+def world():
+    from mpi4py import MPI
+    return MPI.COMM_WORLD
+
+
+class ParallelLammps:
+    """Rank 0 side of a LAMMPS instance spread over all MPI ranks.
+
+    Collective calls (commands, input files, gathers and scatters) are broadcast to the
+    worker ranks, which run the same call in worker_loop(). Everything else, like
+    extract_box, extract_fix or get_thermo("step"), only reads data rank 0 already has and
+    goes straight to the local instance. gather() and scatter() work on whole ID-ordered
+    arrays, so callers never see how the atoms are split between ranks.
+    """
+    def __init__(self, cmdargs):
+        self.comm = world()
+        self.lmp = lammps(cmdargs=cmdargs, comm=self.comm)
+        # gather/scatter by ID need an atom map, which has to exist before the box does
+        self.command("atom_modify map yes")
+
+    def collective(self, name, *args):
+        self.comm.bcast((name, args), root=0)
+        return getattr(self.lmp, name)(*args)
+
+    def command(self, cmd):
+        self.collective("command", cmd)
+
+    def file(self, path):
+        self.collective("file", path)
+
+    def gather(self, name, count, integer=False):
+        # Global (natoms, count) array in atom ID order. Works for per-atom properties and
+        # per-atom computes ("c_ID").
+        natoms = self.lmp.get_natoms()
+        data = self.collective("gather", name, 0 if integer else 1, count)
+        return np.ctypeslib.as_array(data).reshape(natoms, count) if count > 1 else np.ctypeslib.as_array(data)
+
+    def scatter(self, name, values, integer=False):
+        values = np.ascontiguousarray(values, dtype=np.int32 if integer else np.float64)
+        count = 1 if values.ndim == 1 else values.shape[1]
+        ctype = np.ctypeslib.as_ctypes(values.reshape(-1))
+        # Every rank picks its own atoms out of the full array, so the data goes along
+        self.comm.bcast(("scatter", (name, 0 if integer else 1, count, values)), root=0)
+        self.lmp.scatter(name, 0 if integer else 1, count, ctype)
+
+    def close(self):
+        self.comm.bcast(("close", ()), root=0)
+        self.lmp.close()
+
+    def __getattr__(self, name):
+        return getattr(self.lmp, name)
+
+
+def worker_loop(cmdargs):
+    # Ranks above 0 only mirror the collective calls of rank 0 until it closes LAMMPS
+    comm = world()
+    lmp = lammps(cmdargs=cmdargs, comm=comm)
+    while True:
+        name, args = comm.bcast(None, root=0)
+        if name == "close":
+            break
+        if name == "scatter":
+            name_, dtype, count, values = args
+            args = (name_, dtype, count, np.ctypeslib.as_ctypes(values.reshape(-1)))
+        getattr(lmp, name)(*args)
+    lmp.close()
+    return 0
@@ -0,0 +1,84 @@
+import numpy as np
+from scipy.spatial import cKDTree
+
+
+class AtomPicker:
+    """Finds the first atom hit by a ray without testing every atom.
+
+    The atom centers are kept in a KD-tree that is reused across frames. Atoms that moved
+    less than the skin since the tree was built are found by searching with the radius grown
+    by the skin. The few that moved further (e.g. wrapped through a periodic boundary) are
+    tested directly, until there are too many of them and the tree is rebuilt.
+    """
+    def __init__(self, skin=1.0, max_movers=1000):
+        self.skin = skin
+        self.max_movers = max_movers
+        self.tree = None
+        self.x_ref = None
+        self.builds = 0
+
+    def build(self, x):
+        # An unbalanced tree builds twice as fast and is queried only a few times
+        self.tree = cKDTree(x, balanced_tree=False, compact_nodes=False)
+        self.x_ref = x.copy()
+        self.builds += 1
+
+    def movers(self, x):
+        # Indices of the atoms that moved more than the skin since the build, None if the
+        # tree has to be rebuilt
+        if self.x_ref is None or len(self.x_ref) != len(x):
+            return None
+        d = x - self.x_ref
+        moved = np.flatnonzero(np.einsum("ij,ij->i", d, d) > self.skin ** 2)
+        if len(moved) > max(self.max_movers, len(x) // 100):
+            return None
+        return moved
+
+    def candidates(self, reach, origin, direction):
+        # Atoms whose reference position lies within reach of the ray inside the bounds of
+        # the atoms. The ray is sampled every 2 reach and all samples are queried at once.
+        lo = self.tree.mins - reach
+        hi = self.tree.maxes + reach
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t1 = (lo - origin) / direction
+            t2 = (hi - origin) / direction
+        t_near = np.nanmax(np.minimum(t1, t2))
+        t_far = np.nanmin(np.maximum(t1, t2))
+        if t_far < max(t_near, 0):
+            return np.empty(0, dtype=np.intp)
+        t_near = max(t_near, 0)
+        step = 2 * reach
+        t = np.arange(t_near, t_far + step, step)
+        # Every point within reach of the ray is within this distance of a sample
+        radius = np.sqrt(2) * reach
+        found = self.tree.query_ball_point(origin + t[:, None] * direction, radius, return_sorted=False)
+        if not any(len(f) for f in found):
+            return np.empty(0, dtype=np.intp)
+        return np.unique(np.concatenate([np.asarray(f, dtype=np.intp) for f in found]))
+
+    def pick(self, x, radii, origin, direction):
+        # Index of the nearest atom in front of origin whose sphere the ray hits, or None.
+        # radii are the drawn atom radii, direction doesn't need to be normalized.
+        if len(x) == 0:
+            return None
+        origin = np.asarray(origin, dtype=float)
+        direction = np.asarray(direction, dtype=float)
+        direction = direction / np.linalg.norm(direction)
+        moved = self.movers(x)
+        if moved is None:
+            self.build(x)
+            moved = np.empty(0, dtype=np.intp)
+        near = self.candidates(radii.max() + self.skin, origin, direction)
+        atoms = np.union1d(near, moved)
+        if len(atoms) == 0:
+            return None
+        # Exact ray-sphere intersection at the current positions
+        oc = x[atoms] - origin
+        along = oc @ direction
+        miss = np.einsum("ij,ij->i", oc, oc) - along ** 2
+        r2 = radii[atoms] ** 2
+        t = along - np.sqrt(np.maximum(r2 - miss, 0))
+        hit = (miss <= r2) & (t > 0)
+        if not hit.any():
+            return None
+        return int(atoms[hit][np.argmin(t[hit])])
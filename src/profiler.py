@@ -0,0 +1,178 @@
+import os
+import csv
+import json
+import time
+import ctypes
+import numpy as np
+from lammps import lammps
+
+# Stages of one frame in the order update_frame runs them
+STAGES = ["md_step", "thermo", "atoms", "render", "readback", "plotting", "box", "bonds"]
+MEMORY = ["rss_mb", "lammps_mb", "arrays_mb", "history_mb"]
+# Per-frame readback counters: frame buffer copies into RAM, CPU copies of the image and
+# the time from setting up the frame until its pixels could be read
+COUNTERS = ["gpu_copies", "cpu_copies", "readback_latency_ms"]
+
+
+def rss_mb():
+    # Resident set size from /proc, cheap enough to read every few frames
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 ** 2
+    except (OSError, ValueError):
+        return float("nan")
+
+
+def lammps_mb(lmp):
+    # Memory LAMMPS itself has allocated, as reported by the library. A ParallelLammps
+    # wraps the lammps object of rank 0, which only reports the memory of that rank.
+    if lmp is None:
+        return 0.0
+    while not isinstance(lmp, lammps):
+        lmp = lmp.lmp
+    meminfo = (ctypes.c_double * 3)()
+    lmp.lib.lammps_memory_usage(lmp.lmp, meminfo)
+    return meminfo[0]
+
+
+def arrays_mb(obj):
+    # NumPy arrays held directly by an object. Unlike debug.get_size this doesn't recurse,
+    # so it is cheap enough to run live.
+    return sum(v.nbytes for v in vars(obj).values() if isinstance(v, np.ndarray)) / 1024 ** 2
+
+
+class FrameProfiler:
+    """Lap timer for the stages of a frame, plus sampled memory counters.
+
+    lap() charges the time since the previous lap to a stage, count() and measure() set
+    the readback counters of the frame. When the profiler is disabled every call returns
+    immediately, so the hooks can stay in place.
+    """
+    def __init__(self, history=120, memory_every=30):
+        self.enabled = False
+        self.overlay = False
+        self.history = np.zeros((history, len(STAGES) + 1))  # stages + whole frame, in ms
+        self.counter_history = np.zeros((history, len(COUNTERS)))
+        self.frames = 0
+        self.memory_every = memory_every
+        self.memory = {key: 0.0 for key in MEMORY}
+        self.current = np.zeros(len(STAGES))
+        self.counters = np.zeros(len(COUNTERS))
+        self.index = {name: i for i, name in enumerate(STAGES)}
+        self.counter_index = {name: i for i, name in enumerate(COUNTERS)}
+        self.frame_start = 0.0
+        self.last = 0.0
+        self.export_file = None
+        self.export_writer = None
+
+    def begin_frame(self):
+        if not self.enabled:
+            return
+        self.current[:] = 0
+        self.counters[:] = 0
+        self.frame_start = self.last = time.perf_counter()
+
+    def lap(self, stage):
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        self.current[self.index[stage]] += now - self.last
+        self.last = now
+
+    def count(self, counter, n=1):
+        if self.enabled:
+            self.counters[self.counter_index[counter]] += n
+
+    def measure(self, counter, value):
+        if self.enabled:
+            self.counters[self.counter_index[counter]] = value
+
+    def end_frame(self, panda=None):
+        # Store the finished frame, sample memory every memory_every frames and stream
+        # the row to the export file
+        if not self.enabled:
+            return 0.0
+        total = time.perf_counter() - self.frame_start
+        row = self.history[self.frames % len(self.history)]
+        row[:-1] = 1000 * self.current
+        row[-1] = 1000 * total
+        counters = self.counter_history[self.frames % len(self.history)]
+        counters[:] = self.counters
+        sampled = panda is not None and self.frames % self.memory_every == 0
+        if sampled:
+            self.sample_memory(panda)
+        if self.export_writer is not None:
+            self.write_row(row, counters, sampled)
+        self.frames += 1
+        return total
+
+    def sample_memory(self, panda):
+        self.memory["rss_mb"] = rss_mb()
+        self.memory["lammps_mb"] = lammps_mb(panda.lmp)
+        self.memory["arrays_mb"] = arrays_mb(panda)
+        self.memory["history_mb"] = sum(h.data.nbytes for h in panda.sim_info.values()) / 1024 ** 2
+
+    def summary(self, frames=60):
+        # Mean milliseconds per stage (and "frame") over the last frames
+        n = min(self.frames, frames, len(self.history))
+        if n == 0:
+            return {}
+        rows = np.take(self.history, np.arange(self.frames - n, self.frames), axis=0, mode="wrap")
+        means = rows.mean(axis=0)
+        summary = {name: means[i] for i, name in enumerate(STAGES)}
+        summary["frame"] = means[-1]
+        return summary
+
+    def counter_summary(self, frames=60):
+        # Mean of every readback counter over the last frames
+        n = min(self.frames, frames, len(self.history))
+        if n == 0:
+            return {}
+        rows = np.take(self.counter_history, np.arange(self.frames - n, self.frames), axis=0, mode="wrap")
+        return dict(zip(COUNTERS, rows.mean(axis=0)))
+
+    def overlay_lines(self):
+        summary = self.summary()
+        if not summary:
+            return ["Collecting frame timings..."]
+        frame = summary.pop("frame")
+        lines = [f"frame {frame:6.1f} ms  ({1000 / max(frame, 1e-6):5.1f} fps)"]
+        lines += [f"{name:<9}{ms:6.1f} ms" for name, ms in summary.items()]
+        lines.append(f"{'other':<9}{frame - sum(summary.values()):6.1f} ms")
+        counters = self.counter_summary()
+        lines.append(f"copies {counters['gpu_copies']:.1f} GPU, {counters['cpu_copies']:.1f} CPU, "
+                     f"latency {counters['readback_latency_ms']:.1f} ms")
+        lines.append(f"rss {self.memory['rss_mb']:.0f} MB, lammps {self.memory['lammps_mb']:.0f} MB")
+        return lines
+
+    def start_export(self, path):
+        # Stream one row per frame to a .csv file, or JSON lines for any other extension
+        self.stop_export()
+        self.export_file = open(path, "w", newline="", buffering=1)
+        if path.lower().endswith(".csv"):
+            self.export_writer = csv.writer(self.export_file)
+            self.export_writer.writerow(["frame", "time"] + [f"{s}_ms" for s in STAGES] + ["frame_ms"] + COUNTERS + MEMORY)
+        else:
+            # JSON lines are written straight to the file
+            self.export_writer = self.export_file
+
+    def write_row(self, row, counters, sampled):
+        memory = [round(self.memory[key], 2) if sampled else None for key in MEMORY]
+        values = [round(v, 3) for v in row]
+        counters = [round(v, 3) for v in counters]
+        if self.export_writer is not self.export_file:
+            self.export_writer.writerow([self.frames, round(time.time(), 3)] + values + counters +
+                                        ["" if m is None else m for m in memory])
+        else:
+            record = {"frame": self.frames, "time": round(time.time(), 3)}
+            record.update({f"{s}_ms": v for s, v in zip(STAGES + ["frame"], values)})
+            record.update(zip(COUNTERS, counters))
+            if sampled:
+                record.update(dict(zip(MEMORY, memory)))
+            self.export_file.write(json.dumps(record) + "\n")
+
+    def stop_export(self):
+        if self.export_file is not None:
+            self.export_file.close()
+            self.export_file = None
+            self.export_writer = None
@@ -0,0 +1,56 @@
+import time
+
+
+class RedrawTracker:
+    """Decides when the view needs a new frame and at which resolution.
+
+    Whatever changes the picture marks the view dirty through invalidate(): new atom
+    positions, colors, visibility toggles or the selection. The camera is compared with
+    the transform of the last frame instead, so any way of moving it counts. Camera input
+    from the user calls interact(). Until the view has been idle for idle_delay seconds
+    frames are drawn at interactive_scale of the full resolution, then the last view is
+    drawn once more at full resolution.
+    """
+    def __init__(self, interactive_scale=0.5, idle_delay=0.25):
+        self.interactive_scale = interactive_scale
+        self.idle_delay = idle_delay
+        self.reasons = set()
+        # Camera matrix and resolution scale of the last frame, None before the first one
+        self.camera = None
+        self.scale = None
+        self.last_interaction = float("-inf")
+        # Bumped whenever the atoms moved, the bonds are rebuilt when it changes
+        self.atoms_version = 0
+        self.stats = {"frames": 0, "reduced": 0, "refined": 0, "skipped": 0}
+
+    def invalidate(self, reason="scene"):
+        self.reasons.add(reason)
+        if reason == "atoms":
+            self.atoms_version += 1
+
+    def interact(self):
+        self.last_interaction = time.perf_counter()
+
+    def interacting(self):
+        return time.perf_counter() - self.last_interaction < self.idle_delay
+
+    def next_frame(self, camera):
+        # Resolution scale for the next frame, or None if the frame on screen is up to date
+        if self.camera is None or camera != self.camera:
+            self.reasons.add("camera")
+        interacting = self.interacting()
+        if self.reasons:
+            return self.interactive_scale if interacting else 1.0
+        if self.scale != 1.0 and not interacting:
+            self.stats["refined"] += 1
+            return 1.0
+        self.stats["skipped"] += 1
+        return None
+
+    def rendered(self, scale, camera):
+        self.reasons.clear()
+        self.scale = scale
+        self.camera = type(camera)(camera)
+        self.stats["frames"] += 1
+        if scale != 1.0:
+            self.stats["reduced"] += 1
@@ -0,0 +1,83 @@
+import os
+import numpy as np
+
+
+class RingBuffer:
+    """Fixed-size NumPy history of a single quantity.
+
+    Appending overwrites the oldest samples, so memory and plotting cost stay constant no
+    matter how long the session runs. With a spill path the overwritten samples are
+    appended to a raw float64 file instead of being lost.
+    """
+    def __init__(self, size, spill_path=None):
+        self.data = np.zeros(size)
+        self.size = size
+        self.count = 0
+        self.spill_path = spill_path
+        self.spill_file = None
+        if spill_path is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(spill_path)), exist_ok=True)
+            self.spill_file = open(spill_path, "wb")
+
+    def __len__(self):
+        return min(self.count, self.size)
+
+    def extend(self, values):
+        values = np.asarray(values, dtype=float)
+        n = len(values)
+        if n == 0:
+            return
+        if self.spill_file is not None:
+            evicted = len(self) + n - self.size
+            if evicted > 0:
+                self.spill(values, evicted)
+        if n >= self.size:
+            # Only the newest samples fit
+            values = values[-self.size:]
+            self.count += n - self.size
+            n = self.size
+        start = self.count % self.size
+        end = start + n
+        if end <= self.size:
+            self.data[start:end] = values
+        else:
+            split = self.size - start
+            self.data[start:] = values[:split]
+            self.data[:end - self.size] = values[split:]
+        self.count += n
+
+    def clear(self):
+        self.count = 0
+
+    def append(self, value):
+        self.extend([value])
+
+    def spill(self, values, evicted):
+        # Write the samples about to be overwritten (oldest first) to disk
+        history = self.view()
+        from_history = min(evicted, len(history))
+        self.spill_file.write(history[:from_history].tobytes())
+        if evicted > from_history:
+            self.spill_file.write(values[:evicted - from_history].tobytes())
+        self.spill_file.flush()
+
+    def view(self):
+        # Samples in chronological order. Copies at most `size` values.
+        if self.count <= self.size:
+            return self.data[:self.count]
+        start = self.count % self.size
+        return np.concatenate((self.data[start:], self.data[:start]))
+
+    def last(self):
+        return self.data[(self.count - 1) % self.size]
+
+    def full_history(self):
+        # Spilled samples followed by the ones still in memory
+        if self.spill_path is None:
+            return self.view()
+        return np.concatenate((np.fromfile(self.spill_path, dtype=np.float64), self.view()))
+
+    def close(self):
+        if self.spill_file is not None:
+            self.spill_file.close()
+            self.spill_file = None
@@ -0,0 +1,108 @@
+import time
+
+# Time unit of each LAMMPS units style, for the speed label
+TIME_UNITS = {"lj": "tau", "real": "fs", "metal": "ps", "si": "s", "cgs": "s", "electron": "fs",
+              "micro": "us", "nano": "ns"}
+
+
+class StepScheduler:
+    """Picks the number of MD steps per frame and runs them without per-run setup.
+
+    A plain "run N" sets up the whole system (neighbor lists, forces, fix setup) and prints
+    its statistics every call. As long as nothing changed between runs that work isn't
+    needed, so runs continue with "pre no post no". invalidate() has to be called after
+    any other LAMMPS command; the next run then does the full setup again.
+
+    Runs are issued as parts of a window of horizon steps ("start"/"stop"), which fixes
+    that size their storage at setup (fix vector) see as one long run. A run that would
+    leave the window starts a new one. Fixes that ramp a value over a run (langevin, nph)
+    would ramp over the whole window, so the thermostat and barostat hold their targets.
+
+    The speed value (the speed slider, 1-10) is interpreted according to mode:
+      "fixed": that many steps per frame
+      "rate":  a target of simulated time per wall second, doubling with every notch
+      "fps":   a target frame rate of 6 frames per second per notch
+    In the adaptive modes the step count comes from running averages of the time an MD
+    step takes and of the time between runs, so it follows the cost of the system.
+    """
+    MODES = ["fixed", "rate", "fps"]
+
+    def __init__(self, mode="fixed", base_fps=30, min_fps=5, max_steps=10000, horizon=1000, smoothing=0.2):
+        self.mode = mode
+        self.base_fps = base_fps  # at speed 1 the rate target is one step per frame at base_fps
+        self.min_fps = min_fps  # the rate target never pushes the frame rate below this
+        self.max_steps = max_steps
+        self.horizon = horizon
+        self.window = None  # (start, stop) steps of the current window
+        self.smoothing = smoothing
+        self.needs_setup = True
+        self.step_time = None  # seconds per MD step
+        self.overhead = None  # seconds per frame spent outside of runs
+        self.period = None  # seconds from the start of one run to the start of the next
+        self.steps = 1
+        self.last_start = None
+        self.last_elapsed = 0.0
+        self.steps_per_second = 0.0
+
+    def invalidate(self):
+        self.needs_setup = True
+
+    def average(self, old, new):
+        return new if old is None else old + self.smoothing * (new - old)
+
+    def target_rate(self, speed, dt):
+        # Simulated time per wall second for a speed value
+        return self.base_fps * dt * 2 ** (speed - 1)
+
+    def plan(self, speed, dt):
+        if self.mode == "fixed" or self.step_time is None or self.overhead is None:
+            return max(1, int(speed)) if self.mode == "fixed" else 1
+        overhead = self.overhead
+        if self.mode == "fps":
+            steps = (1 / (6 * speed) - overhead) / self.step_time
+        else:
+            # steps * dt = rate * (overhead + steps * step_time), solved for steps
+            rate = self.target_rate(speed, dt)
+            if dt > rate * self.step_time:
+                steps = rate * overhead / (dt - rate * self.step_time)
+            else:
+                steps = self.max_steps
+            steps = min(steps, (1 / self.min_fps - overhead) / self.step_time)
+        return int(max(1, min(self.max_steps, round(steps))))
+
+    def run(self, lmp, speed):
+        # Run the next batch of steps and return how many were run
+        start = time.perf_counter()
+        if self.last_start is not None and start - self.last_start < 1.0:
+            # Longer gaps are pauses, they say nothing about the frame rate. The overhead
+            # is the time per frame not spent in MD (rendering, gathering, waiting for
+            # the next tick).
+            self.period = self.average(self.period, start - self.last_start)
+            self.overhead = self.average(self.overhead, max(0.0, start - self.last_start - self.last_elapsed))
+        self.last_start = start
+        dt = lmp.extract_global("dt") if self.mode == "rate" else 0.0
+        self.steps = self.plan(speed, dt)
+
+        step = lmp.extract_global("ntimestep")
+        setup = self.needs_setup or self.window is None or step + self.steps > self.window[1]
+        if setup:
+            self.window = (step, step + max(self.horizon, self.steps))
+        lmp.command(f"run {self.steps} start {self.window[0]} stop {self.window[1]} "
+                    f"pre {'yes' if setup else 'no'} post no")
+        self.needs_setup = False
+        elapsed = time.perf_counter() - start
+        self.last_elapsed = elapsed
+        # A run with setup is slower than the steps alone, it only seeds the average
+        if not setup or self.step_time is None:
+            self.step_time = self.average(self.step_time, elapsed / self.steps)
+        self.steps_per_second = self.steps / self.period if self.period else self.steps / elapsed
+        return self.steps
+
+    def describe(self, speed, lmp=None):
+        # Speed label text
+        if self.mode == "fps":
+            return f"{6 * speed} fps"
+        if self.mode == "rate" and lmp is not None:
+            units = TIME_UNITS.get(lmp.extract_global("units"), "time units")
+            return f"{self.target_rate(speed, lmp.extract_global('dt')):.3g} {units}/s"
+        return f"{speed} steps/frame"
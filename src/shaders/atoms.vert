@@ -0,0 +1,33 @@
+#version 330
+
+// One sphere mesh drawn once per atom. Per-instance data lives in buffer
+// textures that InstancedAtoms refills from NumPy in a single write. Each level
+// of detail draws the atoms listed in its slice of atom_order.
+uniform mat4 p3d_ModelViewProjectionMatrix;
+uniform mat4 p3d_ModelViewMatrix;
+uniform mat3 p3d_NormalMatrix;
+
+uniform samplerBuffer atom_positions;   // xyz = position
+uniform samplerBuffer atom_scales;      // xyz = scale
+uniform samplerBuffer atom_colors;      // rgba
+uniform samplerBuffer atom_order;       // x = atom index, grouped by level
+uniform float lod_offset;               // start of this level's slice
+
+in vec4 p3d_Vertex;
+in vec3 p3d_Normal;
+
+out vec3 v_position;
+out vec3 v_normal;
+out vec4 v_color;
+
+void main() {
+    int atom = int(texelFetch(atom_order, int(lod_offset) + gl_InstanceID).x);
+    vec3 pos = texelFetch(atom_positions, atom).xyz;
+    vec3 scale = texelFetch(atom_scales, atom).xyz;
+    vec4 world = vec4(p3d_Vertex.xyz * scale + pos, 1.0);
+
+    gl_Position = p3d_ModelViewProjectionMatrix * world;
+    v_position = vec3(p3d_ModelViewMatrix * world);
+    v_normal = normalize(p3d_NormalMatrix * (p3d_Normal / scale));
+    v_color = texelFetch(atom_colors, atom);
+}
@@ -0,0 +1,35 @@
+#version 330
+
+// Instanced half-bond cylinders. The mesh is a unit cylinder along +z (radius 1,
+// z from 0 to 1) that is oriented and stretched per instance in here.
+uniform mat4 p3d_ModelViewProjectionMatrix;
+uniform mat4 p3d_ModelViewMatrix;
+uniform mat3 p3d_NormalMatrix;
+
+uniform samplerBuffer bond_starts;   // xyz = start point, w = radius
+uniform samplerBuffer bond_ends;     // xyz = end point
+uniform samplerBuffer bond_colors;   // rgba
+
+in vec4 p3d_Vertex;
+in vec3 p3d_Normal;
+
+out vec3 v_position;
+out vec3 v_normal;
+out vec4 v_color;
+
+void main() {
+    vec4 start = texelFetch(bond_starts, gl_InstanceID);
+    vec3 axis = texelFetch(bond_ends, gl_InstanceID).xyz - start.xyz;
+    vec3 w = normalize(axis + vec3(0.0, 0.0, 1e-9));
+    vec3 a = abs(w.x) < 0.9 ? vec3(1.0, 0.0, 0.0) : vec3(0.0, 1.0, 0.0);
+    vec3 u = normalize(cross(w, a));
+    vec3 v = cross(w, u);
+
+    vec3 world = start.xyz + (u * p3d_Vertex.x + v * p3d_Vertex.y) * start.w + axis * p3d_Vertex.z;
+    vec3 normal = u * p3d_Normal.x + v * p3d_Normal.y;
+
+    gl_Position = p3d_ModelViewProjectionMatrix * vec4(world, 1.0);
+    v_position = vec3(p3d_ModelViewMatrix * vec4(world, 1.0));
+    v_normal = normalize(p3d_NormalMatrix * normal);
+    v_color = texelFetch(bond_colors, gl_InstanceID);
+}
@@ -0,0 +1,45 @@
+#version 330
+
+// Ray casts the sphere behind each impostor quad and writes its true depth, so
+// impostors intersect each other, bonds and the box like real geometry. Lighting
+// matches lit.frag.
+uniform mat4 p3d_ProjectionMatrix;
+
+uniform struct p3d_LightSourceParameters {
+    vec4 color;
+    vec4 position;
+} p3d_LightSource[4];
+
+uniform struct p3d_LightModelParameters {
+    vec4 ambient;
+} p3d_LightModel;
+
+in vec3 v_position;
+flat in vec3 v_center;
+flat in float v_radius;
+in vec4 v_color;
+
+out vec4 p3d_FragColor;
+
+void main() {
+    // Nearest intersection of the view ray through this fragment with the sphere
+    vec3 ray = normalize(v_position);
+    float b = dot(ray, v_center);
+    float disc = b * b - dot(v_center, v_center) + v_radius * v_radius;
+    if (disc < 0.0) {
+        discard;
+    }
+    vec3 hit = ray * (b - sqrt(disc));
+    vec3 n = (hit - v_center) / v_radius;
+
+    vec4 clip = p3d_ProjectionMatrix * vec4(hit, 1.0);
+    gl_FragDepth = 0.5 * (clip.z / clip.w) + 0.5;
+
+    vec3 light = p3d_LightModel.ambient.rgb;
+    for (int i = 0; i < 4; ++i) {
+        vec4 lp = p3d_LightSource[i].position;
+        vec3 l = normalize(lp.xyz - hit * lp.w);
+        light += p3d_LightSource[i].color.rgb * max(dot(n, l), 0.0);
+    }
+    p3d_FragColor = vec4(v_color.rgb * light, v_color.a);
+}
@@ -0,0 +1,44 @@
+#version 330
+
+// Sphere impostors. Every atom is one quad placed at the atom, facing the
+// camera and just large enough to cover the sphere's silhouette. The fragment
+// shader ray casts the actual sphere.
+uniform mat4 p3d_ModelViewMatrix;
+uniform mat4 p3d_ProjectionMatrix;
+
+uniform samplerBuffer atom_positions;   // xyz = position
+uniform samplerBuffer atom_scales;      // xyz = scale
+uniform samplerBuffer atom_colors;      // rgba
+uniform samplerBuffer atom_order;       // x = atom index
+uniform float lod_offset;
+uniform float sphere_radius;            // radius of the sphere mesh at scale 1
+
+in vec4 p3d_Vertex;
+
+out vec3 v_position;
+flat out vec3 v_center;
+flat out float v_radius;
+out vec4 v_color;
+
+void main() {
+    int atom = int(texelFetch(atom_order, int(lod_offset) + gl_InstanceID).x);
+    vec3 pos = texelFetch(atom_positions, atom).xyz;
+    vec3 scale = texelFetch(atom_scales, atom).xyz;
+    float radius = sphere_radius * max(scale.x, max(scale.y, scale.z));
+
+    // Camera space, the camera sits at the origin
+    vec3 center = vec3(p3d_ModelViewMatrix * vec4(pos, 1.0));
+    float dist = length(center);
+    vec3 dir = center / dist;
+    vec3 hint = abs(dir.z) < 0.9 ? vec3(0.0, 0.0, 1.0) : vec3(0.0, 1.0, 0.0);
+    vec3 right = normalize(cross(dir, hint));
+    vec3 up = cross(right, dir);
+    // Half size of the quad that covers the silhouette cone at the center's distance
+    float half_size = radius * dist / sqrt(max(dist * dist - radius * radius, 1e-4 * dist * dist));
+
+    v_position = center + (right * p3d_Vertex.x + up * p3d_Vertex.y) * half_size;
+    v_center = center;
+    v_radius = radius;
+    v_color = texelFetch(atom_colors, atom);
+    gl_Position = p3d_ProjectionMatrix * vec4(v_position, 1.0);
+}
@@ -0,0 +1,29 @@
+#version 330
+
+// Ambient + directional/point lighting matching the lights set up in
+// OffscreenPanda.__init__. Unused light slots have a black color.
+uniform struct p3d_LightSourceParameters {
+    vec4 color;
+    vec4 position;
+} p3d_LightSource[4];
+
+uniform struct p3d_LightModelParameters {
+    vec4 ambient;
+} p3d_LightModel;
+
+in vec3 v_position;
+in vec3 v_normal;
+in vec4 v_color;
+
+out vec4 p3d_FragColor;
+
+void main() {
+    vec3 n = normalize(v_normal);
+    vec3 light = p3d_LightModel.ambient.rgb;
+    for (int i = 0; i < 4; ++i) {
+        vec4 lp = p3d_LightSource[i].position;
+        vec3 l = normalize(lp.xyz - v_position * lp.w);
+        light += p3d_LightSource[i].color.rgb * max(dot(n, l), 0.0);
+    }
+    p3d_FragColor = vec4(v_color.rgb * light, v_color.a);
+}
@@ -1,4 +1,5 @@
 import sys
+import argparse
 from PyQt6 import QtWidgets
 from direct.showbase.ShowBase import ShowBase
 from direct.task import Task
@@ -7,20 +8,79 @@ from panda3d.core import *
 from lammps import lammps, LMP_TYPE_VECTOR, LMP_STYLE_ATOM, LMP_TYPE_ARRAY
 from panda import OffscreenPanda
 from mainwindow import MainWindow
-
-# Offscreen Panda3D config
-load_prc_file_data("", "window-type offscreen")
-load_prc_file_data("", "gl-force-software true")
+from parallel import lammps_args, world, worker_loop
+from coloring import COLORMAPS, PRESETS
+from backend import add_backend_arguments, backend_from_args
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Atomistic Simulation Visualiser")
+    parser.add_argument("--threaded", action="store_true",
+                        help="advance LAMMPS in a background thread independent of the display frame rate")
+    parser.add_argument("--bond-style", choices=["lines", "cylinders"], default="lines",
+                        help="draw bonds as line segments or as instanced cylinders")
+    parser.add_argument("--atom-style", choices=["spheres", "impostors"], default="spheres",
+                        help="draw atoms as instanced sphere meshes or as ray-cast impostors for very large systems")
+    parser.add_argument("--atom-detail", choices=["auto", "high", "standard", "low"], default="auto",
+                        help="atom mesh level of detail, auto picks one per atom from its size on screen")
+    parser.add_argument("--history-dir", default=None,
+                        help="spill thermo history older than the plotted window to raw files in this directory")
+    parser.add_argument("--record", metavar="PATH", default=None,
+                        help="record positions, box and thermo to a compressed trajectory file")
+    parser.add_argument("--play", metavar="PATH", default=None,
+                        help="play back a recorded trajectory, LAMMPS dump (text or binary) or data file instead of running LAMMPS")
+    parser.add_argument("--profile", metavar="PATH", default=None,
+                        help="stream per-stage frame timings and memory to a .csv file (JSON lines otherwise)")
+    parser.add_argument("--speed-mode", choices=["fixed", "rate", "fps"], default="rate",
+                        help="what the speed slider sets: steps per frame, simulated time per second or frame rate")
+    parser.add_argument("--threads", type=int, default=0,
+                        help="OpenMP threads per LAMMPS process (uses the /omp styles of the OPENMP package)")
+    parser.add_argument("--mpi", action="store_true",
+                        help="spread LAMMPS over all ranks of mpirun, rank 0 gathers the atoms and draws them")
+    parser.add_argument("--color-by", default="type", metavar="SOURCE",
+                        help=f"color atoms by {', '.join(PRESETS)} or a per-atom value like c_ID[2], f_ID, v_name or vx")
+    parser.add_argument("--colormap", choices=list(COLORMAPS), default="viridis")
+    parser.add_argument("--analysis", action="store_true",
+                        help="compute RDF, coordination and MSD on worker threads and plot them")
+    add_backend_arguments(parser)
+    args, qt_args = parser.parse_known_args()
+
+    if args.mpi and world().Get_rank() > 0:
+        # Only rank 0 opens a window, the others just take part in the simulation
+        sys.exit(worker_loop(lammps_args(args.threads)))
+
+    # Offscreen Panda3D config, set before the ShowBase opens its window
+    backend_from_args(parser, args).apply()
     W, H = 1080, 960
-    panda = OffscreenPanda(W, H)
+    panda = OffscreenPanda(W, H, history_dir=args.history_dir, trajectory=args.play,
+                           omp_threads=args.threads, mpi=args.mpi and args.play is None)
+    panda.bond_style = args.bond_style
+    panda.scheduler.mode = args.speed_mode
+    panda.set_atom_style(args.atom_style)
+    panda.set_atom_detail(args.atom_detail)
+    if panda.playback is None:
+        panda.set_coloring(args.color_by, args.colormap)
+    if args.profile:
+        panda.profiler.enabled = True
+        panda.profiler.start_export(args.profile)
     panda.moveAtomsTask()
     panda.drawSimulationBoxTask()
     panda.center_camera()
+    if args.record and panda.playback is None:
+        panda.startRecording(args.record)
+    if args.threaded and panda.playback is None:
+        panda.startEngine()
+    if args.analysis:
+        panda.startAnalysis()
 
-    app = QtWidgets.QApplication(sys.argv)
+    app = QtWidgets.QApplication(sys.argv[:1] + qt_args)
     win = MainWindow(panda)
     win.show()
-    sys.exit(app.exec())
\ No newline at end of file
+    exit_code = app.exec()
+    panda.stopEngine()
+    panda.stopAnalysis()
+    panda.stopRecording()
+    panda.profiler.stop_export()
+    if panda.parallel:
+        panda.lmp.close()
+    sys.exit(exit_code)
\ No newline at end of file
@@ -0,0 +1,69 @@
+import numpy as np
+from funcs import THERMOSTAT_FIX, BAROSTAT_FIX, thermostatCommand, barostatCommand
+
+
+class SavedState:
+    """Simulation state held in memory so a reset or jump back doesn't re-read the deck.
+
+    Positions, velocities and image flags are stored in atom ID order, together with the
+    box, the step and the thermostat/barostat settings driven from the UI. Restoring
+    writes them straight into LAMMPS' per-atom arrays, so it costs the same for any deck.
+    """
+    def __init__(self, name, panda):
+        lmp = panda.lmp
+        natoms = len(panda.atom_ids)
+        # x and ix in the same layout the renderer uses, so a restore doesn't need LAMMPS
+        # to re-evaluate any computes
+        self.x = np.empty((natoms, 3))
+        self.ix = np.empty((natoms, 3), dtype=np.int32)
+        panda.gatherAtoms(self.x, self.ix)
+        if panda.parallel:
+            self.v = lmp.gather("v", 3).copy()
+            self.image = lmp.gather("image", 1, integer=True).copy()
+        else:
+            ids = panda.localRows()
+            nlocal = len(ids)
+            image = lmp.numpy.extract_atom("image")
+            self.v = np.empty((natoms, 3))
+            self.image = np.empty(natoms, dtype=image.dtype)
+            self.v[ids] = lmp.numpy.extract_atom("v")[0:nlocal]
+            self.image[ids] = image[0:nlocal]
+        boxlo, boxhi, xy, yz, xz, periodicity, box_change = lmp.extract_box()
+        self.box = (list(boxlo), list(boxhi), xy, xz, yz)
+        self.step = int(lmp.get_thermo("step"))
+        self.name = name or f"Step {self.step}"
+        self.fixes = set(lmp.available_ids("fix"))
+        self.controls = {"timestep": panda.timestep, "tStop": panda.tStop, "pStop": panda.pStop}
+
+    def restore(self, panda):
+        lmp = panda.lmp
+        for fix in lmp.available_ids("fix"):
+            if fix not in self.fixes:
+                lmp.command(f"unfix {fix}")
+        lmp.command(f"reset_timestep {self.step}")
+        (xlo, ylo, zlo), (xhi, yhi, zhi), xy, xz, yz = self.box
+        tilt = f" xy final {xy} xz final {xz} yz final {yz}" if lmp.extract_setting("triclinic") else ""
+        lmp.command(f"change_box all x final {xlo} {xhi} y final {ylo} {yhi} z final {zlo} {zhi}{tilt} units box")
+
+        # Atoms stay with their current owner, only their values are overwritten. The
+        # next run's setup re-wraps them and rebuilds ghosts and neighbor lists.
+        if panda.parallel:
+            lmp.scatter("x", self.x)
+            lmp.scatter("v", self.v)
+            lmp.scatter("image", self.image, integer=True)
+        else:
+            ids = panda.localRows()
+            nlocal = len(ids)
+            lmp.numpy.extract_atom("x")[0:nlocal] = self.x[ids]
+            lmp.numpy.extract_atom("v")[0:nlocal] = self.v[ids]
+            lmp.numpy.extract_atom("image")[0:nlocal] = self.image[ids]
+
+        # Fixes created after the state was saved are removed above, the ones the UI
+        # changes are put back to their saved settings
+        for key, value in self.controls.items():
+            setattr(panda, key, value)
+        if THERMOSTAT_FIX in self.fixes:
+            lmp.command(thermostatCommand(panda))
+        if BAROSTAT_FIX in self.fixes:
+            lmp.command(barostatCommand(panda))
+
@@ -0,0 +1,122 @@
+// Decoder for the /geometry stream, the browser counterpart of geometry.GeometryDecoder.
+// See geometry.py for the message layout.
+//
+//     const decoder = new GeometryDecoder();
+//     const reader = (await fetch("/geometry")).body.getReader();
+//     for (;;) {
+//         const {value, done} = await reader.read();
+//         if (done) break;
+//         for (const frame of await decoder.feed(value)) draw(frame);
+//     }
+
+const MAGIC = 0x47565341;  // "ASVG"
+const HEADER_SIZE = 28;
+const KEYFRAME = 1;
+const BONDS = 2;
+
+async function inflate(bytes) {
+    // Payloads are zlib streams, which DecompressionStream calls "deflate"
+    const stream = new Blob([bytes]).stream().pipeThrough(new DecompressionStream("deflate"));
+    return new Uint8Array(await new Response(stream).arrayBuffer());
+}
+
+function fromBytePlanes(raw, offset, count) {
+    const values = new Uint16Array(count);
+    for (let i = 0; i < count; i++) {
+        values[i] = raw[offset + i] | (raw[offset + count + i] << 8);
+    }
+    return values;
+}
+
+class GeometryDecoder {
+    constructor() {
+        this.previous = null;
+        this.types = null;
+        this.meta = {};
+        this.bonds = new Int32Array(0);
+        this.buffer = new Uint8Array(0);
+    }
+
+    async feed(chunk) {
+        // Split arbitrary chunks of the byte stream into messages, decode the complete ones
+        const joined = new Uint8Array(this.buffer.length + chunk.length);
+        joined.set(this.buffer);
+        joined.set(chunk, this.buffer.length);
+        const frames = [];
+        let pos = 0;
+        while (joined.length - pos >= HEADER_SIZE) {
+            const view = new DataView(joined.buffer, pos, HEADER_SIZE);
+            const length = HEADER_SIZE + view.getInt32(24, true);
+            if (joined.length - pos < length) break;
+            const frame = await this.decode(joined.subarray(pos, pos + length));
+            if (frame) frames.push(frame);
+            pos += length;
+        }
+        this.buffer = joined.slice(pos);
+        return frames;
+    }
+
+    async decode(message) {
+        const header = new DataView(message.buffer, message.byteOffset, HEADER_SIZE);
+        if (header.getUint32(0, true) !== MAGIC || header.getUint8(4) !== 1) {
+            throw new Error("not an ASV geometry message");
+        }
+        const flags = header.getUint8(5);
+        const bits = header.getUint16(6, true);
+        const frame = Number(header.getBigInt64(8, true));
+        const natoms = header.getInt32(16, true);
+        const nbonds = header.getInt32(20, true);
+        if (!(flags & KEYFRAME) && this.previous === null) return null;
+
+        const raw = await inflate(message.subarray(HEADER_SIZE));
+        const data = new DataView(raw.buffer);
+        const cell = new Float64Array(9);
+        const boxlo = new Float64Array(3);
+        for (let i = 0; i < 9; i++) cell[i] = data.getFloat64(8 * i, true);
+        for (let i = 0; i < 3; i++) boxlo[i] = data.getFloat64(72 + 8 * i, true);
+        let pos = 96;
+        const count = 3 * natoms;
+        let q;
+        if (flags & KEYFRAME) {
+            const metaLength = data.getInt32(pos, true);
+            this.meta = JSON.parse(new TextDecoder().decode(raw.subarray(pos + 4, pos + 4 + metaLength)));
+            pos += 4 + metaLength;
+            this.types = new Uint16Array(natoms);
+            for (let i = 0; i < natoms; i++) this.types[i] = data.getUint16(pos + 2 * i, true);
+            pos += 2 * natoms;
+            q = fromBytePlanes(raw, pos, count);
+        } else {
+            const zigzag = fromBytePlanes(raw, pos, count);
+            q = new Uint16Array(count);
+            for (let i = 0; i < count; i++) {
+                const z = zigzag[i];
+                q[i] = this.previous[i] + ((z >>> 1) ^ -(z & 1));
+            }
+        }
+        pos += 2 * count;
+        this.previous = q;
+
+        if (flags & BONDS) {
+            this.bonds = new Int32Array(2 * nbonds);
+            let i = 0;
+            for (let b = 0; b < nbonds; b++) {
+                i += data.getInt32(pos + 4 * b, true);
+                this.bonds[2 * b] = i;
+                this.bonds[2 * b + 1] = i + data.getInt32(pos + 4 * (nbonds + b), true);
+            }
+        }
+
+        // Fractional coordinates back to box units, x = f @ cell + boxlo
+        const scale = 1 / ((1 << bits) - 1);
+        const x = new Float32Array(count);
+        for (let a = 0; a < natoms; a++) {
+            const f0 = q[3 * a] * scale, f1 = q[3 * a + 1] * scale, f2 = q[3 * a + 2] * scale;
+            for (let k = 0; k < 3; k++) {
+                x[3 * a + k] = f0 * cell[k] + f1 * cell[3 + k] + f2 * cell[6 + k] + boxlo[k];
+            }
+        }
+        return {frame, x, types: this.types, cell, boxlo, bonds: this.bonds, meta: this.meta};
+    }
+}
+
+if (typeof module !== "undefined") module.exports = {GeometryDecoder};
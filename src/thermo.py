@@ -0,0 +1,78 @@
+import numpy as np
+from lammps import LMP_VAR_VECTOR
+
+
+class ThermoCapture:
+    """Records every thermo_style quantity on every MD step with a LAMMPS fix vector.
+
+    lmp.last_thermo() only sees the last step of a run. The fix stores one row per step
+    instead. Every column is exposed as a vector-style variable, so read() fetches each
+    one with a single extract_variable call and copies the rows added since the previous
+    call into a preallocated NumPy buffer.
+    """
+    fix_id = "asv_thermo"
+
+    def __init__(self, lmp, keywords, max_rows=10000, on_change=None):
+        self.lmp = lmp
+        # Called whenever the fix is added or removed, runs need a full setup after that
+        self.on_change = on_change
+        self.keys = [keyword.upper() for keyword in keywords]
+        self.max_rows = max_rows
+        # Compute, fix and variable references can go into the fix directly. Plain thermo
+        # keywords (step, temp, press, ...) are wrapped in equal-style variables.
+        values = []
+        for keyword in keywords:
+            if keyword[:2] in ("c_", "f_", "v_"):
+                values.append(keyword)
+            else:
+                self.lmp.command(f"variable asv_{keyword} equal {keyword}")
+                values.append(f"v_asv_{keyword}")
+        self.values = values
+        # Variables are evaluated when read, so they survive the fix being recreated
+        if len(values) == 1:
+            self.columns = ["asv_col_1"]
+            self.lmp.command(f"variable asv_col_1 vector f_{self.fix_id}")
+        else:
+            self.columns = [f"asv_col_{k}" for k in range(1, len(values) + 1)]
+            for k, name in enumerate(self.columns, 1):
+                self.lmp.command(f"variable {name} vector f_{self.fix_id}[{k}]")
+        self.buffer = np.empty((16, len(self.keys)))
+        self.start()
+
+    def start(self):
+        # The fix stores a row at the step it is created on (during the next run's setup)
+        # and at every step after that
+        self.lmp.command(f"fix {self.fix_id} all vector 1 {' '.join(self.values)}")
+        if self.on_change is not None:
+            self.on_change()
+        self.first_step = int(self.lmp.get_thermo("step"))
+        self.rows_read = 0
+
+    def stop(self):
+        self.lmp.command(f"unfix {self.fix_id}")
+        if self.on_change is not None:
+            self.on_change()
+
+    def restart(self):
+        # Drop the stored history so the fix doesn't grow without bounds. The new fix
+        # repeats the last row the old one already delivered, so skip it.
+        self.stop()
+        self.start()
+        self.rows_read = 1
+
+    def read(self):
+        rows = int(self.lmp.get_thermo("step")) - self.first_step + 1
+        n = rows - self.rows_read
+        if n <= 0:
+            return self.buffer[:0]
+        if n > len(self.buffer):
+            self.buffer = np.empty((max(n, 2 * len(self.buffer)), len(self.keys)))
+
+        for c, name in enumerate(self.columns):
+            column = self.lmp.numpy.extract_variable(name, vartype=LMP_VAR_VECTOR)
+            self.buffer[:n, c] = column[self.rows_read:rows]
+        self.rows_read = rows
+
+        if self.rows_read >= self.max_rows:
+            self.restart()
+        return self.buffer[:n]
@@ -0,0 +1,218 @@
+import json
+import mmap
+import queue
+import struct
+import threading
+import zlib
+import numpy as np
+
+# File layout
+#   header : MAGIC, natoms, chunk_frames, header json length, json (thermo keys, periodicity),
+#            atom types (int32, ID order)
+#   chunks : compressed length, frame count, zlib(x, ix, cell, boxlo, thermo counts, thermo rows)
+#   footer : chunk offsets, chunk count, frame count, INDEX_MAGIC
+# The footer is only written on close. A file from a crashed run is still readable, the
+# reader then rebuilds the chunk index by walking the chunk headers.
+MAGIC = b"ASVTRJ01"
+INDEX_MAGIC = b"ASVINDEX"
+HEADER = struct.Struct("<8sqii")
+CHUNK = struct.Struct("<qi")
+FOOTER = struct.Struct("<qq8s")
+
+
+class Frame:
+    """Snapshot of one recorded frame, in the same layout OffscreenPanda uses."""
+    def __init__(self, x, ix, cell, boxlo, thermo):
+        self.x = x
+        self.ix = ix
+        self.cell = cell
+        self.boxlo = boxlo
+        self.thermo = thermo
+
+
+class TrajectoryWriter:
+    """Streams frames into a chunked, zlib compressed trajectory file.
+
+    write() only copies the arrays into the pending chunk. Compression and disk IO happen
+    on a background thread, so recording costs the simulation loop one memcpy per frame.
+    If that thread fails (disk full, ...) its exception is raised by the next write(),
+    flush() or close().
+    """
+    def __init__(self, path, types, thermo_keys, periodicity, chunk_frames=32, level=1):
+        self.path = path
+        self.natoms = len(types)
+        self.thermo_keys = list(thermo_keys)
+        self.chunk_frames = chunk_frames
+        self.level = level
+        self.file = open(path, "wb")
+        meta = json.dumps({"thermo_keys": self.thermo_keys,
+                           "periodicity": [bool(p) for p in periodicity]}).encode()
+        self.file.write(HEADER.pack(MAGIC, self.natoms, chunk_frames, len(meta)))
+        self.file.write(meta)
+        self.file.write(np.asarray(types, dtype=np.int32).tobytes())
+        self.offsets = []
+        self.n_frames = 0
+        self.new_chunk()
+        # write() may be called from the simulation engine thread while the UI closes the file
+        self.lock = threading.Lock()
+        self.closed = False
+        self.error = None
+
+        self.queue = queue.Queue(maxsize=8)
+        self.thread = threading.Thread(target=self.writer_loop, daemon=True)
+        self.thread.start()
+
+    def new_chunk(self):
+        k, n = self.chunk_frames, self.natoms
+        self.x = np.empty((k, n, 3), dtype=np.float32)
+        self.ix = np.empty((k, n, 3), dtype=np.int32)
+        self.cell = np.empty((k, 3, 3))
+        self.boxlo = np.empty((k, 3))
+        self.thermo = []
+        self.filled = 0
+
+    def write(self, x, ix, cell, boxlo, thermo_rows):
+        with self.lock:
+            if self.error is not None:
+                raise self.error
+            if not self.closed:
+                self.add_frame(x, ix, cell, boxlo, thermo_rows)
+
+    def add_frame(self, x, ix, cell, boxlo, thermo_rows):
+        i = self.filled
+        self.x[i] = x
+        self.ix[i] = ix
+        self.cell[i] = cell
+        self.boxlo[i] = boxlo
+        self.thermo.append(np.array(thermo_rows, dtype=np.float64).reshape(-1, len(self.thermo_keys)))
+        self.filled += 1
+        self.n_frames += 1
+        if self.filled == self.chunk_frames:
+            self.flush()
+
+    def flush(self):
+        if self.error is not None:
+            raise self.error
+        if self.filled == 0:
+            return
+        f = self.filled
+        counts = np.array([len(rows) for rows in self.thermo], dtype=np.int32)
+        parts = [self.x[:f], self.ix[:f], self.cell[:f], self.boxlo[:f], counts,
+                 np.concatenate(self.thermo) if self.thermo else np.empty((0, len(self.thermo_keys)))]
+        self.queue.put((f, parts))
+        self.new_chunk()
+
+    def writer_loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if self.error is not None:
+                continue  # chunks after a failed one are dropped, the queue is only drained
+            frames, parts = item
+            try:
+                data = zlib.compress(b"".join(np.ascontiguousarray(p).tobytes() for p in parts), self.level)
+                offset = self.file.tell()
+                self.file.write(CHUNK.pack(len(data), frames))
+                self.file.write(data)
+            except Exception as e:
+                self.error = e
+                continue
+            self.offsets.append(offset)
+
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            try:
+                self.flush()
+            except Exception:
+                pass  # the writer's error, raised once the file is closed
+        self.queue.put(None)
+        self.thread.join()
+        try:
+            # Without the footer a reader indexes the chunks that made it to disk
+            if self.error is None:
+                self.file.write(np.array(self.offsets, dtype=np.int64).tobytes())
+                self.file.write(FOOTER.pack(len(self.offsets), self.n_frames, INDEX_MAGIC))
+        finally:
+            self.file.close()
+        if self.error is not None:
+            raise self.error
+
+
+class TrajectoryReader:
+    """Memory maps a trajectory file for O(1) access to any frame."""
+    def __init__(self, path, cache_chunks=4):
+        self.file = open(path, "rb")
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.natoms, self.chunk_frames, meta_len = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not an ASV trajectory file")
+        pos = HEADER.size
+        meta = json.loads(self.mm[pos:pos + meta_len].decode())
+        pos += meta_len
+        self.thermo_keys = meta["thermo_keys"]
+        self.periodicity = np.array(meta["periodicity"], dtype=bool)
+        self.types = np.frombuffer(self.mm, dtype=np.int32, count=self.natoms, offset=pos).copy()
+        self.data_start = pos + 4 * self.natoms
+
+        if self.mm[-8:] == INDEX_MAGIC:
+            n_chunks, self.n_frames, _ = FOOTER.unpack_from(self.mm, len(self.mm) - FOOTER.size)
+            index_start = len(self.mm) - FOOTER.size - 8 * n_chunks
+            self.offsets = np.frombuffer(self.mm, dtype=np.int64, count=n_chunks, offset=index_start)
+        else:
+            self.rebuild_index()
+        self.cache = {}
+        self.cache_chunks = cache_chunks
+
+    def rebuild_index(self):
+        offsets, frames, pos = [], 0, self.data_start
+        while pos + CHUNK.size <= len(self.mm):
+            size, count = CHUNK.unpack_from(self.mm, pos)
+            if pos + CHUNK.size + size > len(self.mm):
+                break
+            offsets.append(pos)
+            frames += count
+            pos += CHUNK.size + size
+        self.offsets = np.array(offsets, dtype=np.int64)
+        self.n_frames = frames
+
+    def load_chunk(self, c):
+        if c in self.cache:
+            return self.cache[c]
+        offset = int(self.offsets[c])
+        size, f = CHUNK.unpack_from(self.mm, offset)
+        start = offset + CHUNK.size
+        raw = zlib.decompress(self.mm[start:start + size])
+        n, k = self.natoms, len(self.thermo_keys)
+        pos = 0
+        fields = []
+        for dtype, shape in ((np.float32, (f, n, 3)), (np.int32, (f, n, 3)),
+                             (np.float64, (f, 3, 3)), (np.float64, (f, 3)), (np.int32, (f,))):
+            count = int(np.prod(shape))
+            fields.append(np.frombuffer(raw, dtype=dtype, count=count, offset=pos).reshape(shape))
+            pos += count * np.dtype(dtype).itemsize
+        thermo = np.frombuffer(raw, dtype=np.float64, offset=pos).reshape(-1, k)
+        bounds = np.concatenate(([0], np.cumsum(fields[4])))
+        chunk = (fields, thermo, bounds)
+        if len(self.cache) >= self.cache_chunks:
+            self.cache.pop(next(iter(self.cache)))
+        self.cache[c] = chunk
+        return chunk
+
+    def read_frame(self, i):
+        c, j = divmod(i, self.chunk_frames)
+        (x, ix, cell, boxlo, counts), thermo, bounds = self.load_chunk(c)
+        return Frame(x[j], ix[j], cell[j], boxlo[j], thermo[bounds[j]:bounds[j + 1]])
+
+    def thermo(self, i):
+        # Thermo rows recorded with frame i
+        return self.read_frame(i).thermo
+
+    def close(self):
+        self.cache.clear()
+        self.offsets = None
+        self.mm.close()
+        self.file.close()
@@ -0,0 +1,139 @@
+import os
+import sys
+import time
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+lammps = pytest.importorskip("lammps")
+from lammpsfiles import DataFileReader, DumpReader
+
+
+def write_data(path, style):
+    # Four atoms of types 2 and 3 (molecule 7 where the style has molecules) in a
+    # triclinic box, written by LAMMPS itself
+    lmp = lammps.lammps(cmdargs=["-log", "none", "-screen", "none", "-nocite"])
+    lmp.commands_list([
+        "units metal",
+        f"atom_style {style}",
+        "region box prism 0 10 0 12 0 14 1 0.5 0.25",
+        "create_box 3 box",
+        "create_atoms 2 single 1 1 1",
+        "create_atoms 3 single 5 6 7",
+        "create_atoms 2 single 9 2 3",
+        "create_atoms 3 single 3 10 12",
+        "mass * 1.0",
+    ])
+    if style == "full":
+        lmp.command("set group all mol 7")
+    x = np.array(lmp.numpy.extract_atom("x")[:4])
+    types = np.array(lmp.numpy.extract_atom("type")[:4])
+    lmp.command(f"write_data {path}")
+    lmp.close()
+    return x, types
+
+
+@pytest.mark.parametrize("style", ["atomic", "full"])
+def test_data_file_types_and_positions(tmp_path, style):
+    path = str(tmp_path / f"{style}.data")
+    x, types = write_data(path, style)
+    reader = DataFileReader(path)
+    try:
+        assert reader.natoms == 4
+        np.testing.assert_array_equal(reader.types, types)
+        np.testing.assert_allclose(reader.read_frame(0).x, x, atol=1e-6)
+    finally:
+        reader.close()
+
+
+def write_dump(path, frames=4):
+    # Text dump of a small fcc crystal, one frame every 5 steps
+    lmp = lammps.lammps(cmdargs=["-log", "none", "-screen", "none", "-nocite"])
+    lmp.commands_list([
+        "units lj",
+        "lattice fcc 0.8442",
+        "region box block 0 3 0 3 0 3",
+        "create_box 1 box",
+        "create_atoms 1 box",
+        "mass 1 1.0",
+        "velocity all create 1.0 87287",
+        "pair_style lj/cut 2.5",
+        "pair_coeff 1 1 1.0 1.0 2.5",
+        "fix 1 all nve",
+        f"dump d all custom 5 {path} id type x y z",
+        "dump_modify d sort id",
+        f"run {5 * (frames - 1)}",
+    ])
+    lmp.close()
+
+
+def test_dump_skips_frame_still_being_written(tmp_path):
+    path = str(tmp_path / "run.lammpstrj")
+    write_dump(path)
+    with open(path, "rb") as f:
+        data = f.read()
+    last = data.rfind(b"ITEM: TIMESTEP")
+    # Cut the last frame in the middle of its atoms, inside its header and right after
+    # or inside its step
+    step = last + len(b"ITEM: TIMESTEP\n")
+    for cut in (len(data) - 40, last + 40, step, step + 1):
+        partial = str(tmp_path / f"partial{cut}.lammpstrj")
+        with open(partial, "wb") as f:
+            f.write(data[:cut])
+        reader = DumpReader(partial)
+        try:
+            assert reader.n_frames == 3
+            assert reader.read_frame(2).x.shape == (108, 3)
+        finally:
+            reader.close()
+
+
+def test_binary_dump_skips_frame_still_being_written(tmp_path):
+    path = str(tmp_path / "run.bin")
+    write_dump(path)
+    with open(path, "rb") as f:
+        data = f.read()
+    reader = DumpReader(path)
+    last = int(reader.offsets[-1])
+    # Every cut inside the last frame's header and first chunk size, and a few in its data
+    first_chunk = reader.binary_header(last)["data"]
+    reader.close()
+    cuts = list(range(last, first_chunk + 1)) + list(range(first_chunk + 1, len(data), 997))
+    for cut in cuts:
+        partial = str(tmp_path / f"partial{cut}.bin")
+        with open(partial, "wb") as f:
+            f.write(data[:cut])
+        reader = DumpReader(partial, prefetch=0)
+        try:
+            assert reader.n_frames == 3, cut
+            assert reader.read_frame(2).x.shape == (108, 3)
+        finally:
+            reader.close()
+
+
+def test_dump_prefetch_error_is_raised_by_read_frame(tmp_path):
+    path = str(tmp_path / "run.lammpstrj")
+    write_dump(path)
+    with open(path, "rb") as f:
+        data = f.read()
+    # Garble an atom line of frame 2
+    frame = data.find(b"ITEM: ATOMS", data.find(b"ITEM: TIMESTEP\n10\n"))
+    line = data.find(b"\n", frame) + 1
+    data = data[:line] + b"x" + data[line + 1:]
+    with open(path, "wb") as f:
+        f.write(data)
+    reader = DumpReader(path, prefetch=2)
+    try:
+        reader.read_frame(0)
+        # Frames 1 and 2 are parsed in the background
+        deadline = time.monotonic() + 10
+        while 2 not in reader.cache and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert 2 in reader.cache
+        reader.read_frame(1)
+        with pytest.raises(ValueError):
+            reader.read_frame(2)
+        assert reader.thread.is_alive()
+        assert reader.read_frame(3).x.shape == (108, 3)
+    finally:
+        reader.close()
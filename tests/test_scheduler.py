@@ -0,0 +1,53 @@
+import os
+import sys
+from types import SimpleNamespace
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+lammps = pytest.importorskip("lammps")
+pytest.importorskip("panda3d")
+from funcs import changeThermo
+from scheduler import StepScheduler
+
+
+def lj_panda():
+    # Just enough of a Panda for the slider functions: an LJ liquid held at T = 1
+    lmp = lammps.lammps(cmdargs=["-log", "none", "-screen", "none", "-nocite"])
+    lmp.commands_list([
+        "units lj",
+        "lattice fcc 0.8442",
+        "region box block 0 6 0 6 0 6",
+        "create_box 1 box",
+        "create_atoms 1 box",
+        "mass 1 1.0",
+        "velocity all create 1.0 87287",
+        "pair_style lj/cut 2.5",
+        "pair_coeff 1 1 1.0 1.0 2.5",
+        "fix 1 all nve",
+        "fix 2 all langevin 1 1 0.1 102938",
+    ])
+    panda = SimpleNamespace(lmp=lmp, scheduler=StepScheduler(horizon=1000), tStop=1, pStop=0)
+
+    def lammpsCommand(cmd):
+        lmp.command(cmd)
+        panda.scheduler.invalidate()
+    panda.lammpsCommand = lammpsCommand
+    return panda
+
+
+def test_thermostat_target_holds_across_windows():
+    panda = lj_panda()
+    changeThermo(panda, None, 1585)
+    target = panda.tStop
+    temps = {}
+    try:
+        while panda.lmp.extract_global("ntimestep") < 2500:
+            panda.scheduler.run(panda.lmp, 100)
+            temps[panda.lmp.extract_global("ntimestep")] = panda.lmp.get_thermo("temp")
+    finally:
+        panda.lmp.close()
+    assert panda.scheduler.window[0] > 0
+    # The damping time is 20 steps, after that T stays at the target through every window
+    held = np.array([t for step, t in temps.items() if step >= 300])
+    np.testing.assert_allclose(held, target, rtol=0.15)
@@ -0,0 +1,36 @@
+import os
+import sys
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+from trajectory import TrajectoryWriter, TrajectoryReader
+
+
+def write_frames(writer, frames, natoms):
+    rng = np.random.default_rng(1)
+    for i in range(frames):
+        writer.write(rng.random((natoms, 3)), np.zeros((natoms, 3), dtype=np.int32), np.eye(3) * 10,
+                     np.zeros(3), [[i, 1.0]])
+
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path / "run.traj")
+    writer = TrajectoryWriter(path, np.ones(50), ["STEP", "Temp"], [True, True, False], chunk_frames=4)
+    write_frames(writer, 10, 50)
+    writer.close()
+    reader = TrajectoryReader(path)
+    assert reader.n_frames == 10
+    assert reader.read_frame(9).thermo[0, 0] == 9
+
+
+@pytest.mark.skipif(not os.path.exists("/dev/full"), reason="needs /dev/full")
+def test_write_error_is_raised_instead_of_blocking():
+    # Every write to /dev/full fails with ENOSPC, like a full disk
+    writer = TrajectoryWriter("/dev/full", np.ones(1000), ["STEP", "Temp"], [True] * 3, chunk_frames=2)
+    with pytest.raises(OSError):
+        # Far more chunks than the queue holds
+        write_frames(writer, 200, 1000)
+    with pytest.raises(OSError):
+        writer.close()
+    assert not writer.thread.is_alive()